@@ -0,0 +1,66 @@
+from aws_lambda_powertools.utilities.data_classes import DynamoDBStreamEvent
+from aws_lambda_powertools.utilities.data_classes.dynamo_db_stream_event import (
+    DynamoDBRecordEventName,
+)
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from aws_lambda_powertools import Logger, Tracer
+
+from archive import Archiver, S3ArchiveStore
+from dynamodb import DynamoDB
+from resilience import start_deadline
+from telemetry import metrics
+
+import os
+
+tracer = Tracer()
+logger = Logger()
+
+DDB_TABLE_NAME = os.environ["DDB_TABLE_NAME"]
+ARCHIVE_BUCKET_NAME = os.environ["ARCHIVE_BUCKET_NAME"]
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", 0)) or None
+# Sessions with no writes for this long are archived by the scheduled pass.
+ARCHIVE_IDLE_SECONDS = int(os.environ.get("ARCHIVE_IDLE_SECONDS", 7 * 86400))
+
+_archiver = None
+
+
+def get_archiver() -> Archiver:
+    global _archiver
+    if _archiver is None:
+        _archiver = Archiver(
+            S3ArchiveStore(ARCHIVE_BUCKET_NAME), DynamoDB(DDB_TABLE_NAME, ttl_seconds=SESSION_TTL_SECONDS)
+        )
+    return _archiver
+
+
+def is_ttl_delete(record) -> bool:
+    # TTL deletes are made by the DynamoDB service, not by our own deletes.
+    return (
+        record.event_name == DynamoDBRecordEventName.REMOVE
+        and record.user_identity.get("principalId") == "dynamodb.amazonaws.com"
+    )
+
+
+@logger.inject_lambda_context
+@tracer.capture_lambda_handler
+@metrics.log_metrics
+def lambda_handler(event: dict, context: LambdaContext) -> dict:
+    """
+    Archives history items expired by TTL, from the table's stream, or every
+    idle session when invoked by the schedule.
+    """
+    if "Records" in event:
+        items = [
+            record.dynamodb.old_image
+            for record in DynamoDBStreamEvent(event).records
+            if is_ttl_delete(record)
+        ]
+        if items:
+            get_archiver().archive_expired(items)
+        return {"archived_items": len(items)}
+
+    # Large tables take several scheduled runs, each stops before the timeout.
+    start_deadline(context.get_remaining_time_in_millis())
+    sessions = get_archiver().archive_idle(ARCHIVE_IDLE_SECONDS)
+    logger.info(f"Archived {sessions} idle sessions")
+    return {"archived_sessions": sessions}
@@ -3,20 +3,56 @@ from aws_lambda_powertools.event_handler import (
     Response,
     content_types,
 )
+from aws_lambda_powertools.event_handler.exceptions import (
+    BadRequestError,
+    NotFoundError,
+)
 from aws_lambda_powertools.event_handler.openapi.exceptions import (
     RequestValidationError,
 )
+from aws_lambda_powertools.event_handler.openapi.params import Query
 from aws_lambda_powertools.utilities.typing import LambdaContext
 from aws_lambda_powertools.logging import correlation_paths
 from aws_lambda_powertools import Logger, Tracer
-from aws_lambda_powertools.metrics import MetricUnit
 
 from botocore.exceptions import ClientError
 
-from models import Messages, Message, Event, ContentItem
-from chatbot_client import Chatbot
+from models import Messages, Message, Event, BatchEvent, ContentItem
+from chatbot_client import (
+    Chatbot,
+    ExecutionMode,
+    PersistenceMode,
+    Turn,
+    DEFAULT_BATCH_CONCURRENCY,
+)
+from response_cache import (
+    ResponseCache,
+    DEFAULT_RESPONSE_CACHE_SIZE,
+    DEFAULT_RESPONSE_CACHE_TTL_SECONDS,
+)
+from codec import DEFAULT_COMPRESSION_THRESHOLD_BYTES
+from dynamodb import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, MESSAGE_FIELDS
+from compaction import (
+    CompactionMode,
+    DEFAULT_COMPACTION_KEEP_TURNS,
+    DEFAULT_COMPACTION_MAX_TURNS,
+    DEFAULT_COMPACTION_TOKEN_THRESHOLD,
+)
+from resilience import ServiceUnavailable, remaining_ms, start_deadline
+from router import parse_routes
+from telemetry import add_latency, metrics, timed
 
+import itertools
+import json
 import os
+import time
+
+from typing import Annotated, Iterator, Literal, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # Imported when first used, they are off the path of a /chat turn.
+    from idempotency import IdempotencyStore
+    from jobs import JobQueue, JobStore
 
 app = APIGatewayRestResolver(enable_validation=True)
 tracer = Tracer()
@@ -24,8 +60,154 @@ logger = Logger()
 
 MODEL_ID = os.environ["BEDROCK_MODEL_ID"]
 DDB_TABLE_NAME = os.environ["DDB_TABLE_NAME"]
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 64))
+PERSISTENCE_MODE = os.environ.get("PERSISTENCE_MODE", PersistenceMode.BATCHED.value)
+# Overrides the per model input token budget used to trim long conversations.
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 0)) or None
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", DEFAULT_RESPONSE_CACHE_SIZE))
+RESPONSE_CACHE_TTL_SECONDS = int(
+    os.environ.get("RESPONSE_CACHE_TTL_SECONDS", DEFAULT_RESPONSE_CACHE_TTL_SECONDS)
+)
+RESPONSE_CACHE_TABLE_NAME = os.environ.get("RESPONSE_CACHE_TABLE_NAME")
+EXECUTION_MODE = os.environ.get("EXECUTION_MODE", ExecutionMode.CONCURRENT.value)
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", DEFAULT_BATCH_CONCURRENCY))
+# JSON list of routes that send some turns to other models, see router.py.
+MODEL_ROUTES = os.environ.get("MODEL_ROUTES")
+# Async jobs are only enabled when both are set.
+JOBS_TABLE_NAME = os.environ.get("JOBS_TABLE_NAME")
+JOB_QUEUE_URL = os.environ.get("JOB_QUEUE_URL")
+# Long server side sessions are folded into a rolling summary, see compaction.py.
+COMPACTION_MODE = os.environ.get("COMPACTION_MODE", CompactionMode.OFF.value)
+COMPACTION_MAX_TURNS = int(os.environ.get("COMPACTION_MAX_TURNS", DEFAULT_COMPACTION_MAX_TURNS))
+COMPACTION_TOKEN_THRESHOLD = int(
+    os.environ.get("COMPACTION_TOKEN_THRESHOLD", DEFAULT_COMPACTION_TOKEN_THRESHOLD)
+)
+COMPACTION_KEEP_TURNS = int(os.environ.get("COMPACTION_KEEP_TURNS", DEFAULT_COMPACTION_KEEP_TURNS))
+# Message content over this size is stored compressed, 0 to store it plainly.
+COMPRESSION_THRESHOLD_BYTES = int(
+    os.environ.get("COMPRESSION_THRESHOLD_BYTES", DEFAULT_COMPRESSION_THRESHOLD_BYTES)
+)
+# History items expire this long after they are written, 0 keeps them forever.
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", 0)) or None
+# Bucket expired and idle sessions are archived to, restored when resumed.
+ARCHIVE_BUCKET_NAME = os.environ.get("ARCHIVE_BUCKET_NAME")
+# Passages related to the prompt are added to the system prompts from the
+# document index packaged in the layer, when it has been built, see retrieval.py.
+RETRIEVAL_INDEX_PATH = os.environ.get("RETRIEVAL_INDEX_PATH")
+# Records /chat responses so retried requests don't call the model again.
+IDEMPOTENCY_TABLE_NAME = os.environ.get("IDEMPOTENCY_TABLE_NAME")
+IDEMPOTENCY_TTL_SECONDS = os.environ.get("IDEMPOTENCY_TTL_SECONDS")
+# Longest a Lambda invocation waits for background writes before returning.
+BACKGROUND_DRAIN_MS = int(os.environ.get("BACKGROUND_DRAIN_MS", 1000))
+
+_chatbot_client = None
+_job_queue: Optional["JobQueue"] = None
+_job_store: Optional["JobStore"] = None
+_idempotency_store: Optional["IdempotencyStore"] = None
+# Cleared after the first invocation so metrics can be split by cold and warm starts.
+_cold_start = True
+# Body of the /chat/stream response being resolved, left out of the response for
+# the caller to write out as it is generated, see resolve_stream_event().
+_stream_body: Optional[Iterator[str]] = None
+
+
+def get_chatbot_client() -> Chatbot:
+    """
+    Builds the chatbot on first use and reuses it across warm invocations, the
+    AWS clients it holds are also created lazily on first use.
+    """
+    global _chatbot_client
+    if _chatbot_client is None:
+        semantic_cache = None
+        if SEMANTIC_CACHE_ENABLED:
+            # Only import when enabled as the semantic cache depends on NumPy.
+            from semantic_cache import SemanticCache
+
+            semantic_cache = SemanticCache(
+                threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.9)),
+                max_size=int(os.environ.get("SEMANTIC_CACHE_SIZE", 1000)),
+                index_path=os.environ.get("SEMANTIC_CACHE_INDEX_PATH"),
+            )
+
+        retriever = None
+        if RETRIEVAL_INDEX_PATH and os.path.exists(f"{RETRIEVAL_INDEX_PATH}.npy"):
+            # Only import when there is an index as retrieval depends on NumPy.
+            from retrieval import Retriever
+
+            retriever = Retriever(
+                RETRIEVAL_INDEX_PATH,
+                k=int(os.environ.get("RETRIEVAL_TOP_K", 3)),
+                min_score=float(os.environ.get("RETRIEVAL_MIN_SCORE", 0.2)),
+            )
+
+        archive_store = None
+        if ARCHIVE_BUCKET_NAME:
+            from archive import S3ArchiveStore
+
+            archive_store = S3ArchiveStore(ARCHIVE_BUCKET_NAME)
+
+        _chatbot_client = Chatbot(
+            MODEL_ID,
+            DDB_TABLE_NAME,
+            session_cache_size=SESSION_CACHE_SIZE,
+            persistence_mode=PersistenceMode(PERSISTENCE_MODE),
+            context_token_budget=CONTEXT_TOKEN_BUDGET,
+            response_cache=ResponseCache(
+                RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_TABLE_NAME
+            ),
+            semantic_cache=semantic_cache,
+            execution_mode=ExecutionMode(EXECUTION_MODE),
+            model_routes=parse_routes(MODEL_ROUTES),
+            batch_concurrency=BATCH_CONCURRENCY,
+            compaction_mode=CompactionMode(COMPACTION_MODE),
+            compaction_max_turns=COMPACTION_MAX_TURNS,
+            compaction_token_threshold=COMPACTION_TOKEN_THRESHOLD,
+            compaction_keep_turns=COMPACTION_KEEP_TURNS,
+            compression_threshold_bytes=COMPRESSION_THRESHOLD_BYTES,
+            session_ttl_seconds=SESSION_TTL_SECONDS,
+            archive_store=archive_store,
+            retriever=retriever,
+            # Deferred compaction runs on the async worker, inline without a queue.
+            defer_compaction=defer_compaction if get_job_queue() is not None else None,
+        )
+    return _chatbot_client
+
+
+def defer_compaction(session_id: str):
+    from jobs import new_compaction_job
+
+    get_job_queue().send(new_compaction_job(session_id))
+
+
+def get_job_queue() -> "JobQueue":
+    global _job_queue
+    if _job_queue is None and JOB_QUEUE_URL:
+        from jobs import SQSJobQueue
+
+        _job_queue = SQSJobQueue(JOB_QUEUE_URL)
+    return _job_queue
+
+
+def get_job_store() -> "JobStore":
+    global _job_store
+    if _job_store is None and JOBS_TABLE_NAME:
+        from jobs import JobStore
+
+        _job_store = JobStore(JOBS_TABLE_NAME)
+    return _job_store
+
+
+def get_idempotency_store() -> "IdempotencyStore":
+    global _idempotency_store
+    if _idempotency_store is None and IDEMPOTENCY_TABLE_NAME:
+        from idempotency import DEFAULT_IDEMPOTENCY_TTL_SECONDS, IdempotencyStore
+
+        _idempotency_store = IdempotencyStore(
+            IDEMPOTENCY_TABLE_NAME, int(IDEMPOTENCY_TTL_SECONDS or DEFAULT_IDEMPOTENCY_TTL_SECONDS)
+        )
+    return _idempotency_store
 
-chatbot_client = Chatbot(MODEL_ID, DDB_TABLE_NAME)
 
 @app.exception_handler(RequestValidationError)
 def handle_validation_error(ex: RequestValidationError):
@@ -40,40 +222,378 @@ def handle_validation_error(ex: RequestValidationError):
     )
 
 
+@app.exception_handler(ServiceUnavailable)
+def handle_service_unavailable(ex: ServiceUnavailable):
+    # Throttled (429), shedding load (503), a duplicate in progress or a session
+    # other writers kept appending to (409), tell the client when to try again.
+    logger.warning(
+        "Request shed", path=app.current_event.path, status_code=ex.status_code, reason=str(ex)
+    )
+
+    return Response(
+        status_code=ex.status_code,
+        content_type=content_types.APPLICATION_JSON,
+        body=json.dumps({"message": str(ex)}),
+        headers={"Retry-After": ex.retry_after},
+    )
+
+
+SYSTEM_PROMPTS = [
+    {
+        "text": "You are a chatbot that responses to user prompts, if you don't know an answer say I'm sorry I don't know.  Ensure responses are accurate and not offensive"
+    }
+]
+
+
+def record_validation_latency():
+    # Time from the handler being invoked to the route running, mostly request validation.
+    start = app.context.get("request_start")
+    if start is not None:
+        add_latency("Validation", (time.perf_counter() - start) * 1000)
+
+
+def build_messages(event: Event) -> Messages:
+    record_validation_latency()
+    if event.messages is None:
+        # Client only sent the session id and prompt, rebuild the conversation server side.
+        with timed("HistoryLoad"):
+            messages = get_chatbot_client().get_history(event.session_id)
+    else:
+        messages = Messages.from_message_list(
+            session_id=event.session_id, messages=event.messages
+        )
+
+    content = ContentItem(text=event.prompt)
+    message = Message(role="user", content=[content])
+    messages.append(message)
+    return messages
+
+
+def submit_job(event: Event) -> Response:
+    """Queues the turn for the worker function and returns the job to poll."""
+    record_validation_latency()
+    queue, store = get_job_queue(), get_job_store()
+    if queue is None or store is None:
+        raise BadRequestError("Async requests are not enabled")
+
+    from jobs import JobStatus, JobTooLarge, check_payload_size, new_job
+
+    job = new_job(
+        SYSTEM_PROMPTS,
+        event.session_id,
+        event.prompt,
+        messages=None if event.messages is None else [message.to_record() for message in event.messages],
+        use_cache=event.use_cache,
+    )
+    try:
+        check_payload_size(job)
+    except JobTooLarge as e:
+        raise BadRequestError(str(e))
+    store.put(job)
+    try:
+        queue.send(job)
+    except Exception as e:
+        # Otherwise the job stays pending but never runs.
+        store.update(job["job_id"], JobStatus.FAILED, error={"error": type(e).__name__, "message": "Could not queue the job"})
+        raise
+    logger.info("Queued job", job_id=job["job_id"], session_id=event.session_id)
+
+    return Response(
+        status_code=202,
+        content_type=content_types.APPLICATION_JSON,
+        body=json.dumps({"job_id": job["job_id"], "session_id": event.session_id, "status": "pending"}),
+        headers={"Location": f"/jobs/{job['job_id']}"},
+    )
+
+
+def converse_turn(event: Event, messages: Messages) -> str:
+    with timed("Turn"):
+        messages = get_chatbot_client().converse(
+            SYSTEM_PROMPTS, messages, use_cache=event.use_cache
+        )
+    if event.messages is None:
+        get_chatbot_client().maybe_compact(messages)
+    return messages.to_json()
+
+
+def idempotent_turn(event: Event) -> str:
+    """
+    Runs the turn at most once per idempotency key, the Idempotency-Key header
+    when the client sends one, otherwise the session, the sequence the prompt
+    takes and the request.  Without a header only the retries of a client side
+    history turn, or duplicates sent while the turn is running, are caught, as
+    a server side history retry after the turn completed takes the next sequence.
+    """
+    store = get_idempotency_store()
+    if store is None:
+        return converse_turn(event, build_messages(event))
+    from idempotency import IdempotencyKeyReused, request_fingerprint
+
+    # Only what the client sent, not a generated session id.
+    fingerprint = request_fingerprint(event.model_dump(mode="json", by_alias=True, exclude_unset=True))
+    client_key = app.current_event.headers.get("Idempotency-Key")
+    try:
+        if client_key:
+            # Checked before loading history, which a completed turn has changed.
+            return store.run(
+                f"key#{client_key}", fingerprint, lambda: converse_turn(event, build_messages(event))
+            )
+        messages = build_messages(event)
+        sequence = messages.offset + len(messages.messages)
+        return store.run(
+            f"{event.session_id}#{sequence}#{fingerprint}", fingerprint, lambda: converse_turn(event, messages)
+        )
+    except IdempotencyKeyReused as e:
+        raise BadRequestError(str(e))
+
+
 @app.post("/chat")
 @tracer.capture_method
 def chat(event: Event):
-    system_prompts = [
-        {
-            "text": "You are a chatbot that responses to user prompts, if you don't know an answer say I'm sorry I don't know.  Ensure responses are accurate and not offensive"
-        }
-    ]
+    if event.async_:
+        return submit_job(event)
 
     try:
-        messages = Messages.from_message_list(
-            session_id=event.session_id, messages=event.messages
-        )
+        body = idempotent_turn(event)
+
+    except ClientError as err:
+        message = err.response["Error"]["Message"]
+        logger.error("A client error occurred: %s", message)
+        logger.debug("Turn failed", exc_info=True)
+        raise
+    except Exception as err:
+        logger.error("An error occurred: %s", err)
+        logger.debug("Turn failed", exc_info=True)
+        raise
 
-        content = ContentItem(text=event.prompt)
-        message = Message(role="user", content=[content])
-        messages.append(message)
+    return Response(
+        status_code=200,
+        content_type=content_types.APPLICATION_JSON,
+        body=body,
+    )
 
-        messages = chatbot_client.converse(system_prompts, messages)
+
+def stream_chat(event: Event):
+    """
+    Generates the chat response as newline delimited JSON, one {"delta": ...}
+    line per chunk of text from the model followed by a final line holding the
+    full conversation.
+    """
+    messages = build_messages(event)
+    stream = get_chatbot_client().converse_stream(
+        SYSTEM_PROMPTS, messages, use_cache=event.use_cache
+    )
+    while True:
+        try:
+            delta = next(stream)
+        except StopIteration as stop:
+            messages = stop.value
+            break
+        yield json.dumps({"delta": delta}) + "\n"
+    yield messages.to_json() + "\n"
+    if event.messages is None:
+        get_chatbot_client().maybe_compact(messages)
+
+
+@app.post("/chat/stream")
+@tracer.capture_method
+def chat_stream(event: Event):
+    global _stream_body
+    try:
+        chunks = stream_chat(event)
+        # Waits for the model's first chunk, so failures before it still get their status code.
+        first = next(chunks)
+        if app.context.get("stream"):
+            _stream_body = itertools.chain([first], chunks)
+            body = ""
+        else:
+            # API Gateway REST proxy integrations buffer the Lambda response, the
+            # chunks are still framed so callers that can read them incrementally do.
+            body = first + "".join(chunks)
 
     except ClientError as err:
         message = err.response["Error"]["Message"]
         logger.error("A client error occurred: %s", message)
-        print(f"A client error occurred: {message}")
+        logger.debug("Turn failed", exc_info=True)
         raise
     except Exception as err:
         logger.error("An error occurred: %s", err)
-        print(f"An error occurred: {err}")
+        logger.debug("Turn failed", exc_info=True)
         raise
 
-    return messages
+    return Response(
+        status_code=200,
+        content_type="application/x-ndjson",
+        body=body,
+    )
+
+
+@app.get("/jobs/<job_id>")
+@tracer.capture_method
+def get_job(job_id: str):
+    store = get_job_store()
+    job = store.get(job_id) if store is not None else None
+    if job is None:
+        raise NotFoundError(f"Job {job_id} not found")
+
+    return Response(
+        status_code=200,
+        content_type=content_types.APPLICATION_JSON,
+        body=json.dumps(job),
+    )
+
+
+@app.get("/sessions/<session_id>/messages")
+@tracer.capture_method
+def get_session_messages(
+    session_id: str,
+    limit: Annotated[int, Query(gt=0, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+    cursor: Annotated[Optional[str], Query()] = None,
+    order: Annotated[Literal["asc", "desc"], Query()] = "asc",
+    fields: Annotated[Optional[str], Query()] = None,
+    consistent: Annotated[bool, Query()] = False,
+):
+    """
+    Pages through a session's stored history, pass the returned cursor to get
+    the next page.  fields is a comma separated projection, for example
+    role,sequence,preview for a listing view.
+    """
+    field_list = None
+    if fields is not None:
+        field_list = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown = set(field_list) - set(MESSAGE_FIELDS)
+        if not field_list or unknown:
+            raise BadRequestError(f"fields must be some of {', '.join(MESSAGE_FIELDS)}")
+
+    try:
+        messages, next_cursor = get_chatbot_client().ddb.query_messages(
+            session_id,
+            limit=limit,
+            cursor=cursor,
+            ascending=order == "asc",
+            fields=field_list,
+            consistent_read=consistent,
+        )
+    except ValueError as err:
+        raise BadRequestError(str(err))
+
+    return Response(
+        status_code=200,
+        content_type=content_types.APPLICATION_JSON,
+        body=json.dumps({"session_id": session_id, "messages": messages, "cursor": next_cursor}),
+    )
+
+
+def batch_error(error: Exception) -> dict:
+    if isinstance(error, ServiceUnavailable):
+        return {"status_code": error.status_code, "error": type(error).__name__, "message": str(error)}
+    if isinstance(error, ClientError):
+        return {
+            "status_code": 502,
+            "error": error.response["Error"]["Code"],
+            "message": error.response["Error"]["Message"],
+        }
+    return {"status_code": 500, "error": type(error).__name__, "message": "Internal error"}
+
+
+@app.post("/chat/batch")
+@tracer.capture_method
+def chat_batch(event: BatchEvent):
+    """
+    Runs independent prompts / sessions in one invocation, returning a result
+    per item in the order they were sent, each either the conversation or an
+    error with the status code the item would have had on /chat.
+    """
+    record_validation_latency()
+    turns = [
+        Turn(
+            item.session_id,
+            Message(role="user", content=[ContentItem(text=item.prompt)]),
+            history=item.messages,
+            use_cache=item.use_cache,
+        )
+        for item in event.items
+    ]
+    with timed("Batch"):
+        results = get_chatbot_client().converse_batch(SYSTEM_PROMPTS, turns)
+
+    body = []
+    for turn, result in zip(turns, results):
+        if isinstance(result, Messages):
+            body.append(dict(result.to_record(), status_code=200))
+        else:
+            logger.error("Batch item failed", session_id=turn.session_id, error=str(result))
+            body.append(dict(batch_error(result), session_id=turn.session_id))
+
+    return Response(
+        status_code=200,
+        content_type=content_types.APPLICATION_JSON,
+        body=json.dumps({"results": body}),
+    )
+
+
+def resolve_event(
+    event: dict, context: Optional[LambdaContext], remaining_ms: Optional[int], stream: bool = False
+) -> dict:
+    """
+    Runs an API Gateway REST proxy event through the routes, shared by the Lambda
+    handler and the standalone server in server.py.
+
+    Args:
+        event: The API Gateway REST proxy event.
+        context: The Lambda context, None outside Lambda.
+        remaining_ms: Time the request has left, bounds Bedrock retries.
+        stream: Leave a /chat/stream body out of the response, see resolve_stream_event().
+
+    Returns:
+        The API Gateway REST proxy response.
+    """
+    global _cold_start
+    metrics.add_dimension(name="ModelId", value=MODEL_ID)
+    metrics.add_dimension(name="Start", value="cold" if _cold_start else "warm")
+    _cold_start = False
+    start_deadline(remaining_ms)
+    app.append_context(request_start=time.perf_counter(), stream=stream)
+    return app.resolve(event, context)
+
+
+def drain_background_writes():
+    """
+    Waits, for at most BACKGROUND_DRAIN_MS and the time the invocation has left,
+    for shared cache and history writes still running in the background.  The
+    Lambda container can be frozen once the handler returns, stalling them.
+    """
+    if _chatbot_client is None:
+        return
+    timeout_ms = BACKGROUND_DRAIN_MS
+    left = remaining_ms()
+    if left is not None:
+        timeout_ms = min(timeout_ms, left)
+    _chatbot_client.drain(timeout_ms / 1000)
+
+
+def resolve_stream_event(event: dict, remaining_ms: Optional[int]) -> Tuple[dict, Optional[Iterator[str]]]:
+    """
+    Runs an event through the routes like resolve_event(), but a successful
+    /chat/stream body is returned as an iterator of chunks the caller writes out
+    as the model generates them, rather than joined into the response.
+
+    Returns:
+        The response, with an empty body when streamed, and the chunks or None.
+    """
+    global _stream_body
+    _stream_body = None
+    try:
+        return resolve_event(event, None, remaining_ms, stream=True), _stream_body
+    finally:
+        _stream_body = None
 
 
 @logger.inject_lambda_context(correlation_id_path=correlation_paths.API_GATEWAY_REST)
 @tracer.capture_lambda_handler
+@metrics.log_metrics(capture_cold_start_metric=True)
 def lambda_handler(event: dict, context: LambdaContext) -> dict:
-    return app.resolve(event, context)
+    try:
+        return resolve_event(event, context, context.get_remaining_time_in_millis())
+    finally:
+        drain_background_writes()
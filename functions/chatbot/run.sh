@@ -0,0 +1,4 @@
+#!/bin/sh
+# Started by the Lambda Web Adapter in ChatbotStreamFunction, which forwards the
+# Function URL's requests to the server and streams its responses back.
+PYTHONPATH=$PYTHONPATH:/opt/python:$LAMBDA_TASK_ROOT exec python server.py
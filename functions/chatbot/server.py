@@ -0,0 +1,290 @@
+"""
+Standalone HTTP server for the chatbot API, for running the same routes on a
+container fleet instead of Lambda, e.g.
+
+    PYTHONPATH=layers/chatbot python functions/chatbot/server.py
+
+Powertools keeps the current event on the router class, so one process can only
+resolve one request at a time.  The server pre-forks SERVER_WORKERS processes
+that accept from a shared listening socket, each handling one request at a time
+like a Lambda container, with its own Chatbot, session cache and pooled AWS
+clients.  Whichever worker accepts a connection serves it, so with N workers the
+session and local response cache hit rates drop by about N, see the README.  SIGTERM or SIGINT stops accepting new requests, lets in flight ones
+and background writes finish, and exits.
+
+/chat/stream responses are written out line by line as the model generates them,
+so callers get the first tokens straight away.  Run behind a Lambda Function URL
+with the Lambda Web Adapter, see ChatbotStreamFunction in template.yaml, this is
+also how the API streams on Lambda.
+"""
+import base64
+import json
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from email.message import Message
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, Iterator, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+from uuid import uuid4
+
+from aws_lambda_powertools import Logger
+
+import app
+import aws_clients
+from telemetry import metrics
+
+logger = Logger()
+
+DEFAULT_PORT = 8080
+# Requests spend most of their time waiting on Bedrock, so more workers than CPUs.
+DEFAULT_WORKERS = 2 * (os.cpu_count() or 1) + 1
+# Matches the Lambda function timeout, Bedrock retries stop in time to respond.
+DEFAULT_REQUEST_TIMEOUT_SECONDS = 30
+DEFAULT_SHUTDOWN_GRACE_SECONDS = 30
+
+
+def to_event(method: str, target: str, headers: Message, body: Optional[str], source_ip: str) -> Dict:
+    """Builds the API Gateway REST proxy event API Gateway would have sent for the request."""
+    url = urlsplit(target)
+    query = parse_qs(url.query, keep_blank_values=True)
+    request_id = str(uuid4())
+    return {
+        "body": body,
+        "resource": url.path,
+        "path": url.path,
+        "httpMethod": method,
+        "headers": dict(headers.items()),
+        "multiValueHeaders": {name: headers.get_all(name) for name in set(headers.keys())},
+        "queryStringParameters": {name: values[-1] for name, values in query.items()} or None,
+        "multiValueQueryStringParameters": query or None,
+        "pathParameters": None,
+        "stageVariables": None,
+        "isBase64Encoded": False,
+        "requestContext": {
+            "resourcePath": url.path,
+            "httpMethod": method,
+            "path": url.path,
+            "stage": "server",
+            "requestId": request_id,
+            "requestTimeEpoch": int(time.time() * 1000),
+            "identity": {"sourceIp": source_ip},
+        },
+    }
+
+
+def handle_event(event: Dict, timeout_ms: int) -> Tuple[Dict, Optional[Iterator[str]]]:
+    """
+    Resolves the event, with the failures API Gateway would turn into a 502.
+    A streamed body is returned separately, to be written out as it is generated.
+    """
+    logger.set_correlation_id(event["requestContext"]["requestId"])
+    try:
+        return app.resolve_stream_event(event, timeout_ms)
+    except Exception as e:
+        logger.exception(f"Unhandled error: {e}")
+        return {
+            "statusCode": 502,
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps({"message": "Internal server error"}),
+            "isBase64Encoded": False,
+        }, None
+
+
+class ChatbotRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.0 closes the connection after each response, so an idle keep-alive
+    # client can't hold on to a worker that only serves one request at a time.
+    protocol_version = "HTTP/1.0"
+    server_version = "serverless-chatbot"
+    # The headers and body are separate writes, without this the body waits on
+    # the client's delayed ACK of the headers.
+    disable_nagle_algorithm = True
+
+    def handle_api(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length).decode("utf-8") if length else None
+        event = to_event(self.command, self.path, self.headers, body, self.client_address[0])
+        try:
+            response, chunks = handle_event(event, self.server.request_timeout_ms)
+            self.send_response(response["statusCode"])
+            headers = {name: [value] for name, value in (response.get("headers") or {}).items()}
+            headers.update(response.get("multiValueHeaders") or {})
+            for name, values in headers.items():
+                if name.lower() != "content-length":
+                    for value in values:
+                        self.send_header(name, value)
+            if chunks is not None:
+                self.write_stream(chunks)
+                return
+
+            payload = response.get("body") or ""
+            data = base64.b64decode(payload) if response.get("isBase64Encoded") else payload.encode("utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        finally:
+            # Under the Lambda Web Adapter the container can be frozen once the response is sent.
+            app.drain_background_writes()
+            # After a streamed body, which adds the token usage metrics as it finishes.
+            metrics.flush_metrics()
+
+    def write_stream(self, chunks: Iterator[str]):
+        """
+        Writes each chunk as soon as it is generated.  Without a Content-Length the
+        body ends when the connection closes, so a stream that fails part way ends
+        without its final line, the full conversation.
+        """
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                self.wfile.write(chunk.encode("utf-8"))
+                self.wfile.flush()
+        except Exception as e:
+            logger.exception(f"Stream failed after it started: {e}")
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_OPTIONS = handle_api
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class WorkerHTTPServer(HTTPServer):
+    """HTTPServer whose listening socket is shared by forked worker processes."""
+
+    def __init__(self, server_address: Tuple[str, int], request_timeout_seconds: float):
+        super().__init__(server_address, ChatbotRequestHandler)
+        self.request_timeout_ms = int(request_timeout_seconds * 1000)
+
+    def server_activate(self):
+        super().server_activate()
+        # Every worker is woken for a new connection but only one accepts it, the
+        # others get BlockingIOError and go back to waiting rather than blocking.
+        self.socket.setblocking(False)
+
+    def get_request(self) -> Tuple[socket.socket, Tuple]:
+        request, client_address = self.socket.accept()
+        request.setblocking(True)
+        return request, client_address
+
+
+def init_worker():
+    """Drops clients and thread pools a worker inherited from the parent, they aren't safe to share."""
+    aws_clients.reset()
+    app._chatbot_client = None
+    app._job_queue = None
+    app._job_store = None
+    app._idempotency_store = None
+
+
+def run_worker(http_server: WorkerHTTPServer):
+    init_worker()
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so can't be called from its thread.
+        threading.Thread(target=http_server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    # Ctrl+C reaches the whole process group, the parent stops the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    http_server.serve_forever()
+    if app._chatbot_client is not None:
+        app._chatbot_client.close()
+
+
+class ChatbotServer:
+    def __init__(
+        self,
+        host: str = "0.0.0.0",
+        port: int = DEFAULT_PORT,
+        workers: int = DEFAULT_WORKERS,
+        request_timeout_seconds: float = DEFAULT_REQUEST_TIMEOUT_SECONDS,
+    ):
+        self.http_server = WorkerHTTPServer((host, port), request_timeout_seconds)
+        self.workers = workers
+        self._pids: Set[int] = set()
+
+    @property
+    def server_address(self) -> Tuple[str, int]:
+        return self.http_server.server_address[:2]
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.http_server)
+            except BaseException as e:
+                logger.exception(f"Worker failed: {e}")
+                code = 1
+            finally:
+                # Skip the parent's atexit handlers, after writing out our own output.
+                sys.stdout.flush()
+                os._exit(code)
+        self._pids.add(pid)
+
+    def _reap(self) -> int:
+        """Collects exited workers without blocking, returns how many exited."""
+        exited = 0
+        for pid in list(self._pids):
+            done, _ = os.waitpid(pid, os.WNOHANG)
+            if done:
+                self._pids.discard(pid)
+                exited += 1
+        return exited
+
+    def start(self):
+        """Forks the workers, which start serving immediately."""
+        for _ in range(self.workers):
+            self._spawn()
+        logger.info(f"Serving on {self.server_address} with {self.workers} workers")
+
+    def stop(self, grace_seconds: float = DEFAULT_SHUTDOWN_GRACE_SECONDS):
+        """
+        Stops the workers gracefully, any still running after grace_seconds are killed.
+
+        Args:
+            grace_seconds: How long in flight requests have to finish.
+        """
+        for pid in self._pids:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + grace_seconds
+        while self._pids and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.05)
+        for pid in self._pids:
+            logger.warning(f"Worker {pid} did not stop in {grace_seconds}s, killing it")
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self._pids.clear()
+        self.http_server.server_close()
+
+    def serve_forever(self, grace_seconds: float = DEFAULT_SHUTDOWN_GRACE_SECONDS):
+        """Serves until SIGTERM or SIGINT, replacing any worker that exits unexpectedly."""
+        stopping = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: stopping.set())
+        self.start()
+        while not stopping.wait(1):
+            for _ in range(self._reap()):
+                logger.warning("Worker exited, starting a replacement")
+                self._spawn()
+        logger.info("Shutting down")
+        self.stop(grace_seconds)
+
+
+def main():
+    ChatbotServer(
+        host=os.environ.get("SERVER_HOST", "0.0.0.0"),
+        port=int(os.environ.get("SERVER_PORT", DEFAULT_PORT)),
+        workers=int(os.environ.get("SERVER_WORKERS", DEFAULT_WORKERS)),
+        request_timeout_seconds=float(
+            os.environ.get("SERVER_REQUEST_TIMEOUT_SECONDS", DEFAULT_REQUEST_TIMEOUT_SECONDS)
+        ),
+    ).serve_forever(float(os.environ.get("SERVER_SHUTDOWN_GRACE_SECONDS", DEFAULT_SHUTDOWN_GRACE_SECONDS)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+from aws_lambda_powertools.utilities.batch import (
+    BatchProcessor,
+    EventType,
+    process_partial_response,
+)
+from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from aws_lambda_powertools import Logger, Tracer
+
+from archive import S3ArchiveStore
+from chatbot_client import Chatbot, PersistenceMode
+from codec import DEFAULT_COMPRESSION_THRESHOLD_BYTES
+from compaction import (
+    CompactionMode,
+    DEFAULT_COMPACTION_KEEP_TURNS,
+    DEFAULT_COMPACTION_MAX_TURNS,
+    DEFAULT_COMPACTION_TOKEN_THRESHOLD,
+)
+from jobs import JobStore, JobWorker
+from resilience import start_deadline
+from router import parse_routes
+from telemetry import metrics
+
+import json
+import os
+
+processor = BatchProcessor(event_type=EventType.SQS)
+tracer = Tracer()
+logger = Logger()
+
+MODEL_ID = os.environ["BEDROCK_MODEL_ID"]
+DDB_TABLE_NAME = os.environ["DDB_TABLE_NAME"]
+JOBS_TABLE_NAME = os.environ["JOBS_TABLE_NAME"]
+PERSISTENCE_MODE = os.environ.get("PERSISTENCE_MODE", PersistenceMode.BATCHED.value)
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 0)) or None
+MODEL_ROUTES = os.environ.get("MODEL_ROUTES")
+COMPACTION_MODE = os.environ.get("COMPACTION_MODE", CompactionMode.OFF.value)
+COMPACTION_MAX_TURNS = int(os.environ.get("COMPACTION_MAX_TURNS", DEFAULT_COMPACTION_MAX_TURNS))
+COMPACTION_TOKEN_THRESHOLD = int(
+    os.environ.get("COMPACTION_TOKEN_THRESHOLD", DEFAULT_COMPACTION_TOKEN_THRESHOLD)
+)
+COMPACTION_KEEP_TURNS = int(os.environ.get("COMPACTION_KEEP_TURNS", DEFAULT_COMPACTION_KEEP_TURNS))
+# Message content over this size is stored compressed, 0 to store it plainly.
+COMPRESSION_THRESHOLD_BYTES = int(
+    os.environ.get("COMPRESSION_THRESHOLD_BYTES", DEFAULT_COMPRESSION_THRESHOLD_BYTES)
+)
+# History items expire this long after they are written, 0 keeps them forever.
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", 0)) or None
+# Bucket expired and idle sessions are archived to, restored when resumed.
+ARCHIVE_BUCKET_NAME = os.environ.get("ARCHIVE_BUCKET_NAME")
+# Passages related to the prompt are added to the system prompts from the
+# document index packaged in the layer, when it has been built, see retrieval.py.
+RETRIEVAL_INDEX_PATH = os.environ.get("RETRIEVAL_INDEX_PATH")
+
+_job_worker = None
+
+
+def get_job_worker() -> JobWorker:
+    global _job_worker
+    if _job_worker is None:
+        retriever = None
+        if RETRIEVAL_INDEX_PATH and os.path.exists(f"{RETRIEVAL_INDEX_PATH}.npy"):
+            # Only import when there is an index as retrieval depends on NumPy.
+            from retrieval import Retriever
+
+            retriever = Retriever(
+                RETRIEVAL_INDEX_PATH,
+                k=int(os.environ.get("RETRIEVAL_TOP_K", 3)),
+                min_score=float(os.environ.get("RETRIEVAL_MIN_SCORE", 0.2)),
+            )
+        chatbot = Chatbot(
+            MODEL_ID,
+            DDB_TABLE_NAME,
+            persistence_mode=PersistenceMode(PERSISTENCE_MODE),
+            context_token_budget=CONTEXT_TOKEN_BUDGET,
+            model_routes=parse_routes(MODEL_ROUTES),
+            # The worker is the deferred pass, so it always compacts inline.
+            compaction_mode=(
+                CompactionMode.OFF
+                if CompactionMode(COMPACTION_MODE) == CompactionMode.OFF
+                else CompactionMode.INLINE
+            ),
+            compaction_max_turns=COMPACTION_MAX_TURNS,
+            compaction_token_threshold=COMPACTION_TOKEN_THRESHOLD,
+            compaction_keep_turns=COMPACTION_KEEP_TURNS,
+            compression_threshold_bytes=COMPRESSION_THRESHOLD_BYTES,
+            session_ttl_seconds=SESSION_TTL_SECONDS,
+            archive_store=S3ArchiveStore(ARCHIVE_BUCKET_NAME) if ARCHIVE_BUCKET_NAME else None,
+            retriever=retriever,
+        )
+        _job_worker = JobWorker(chatbot, JobStore(JOBS_TABLE_NAME))
+    return _job_worker
+
+
+@tracer.capture_method
+def record_handler(record: SQSRecord):
+    get_job_worker().process(json.loads(record.body))
+
+
+@logger.inject_lambda_context
+@tracer.capture_lambda_handler
+@metrics.log_metrics
+def lambda_handler(event: dict, context: LambdaContext) -> dict:
+    # Throttled jobs are reported as batch item failures and redelivered by SQS.
+    metrics.add_dimension(name="ModelId", value=MODEL_ID)
+    start_deadline(context.get_remaining_time_in_millis())
+    return process_partial_response(
+        event=event, record_handler=record_handler, processor=processor, context=context
+    )
@@ -0,0 +1,221 @@
+import base64
+import gzip
+import json
+import os
+from decimal import Decimal
+from typing import Dict, Iterable, List, Protocol
+from uuid import uuid4
+
+from aws_lambda_powertools import Logger
+from botocore.exceptions import ClientError, BotoCoreError
+
+import aws_clients
+from codec import decode_content
+from dynamodb import DEFAULT_SCAN_RESERVE_MS, DynamoDB, SUMMARY_SEQUENCE
+from resilience import deadline_allows
+from telemetry import add_count, timed
+
+logger = Logger()
+
+# Attributes that only mean something in the hot table.
+TABLE_ONLY_ATTRIBUTES = ("session_id", "expires_at", "format_version")
+
+
+class ArchiveStore(Protocol):
+    def put(self, key: str, data: bytes): ...
+
+    def get(self, key: str) -> bytes: ...
+
+    def list(self, prefix: str) -> List[str]: ...
+
+
+class S3ArchiveStore:
+    def __init__(self, bucket_name: str, prefix: str = "sessions/"):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self._s3_client = None
+
+    @property
+    def s3_client(self):
+        if self._s3_client is None:
+            try:
+                self._s3_client = aws_clients.client("s3")
+            except Exception as e:
+                logger.error(f"Error initializing S3 client: {e}")
+                raise
+        return self._s3_client
+
+    def put(self, key: str, data: bytes):
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=self.prefix + key,
+                Body=data,
+                ContentType="application/x-ndjson",
+                ContentEncoding="gzip",
+            )
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+
+    def get(self, key: str) -> bytes:
+        try:
+            return self.s3_client.get_object(Bucket=self.bucket_name, Key=self.prefix + key)["Body"].read()
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+
+    def list(self, prefix: str) -> List[str]:
+        keys = []
+        try:
+            for page in self.s3_client.get_paginator("list_objects_v2").paginate(
+                Bucket=self.bucket_name, Prefix=self.prefix + prefix
+            ):
+                keys.extend(item["Key"][len(self.prefix) :] for item in page.get("Contents", []))
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+        return keys
+
+
+class LocalArchiveStore:
+    """Stand in for S3 that keeps the archive under a local directory."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def put(self, key: str, data: bytes):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(data)
+
+    def get(self, key: str) -> bytes:
+        with open(os.path.join(self.directory, key), "rb") as file:
+            return file.read()
+
+    def list(self, prefix: str) -> List[str]:
+        directory = os.path.join(self.directory, os.path.dirname(prefix))
+        if not os.path.isdir(directory):
+            return []
+        keys = [os.path.join(os.path.dirname(prefix), name) for name in os.listdir(directory)]
+        return sorted(key for key in keys if key.startswith(prefix))
+
+
+def archive_record(item: Dict) -> Dict:
+    """
+    Turns a table item, or the old image of a stream record, into the JSON
+    record kept in the archive, content always plain.
+    """
+    if isinstance(item.get("content_z"), str):
+        # Stream images keep binary attributes as the base64 text of the record's JSON.
+        item = dict(item, content_z=base64.b64decode(item["content_z"]))
+    return {
+        key: int(value) if isinstance(value, Decimal) else value
+        for key, value in decode_content(item).items()
+        if key not in TABLE_ONLY_ATTRIBUTES
+    }
+
+
+class Archiver:
+    """
+    Moves sessions out of the history table to a cheaper archive as gzipped
+    JSONL, one object per export under the session id, and leaves a marker item
+    so reading the session restores them to the table first.  Items are
+    archived when DynamoDB TTL expires them, or for a whole session once it has
+    been idle for a while.
+    """
+
+    def __init__(self, store: ArchiveStore, ddb: DynamoDB):
+        self.store = store
+        self.ddb = ddb
+
+    def _export(self, session_id: str, records: List[Dict]):
+        sequences = [record["sequence"] for record in records]
+        body = "".join(json.dumps(record) + "\n" for record in sorted(records, key=lambda r: r["sequence"]))
+        key = f"{session_id}/{min(sequences):010d}-{max(sequences):010d}-{uuid4().hex[:8]}.jsonl.gz"
+        with timed("ArchiveWrite"):
+            self.store.put(key, gzip.compress(body.encode("utf-8")))
+        self.ddb.mark_archived(session_id, max(sequences))
+        add_count("ArchivedItems", len(records))
+
+    def archive_expired(self, items: Iterable[Dict]):
+        """Archives items DynamoDB TTL has removed, the old images from the table's stream."""
+        sessions: Dict[str, List[Dict]] = {}
+        for item in items:
+            sessions.setdefault(item["session_id"], []).append(archive_record(item))
+        for session_id, records in sessions.items():
+            self._export(session_id, records)
+
+    def archive_session(self, session_id: str):
+        """Archives every item of a session and removes them from the table."""
+        items = self.ddb.get_items(session_id)
+        if not items:
+            return
+        self._export(session_id, [archive_record(item) for item in items])
+        self.ddb.delete_items(session_id, [int(item["sequence"]) for item in items])
+        logger.info(f"Archived {len(items)} items of idle session {session_id}")
+
+    def archive_idle(self, idle_seconds: int, reserve_ms: float = DEFAULT_SCAN_RESERVE_MS) -> int:
+        """
+        Archives the sessions with no writes in idle_seconds, returns how many
+        were archived.  Stops near the invocation deadline, the next call carries
+        on from where the scan stopped.
+        """
+        count = 0
+        for session_id in self.ddb.idle_sessions(idle_seconds, reserve_ms=reserve_ms):
+            if not deadline_allows(reserve_ms):
+                logger.info("Stopping near the deadline, the next run carries on archiving idle sessions")
+                break
+            self.archive_session(session_id)
+            count += 1
+        return count
+
+    def load(self, session_id: str) -> Dict[int, Dict]:
+        """Reads a session's archived records keyed by sequence, the latest summary wins."""
+        records: Dict[int, Dict] = {}
+        for key in self.store.list(f"{session_id}/"):
+            for line in gzip.decompress(self.store.get(key)).decode("utf-8").splitlines():
+                record = json.loads(line)
+                existing = records.get(record["sequence"])
+                if (
+                    record["sequence"] == SUMMARY_SEQUENCE
+                    and existing is not None
+                    and existing["covers_through"] >= record["covers_through"]
+                ):
+                    continue
+                records[record["sequence"]] = record
+        return records
+
+    def rehydrate(self, session_id: str):
+        """
+        Restores the archived items a resumed session needs, the summary and the
+        messages after it, then clears the marker.
+        """
+        state = self.ddb.get_session_state(session_id)
+        if "archived_through" not in state:
+            return
+        with timed("ArchiveRehydrate"):
+            records = self.load(session_id)
+        covers_through = state.get("covers_through", 0)
+        restore = []
+        summary = records.get(SUMMARY_SEQUENCE)
+        if summary is not None and summary["covers_through"] > covers_through:
+            restore.append(summary)
+            covers_through = summary["covers_through"]
+        restore.extend(
+            record for sequence, record in sorted(records.items()) if sequence > covers_through
+        )
+        self.ddb.put_items(session_id, restore)
+        self.ddb.clear_archived(session_id, state["archived_through"])
+        add_count("SessionRehydrated")
+        logger.info(f"Restored {len(restore)} archived items of session {session_id}")
@@ -0,0 +1,119 @@
+import os
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+import boto3
+
+from botocore.config import Config
+
+# Enough connections for the batch fan-out plus the background writer to share
+# a client without urllib3 opening, and then discarding, extra connections.
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 2
+DEFAULT_READ_TIMEOUT_SECONDS = 10
+
+# (connect, read) timeouts in seconds.  DynamoDB and SQS answer in milliseconds
+# so a stalled connection is better retried than waited on, a model call waits
+# for the whole generation and is sized to the function timeout through
+# BEDROCK_READ_TIMEOUT_SECONDS.
+SERVICE_TIMEOUTS = {
+    "bedrock-runtime": (DEFAULT_CONNECT_TIMEOUT_SECONDS, 25),
+    "dynamodb": (1, 5),
+    "sqs": (1, 5),
+    "s3": (DEFAULT_CONNECT_TIMEOUT_SECONDS, 30),
+}
+
+_session: Optional[boto3.session.Session] = None
+_clients: Dict[Tuple[str, int], object] = {}
+_endpoint_urls: Dict[str, str] = {}
+_lock = Lock()
+
+
+def _env_name(service_name: str) -> str:
+    return service_name.split("-")[0].upper()
+
+
+def client_config(service_name: str) -> Config:
+    """
+    The tuned config every client is created with, a pool sized for concurrent
+    calls, TCP keep-alive so warm containers reuse their connections, and
+    explicit per service timeouts.
+
+    Args:
+        service_name: The boto3 service name.
+
+    Returns:
+        The botocore Config for the service.
+    """
+    connect_timeout, read_timeout = SERVICE_TIMEOUTS.get(
+        service_name, (DEFAULT_CONNECT_TIMEOUT_SECONDS, DEFAULT_READ_TIMEOUT_SECONDS)
+    )
+    env_name = _env_name(service_name)
+    return Config(
+        max_pool_connections=int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", DEFAULT_MAX_POOL_CONNECTIONS)),
+        tcp_keepalive=True,
+        connect_timeout=float(os.environ.get(f"{env_name}_CONNECT_TIMEOUT_SECONDS", connect_timeout)),
+        read_timeout=float(os.environ.get(f"{env_name}_READ_TIMEOUT_SECONDS", read_timeout)),
+    )
+
+
+def get_session() -> boto3.session.Session:
+    """The botocore session shared by every client, so credentials and service models are loaded once."""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session()
+        return _session
+
+
+def client(service_name: str, config: Optional[Config] = None):
+    """
+    Returns the shared client for a service, created on first use.  Clients are
+    thread safe so one per container is reused by every caller.
+
+    Args:
+        service_name: The boto3 service name.
+        config: Settings merged over the tuned config, for example retries.
+            Callers pass the same module level object so they share a client.
+
+    Returns:
+        The low level boto3 client.
+    """
+    key = (service_name, id(config))
+    existing = _clients.get(key)
+    if existing is not None:
+        return existing
+    session = get_session()
+    with _lock:
+        if key not in _clients:
+            merged = client_config(service_name)
+            if config is not None:
+                merged = merged.merge(config)
+            _clients[key] = session.client(
+                service_name, config=merged, endpoint_url=_endpoint_urls.get(service_name)
+            )
+        return _clients[key]
+
+
+def set_endpoint_url(service_name: str, endpoint_url: Optional[str]):
+    """
+    Points a service at another endpoint, such as DynamoDB Local or a stub
+    server, for clients created from now on.  AWS_ENDPOINT_URL_<SERVICE> works
+    too, this is for overriding it from code.
+    """
+    with _lock:
+        if endpoint_url is None:
+            _endpoint_urls.pop(service_name, None)
+        else:
+            _endpoint_urls[service_name] = endpoint_url
+        for key in [key for key in _clients if key[0] == service_name]:
+            del _clients[key]
+
+
+def reset():
+    """Drops the shared session, clients and endpoint overrides."""
+    global _session
+    with _lock:
+        _session = None
+        _clients.clear()
+        _endpoint_urls.clear()
@@ -0,0 +1,96 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, List, Set
+
+from aws_lambda_powertools import Logger
+from botocore.exceptions import ClientError, ConnectTimeoutError, EndpointConnectionError
+
+from telemetry import add_count
+
+logger = Logger()
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF_SECONDS = 0.05
+# Failures where the request was rejected or never sent, so sending it again can't
+# apply it twice.  Not read timeouts, the write may have landed before the response
+# was lost, and retrying a conditional write would then see its own item.
+SAFE_TO_RETRY = (ClientError, ConnectTimeoutError, EndpointConnectionError)
+
+
+class BackgroundWriter:
+    """
+    Runs I/O on a shared thread pool so it can overlap with the model call.
+    Calls that failed without being applied are retried with exponential
+    backoff, and the final failure is kept on the returned future so callers
+    waiting on it see the error.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        backoff_seconds: float = DEFAULT_BACKOFF_SECONDS,
+    ):
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="chatbot-io"
+        )
+        self._lock = threading.Lock()
+        self._pending: Set[Future] = set()
+
+    def _with_retries(self, function: Callable, *args, **kwargs):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return function(*args, **kwargs)
+            except SAFE_TO_RETRY as e:
+                if attempt == self.max_attempts:
+                    logger.error(
+                        f"Background {function.__name__} failed after {attempt} attempts: {e}"
+                    )
+                    raise
+                logger.warning(f"Background {function.__name__} failed, retrying: {e}")
+                time.sleep(self.backoff_seconds * 2 ** (attempt - 1))
+
+    def submit(self, function: Callable, *args, **kwargs) -> Future:
+        future = self._executor.submit(self._with_retries, function, *args, **kwargs)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future: Future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def drain(self, timeout_seconds: float) -> int:
+        """
+        Waits up to timeout_seconds for the calls still in flight, which nothing
+        else waits on, before a Lambda container is frozen between invocations.
+        Calls that don't finish in time may stall until the next invocation or be
+        lost with the container, they are counted as BackgroundWritesUnfinished.
+
+        Returns:
+            How many calls had not finished.
+        """
+        with self._lock:
+            pending = list(self._pending)
+        if not pending:
+            return 0
+        _, not_done = wait(pending, timeout=max(timeout_seconds, 0))
+        if not_done:
+            logger.warning(f"{len(not_done)} background writes had not finished when the handler returned")
+            add_count("BackgroundWritesUnfinished", len(not_done))
+        return len(not_done)
+
+    def wait(self, futures: List[Future]):
+        """Waits for all of the futures, then raises the first failure if any failed."""
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        """Waits for the calls already submitted to finish."""
+        self._executor.shutdown(wait=True)
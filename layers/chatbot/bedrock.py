@@ -1,31 +1,92 @@
-import boto3
+import time
+from typing import Optional, TYPE_CHECKING
 
 from aws_lambda_powertools import Logger
 from botocore.config import Config
 from botocore.exceptions import ClientError, BotoCoreError
 
-from models import Messages, Message
+import aws_clients
+from context_window import estimate_text_tokens
+from models import Messages, MessageRecord, ContentRecord, Role
+from resilience import CircuitBreaker, RetryPolicy
+from response_cache import ResponseCache, cache_key, namespace_key
+from telemetry import add_count, add_latency, add_retry_attempts, timed
+
+if TYPE_CHECKING:
+    # Imported lazily by the caller as it pulls in NumPy.
+    from semantic_cache import SemanticCache
 
 logger = Logger()
 
-# In some regions / models Bedrock requests per minute can be too low for the integration tests so increase the number of retries.
-config = Config(retries={"max_attempts": 15, "mode": "adaptive"})
+# Retries are left to the RetryPolicy, which knows how long the invocation has left.
+config = Config(retries={"total_max_attempts": 1, "mode": "standard"})
+
+# Also placed by callers after the static system prompts, to keep the prompts that
+# change from turn to turn after it out of the cached prefix.
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+# Models that support Bedrock prompt caching, keyed by a substring of the model id,
+# with the minimum number of tokens a cache checkpoint has to cover to be cached.
+PROMPT_CACHE_MODELS = {
+    "anthropic.claude-3-7-sonnet": {"min_tokens": 1024},
+    "anthropic.claude-3-5-haiku": {"min_tokens": 2048},
+    "anthropic.claude-sonnet-4": {"min_tokens": 1024},
+    "anthropic.claude-opus-4": {"min_tokens": 1024},
+    "amazon.nova-micro": {"min_tokens": 1000},
+    "amazon.nova-lite": {"min_tokens": 1000},
+    "amazon.nova-pro": {"min_tokens": 1000},
+}
+
+
+# Metric name for each field of the Converse token usage.
+TOKEN_METRICS = {
+    "InputTokens": "inputTokens",
+    "OutputTokens": "outputTokens",
+    "TotalTokens": "totalTokens",
+    "CacheReadInputTokens": "cacheReadInputTokens",
+    "CacheWriteInputTokens": "cacheWriteInputTokens",
+}
+
+
+def prompt_cache_capability(model_id: str) -> Optional[dict]:
+    for model_family, capability in PROMPT_CACHE_MODELS.items():
+        if model_family in model_id:
+            return capability
+    return None
 
 
 class Bedrock:
     model_id: str
 
-    def __init__(self, model_id):
+    def __init__(
+        self,
+        model_id,
+        response_cache: Optional[ResponseCache] = None,
+        semantic_cache: Optional["SemanticCache"] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+    ):
         self.model_id = model_id
-        try:
-            self.bedrock_client = self._create_bedrock_client()
-        except Exception as e:
-            logger.error(f"Error initializing Bedrock client: {str(e)}")
-            raise
+        self.response_cache = response_cache
+        self.semantic_cache = semantic_cache
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(model_id)
+        self._bedrock_client = None
+
+    @property
+    def bedrock_client(self):
+        # Created on first use so importing the function doesn't pay for it.
+        if self._bedrock_client is None:
+            try:
+                self._bedrock_client = self._create_bedrock_client()
+            except Exception as e:
+                logger.error(f"Error initializing Bedrock client: {str(e)}")
+                raise
+        return self._bedrock_client
 
     def _create_bedrock_client(self):
         try:
-            bedrock_client = boto3.client("bedrock-runtime", config=config)
+            bedrock_client = aws_clients.client("bedrock-runtime", config=config)
             return bedrock_client
         except ClientError as e:
             logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
@@ -37,48 +98,240 @@ class Bedrock:
             logger.error(f"Unexpected error creating Bedrock client: {str(e)}")
             raise
 
-    def converse(self, system_prompts, messages: Messages):
+    def _converse_args(self, system_prompts, messages: Messages):
+        # Inference parameters to use.
+        temperature = 0.5
+        top_k = 200
+
+        # Base inference parameters to use.
+        inference_config = {"temperature": temperature}
+        # Additional inference parameters to use.
+        additional_model_fields = {"top_k": top_k}
+
+        return {
+            "modelId": self.model_id,
+            "messages": messages.to_dict()["messages"],
+            "system": system_prompts,
+            "inferenceConfig": inference_config,
+            "additionalModelRequestFields": additional_model_fields,
+        }
+
+    def _with_cache_points(self, converse_args):
+        """
+        Adds prompt cache checkpoints after the system prompts and after the stable
+        prefix of the conversation, everything before the new user prompt, so the
+        model can reuse them on the next turn.  When the system prompts hold a
+        CACHE_POINT, e.g. before a rolling summary or retrieved passages, the
+        checkpoint goes there instead of after them all.  Checkpoints covering
+        fewer tokens than the model's minimum are left out as they would never be
+        cached, as are all of them for models without prompt caching.
+        """
+        system = converse_args["system"]
+        static_end = system.index(CACHE_POINT) if CACHE_POINT in system else len(system)
+        static = system[:static_end]
+        per_turn = [prompt for prompt in system[static_end:] if prompt != CACHE_POINT]
+
+        capability = prompt_cache_capability(self.model_id)
+        if capability is None:
+            if static_end == len(system):
+                return converse_args
+            return dict(converse_args, system=static + per_turn)
+
+        converse_args = dict(converse_args)
+        tokens = sum(estimate_text_tokens(prompt.get("text", "")) for prompt in static)
+        if static and tokens >= capability["min_tokens"]:
+            converse_args["system"] = static + [CACHE_POINT] + per_turn
+        else:
+            converse_args["system"] = static + per_turn
+        tokens += sum(estimate_text_tokens(prompt.get("text", "")) for prompt in per_turn)
+
+        messages = converse_args["messages"]
+        if len(messages) > 1:
+            tokens += sum(
+                estimate_text_tokens(item.get("text", ""))
+                for message in messages[:-1]
+                for item in message["content"]
+            )
+            if tokens >= capability["min_tokens"]:
+                prefix_end = dict(messages[-2], content=messages[-2]["content"] + [CACHE_POINT])
+                converse_args["messages"] = messages[:-2] + [prefix_end, messages[-1]]
+        return converse_args
+
+    def _log_usage(self, token_usage, stop_reason, response_metrics=None):
+        logger.info("Input tokens: %s", token_usage["inputTokens"])
+        logger.info("Output tokens: %s", token_usage["outputTokens"])
+        logger.info("Total tokens: %s", token_usage["totalTokens"])
+        logger.info("Cache read input tokens: %s", token_usage.get("cacheReadInputTokens", 0))
+        logger.info("Cache write input tokens: %s", token_usage.get("cacheWriteInputTokens", 0))
+        logger.info("Stop reason: %s", stop_reason)
+
+        for name, key in TOKEN_METRICS.items():
+            add_count(name, token_usage.get(key, 0))
+        if stop_reason:
+            # e.g. StopReasonEndTurn, StopReasonMaxTokens
+            add_count("StopReason" + "".join(part.title() for part in stop_reason.split("_")))
+        if response_metrics and "latencyMs" in response_metrics:
+            # Time Bedrock spent on the request, the gap to BedrockLatency is network and retries.
+            add_latency("BedrockModel", response_metrics["latencyMs"])
+
+    def _invoke(self, operation, converse_args):
+        """
+        Calls Bedrock through the circuit breaker and retry policy, only errors
+        that survive the retries count as failures towards opening the circuit.
+        """
+        self.circuit_breaker.before_call()
+        try:
+            response, retries = self.retry_policy.call(
+                operation, **self._with_cache_points(converse_args)
+            )
+        except ClientError:
+            # Bedrock answered, the request itself was bad.
+            self.circuit_breaker.record_success()
+            raise
+        except BaseException:
+            # Unavailable once the retries ran out, timeouts, connection errors and
+            # anything unexpected.  Always recorded, so a half open probe is never
+            # left outstanding with every later call shed.
+            self.circuit_breaker.record_failure()
+            raise
+        self.circuit_breaker.record_success()
+        add_retry_attempts("Bedrock", response, retries)
+        return response
+
+    def _stateless_prompt(self, converse_args, first_turn: bool) -> Optional[str]:
+        # Only first turn prompts are answered from the semantic cache, later turns
+        # depend on the rest of the conversation even when it was trimmed away.
+        if self.semantic_cache is None or not first_turn:
+            return None
+        return " ".join(item["text"] for item in converse_args["messages"][0]["content"])
+
+    def _cached_response(self, converse_args, use_cache: bool, first_turn: bool) -> Optional[MessageRecord]:
+        if not use_cache:
+            return None
+        if self.response_cache is not None:
+            cached = self.response_cache.get(cache_key(converse_args))
+            if cached is not None:
+                return MessageRecord.from_dict(cached)
+        prompt = self._stateless_prompt(converse_args, first_turn)
+        if prompt is not None:
+            cached = self.semantic_cache.get(namespace_key(converse_args), prompt)
+            if cached is not None:
+                return MessageRecord.from_dict(cached)
+        return None
+
+    def _cache_response(self, converse_args, use_cache: bool, first_turn: bool, message: MessageRecord):
+        if not use_cache:
+            return
+        if self.response_cache is not None:
+            self.response_cache.put(cache_key(converse_args), message.to_dict())
+        prompt = self._stateless_prompt(converse_args, first_turn)
+        if prompt is not None:
+            self.semantic_cache.put(namespace_key(converse_args), prompt, message.to_dict())
+
+    def converse(
+        self, system_prompts, messages: Messages, use_cache: bool = True, first_turn: Optional[bool] = None
+    ):
         """
         Sends messages to a model.
         Args:
             system_prompts (JSON) : The system prompts for the model to use.
             messages (JSON) : The messages to send to the model.
+            use_cache (bool) : Whether the response cache may be used for this request.
+            first_turn (bool) : Whether this is the conversation's first prompt, by default when messages holds a single message.
 
         Returns:
             response (JSON): The conversation that the model generated.
 
         """
 
-        logger.info("Generating message with model %s", self.model_id)
-
-        # Inference parameters to use.
-        temperature = 0.5
-        top_k = 200
+        if first_turn is None:
+            first_turn = len(messages.messages) == 1
+        converse_args = self._converse_args(system_prompts, messages)
+        message = self._cached_response(converse_args, use_cache, first_turn)
+        if message is not None:
+            return message
 
-        # Base inference parameters to use.
-        inference_config = {"temperature": temperature}
-        # Additional inference parameters to use.
-        additional_model_fields = {"top_k": top_k}
+        logger.info("Generating message with model %s", self.model_id)
 
         # Send the message.
         try:
-            response = self.bedrock_client.converse(
-                modelId=self.model_id,
-                messages=messages.to_dict()["messages"],
-                system=system_prompts,
-                inferenceConfig=inference_config,
-                additionalModelRequestFields=additional_model_fields,
-            )
+            with timed("Bedrock"):
+                response = self._invoke(self.bedrock_client.converse, converse_args)
         except ClientError as e:
             logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
             raise  # Re-raise the exception after logging
 
         # Log token usage.
-        token_usage = response["usage"]
-        logger.info("Input tokens: %s", token_usage["inputTokens"])
-        logger.info("Output tokens: %s", token_usage["outputTokens"])
-        logger.info("Total tokens: %s", token_usage["totalTokens"])
-        logger.info("Stop reason: %s", response["stopReason"])
+        self._log_usage(response["usage"], response["stopReason"], response.get("metrics"))
+
+        message = MessageRecord.from_dict(response["output"]["message"])
+        self._cache_response(converse_args, use_cache, first_turn, message)
+        return message
+
+    def converse_stream(
+        self, system_prompts, messages: Messages, use_cache: bool = True, first_turn: Optional[bool] = None
+    ):
+        """
+        Sends messages to a model and streams the response back.
+        Args:
+            system_prompts (JSON) : The system prompts for the model to use.
+            messages (JSON) : The messages to send to the model.
+            use_cache (bool) : Whether the response cache may be used for this request.
+            first_turn (bool) : Whether this is the conversation's first prompt, by default when messages holds a single message.
+
+        Yields:
+            text (str): Each text delta as the model generates it.
+
+        Returns:
+            message (MessageRecord): The assembled assistant message once the stream closes.
+
+        """
+
+        if first_turn is None:
+            first_turn = len(messages.messages) == 1
+        converse_args = self._converse_args(system_prompts, messages)
+        message = self._cached_response(converse_args, use_cache, first_turn)
+        if message is not None:
+            # Replay the cached response as a single delta.
+            for item in message.content:
+                yield item.text
+            return message
+
+        logger.info("Streaming message with model %s", self.model_id)
+
+        start = time.perf_counter()
+        try:
+            response = self._invoke(self.bedrock_client.converse_stream, converse_args)
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+
+        first_token = True
+        role = Role.ASSISTANT
+        blocks = {}
+        stop_reason = None
+        for event in response["stream"]:
+            if "messageStart" in event:
+                role = Role(event["messageStart"]["role"])
+            elif "contentBlockDelta" in event:
+                delta = event["contentBlockDelta"]["delta"].get("text")
+                if delta:
+                    index = event["contentBlockDelta"]["contentBlockIndex"]
+                    blocks.setdefault(index, []).append(delta)
+                    if first_token:
+                        add_latency("BedrockTimeToFirstToken", (time.perf_counter() - start) * 1000)
+                        first_token = False
+                    yield delta
+            elif "messageStop" in event:
+                stop_reason = event["messageStop"]["stopReason"]
+            elif "metadata" in event:
+                # Log token usage.
+                self._log_usage(
+                    event["metadata"]["usage"], stop_reason, event["metadata"].get("metrics")
+                )
 
-        message = Message.from_dict(response["output"]["message"])
+        add_latency("Bedrock", (time.perf_counter() - start) * 1000)
+        content = [ContentRecord("".join(blocks[index])) for index in sorted(blocks)]
+        message = MessageRecord(role, content)
+        self._cache_response(converse_args, use_cache, first_turn, message)
         return message
@@ -1,15 +1,370 @@
-from bedrock import Bedrock
-from dynamodb import DynamoDB
-from models import Messages
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from enum import Enum
+from typing import Callable, Dict, List, Optional, Union, TYPE_CHECKING
+
+from aws_lambda_powertools import Logger
+
+from background import BackgroundWriter
+from bedrock import CACHE_POINT
+from codec import DEFAULT_COMPRESSION_THRESHOLD_BYTES
+from compaction import (
+    CompactionMode,
+    Compactor,
+    with_summary,
+    DEFAULT_COMPACTION_KEEP_TURNS,
+    DEFAULT_COMPACTION_MAX_TURNS,
+    DEFAULT_COMPACTION_TOKEN_THRESHOLD,
+)
+from dynamodb import DynamoDB, SessionWriteConflict
+from lru import LRUCache
+from models import Message, Messages
+from resilience import ServiceUnavailable, deadline_allows, remaining_ms
+from response_cache import ResponseCache
+from router import ModelRoute, ModelRouter
+from telemetry import add_count, timed
+
+if TYPE_CHECKING:
+    from archive import ArchiveStore
+    from retrieval import Retriever
+    from semantic_cache import SemanticCache
+
+logger = Logger()
+
+# Number of recent sessions each warm container keeps in memory so follow up turns skip the history read.
+DEFAULT_SESSION_CACHE_SIZE = 64
+# Bedrock calls in flight at once for a batch request.
+DEFAULT_BATCH_CONCURRENCY = 8
+# Time a batch turn is expected to take, one isn't started with less than this left.
+DEFAULT_BATCH_TURN_MS = 10000
+# Time kept back from the invocation deadline to save the completed turns of a batch and respond.
+BATCH_SAVE_RESERVE_MS = 3000
+
+
+class PersistenceMode(Enum):
+    # Write the user and assistant messages together once the model has responded.
+    BATCHED = "batched"
+    # Write the user message before calling the model and the assistant message after it.
+    WRITE_AHEAD = "write_ahead"
+
+
+class ExecutionMode(Enum):
+    # Every call in the turn runs one after another on the request thread.
+    SERIAL = "serial"
+    # Writes that don't depend on the model response overlap with the model call
+    # and shared cache writes leave the request path, on a background thread pool.
+    CONCURRENT = "concurrent"
+
+
+class Turn:
+    """One independent turn of a batch request."""
+
+    __slots__ = ("session_id", "prompt", "history", "use_cache")
+
+    def __init__(
+        self,
+        session_id: str,
+        prompt: Message,
+        history: Optional[List[Message]] = None,
+        use_cache: bool = True,
+    ):
+        self.session_id = session_id
+        self.prompt = prompt
+        # When None the history is loaded server side from the session id.
+        self.history = history
+        self.use_cache = use_cache
+
+
+class TurnNotSaved(Exception):
+    """The model responded but the turn could not be written to the history table."""
+
+
+class TurnOutOfTime(ServiceUnavailable):
+    """A batch turn that could not finish in time to be saved before the invocation times out, returned as a 503."""
+
 
 class Chatbot:
-    def __init__(self, model_id:str, table_name: str):
-        self.bedrock = Bedrock(model_id)
-        self.ddb = DynamoDB(table_name)
+    def __init__(
+        self,
+        model_id: str,
+        table_name: str,
+        session_cache_size: int = DEFAULT_SESSION_CACHE_SIZE,
+        persistence_mode: PersistenceMode = PersistenceMode.BATCHED,
+        context_token_budget: Optional[int] = None,
+        response_cache: Optional[ResponseCache] = None,
+        semantic_cache: Optional["SemanticCache"] = None,
+        execution_mode: ExecutionMode = ExecutionMode.CONCURRENT,
+        model_routes: Optional[List[ModelRoute]] = None,
+        batch_concurrency: int = DEFAULT_BATCH_CONCURRENCY,
+        batch_turn_ms: float = DEFAULT_BATCH_TURN_MS,
+        compaction_mode: CompactionMode = CompactionMode.OFF,
+        compaction_max_turns: int = DEFAULT_COMPACTION_MAX_TURNS,
+        compaction_token_threshold: int = DEFAULT_COMPACTION_TOKEN_THRESHOLD,
+        compaction_keep_turns: int = DEFAULT_COMPACTION_KEEP_TURNS,
+        defer_compaction: Optional[Callable[[str], None]] = None,
+        compression_threshold_bytes: Optional[int] = DEFAULT_COMPRESSION_THRESHOLD_BYTES,
+        session_ttl_seconds: Optional[int] = None,
+        archive_store: Optional["ArchiveStore"] = None,
+        retriever: Optional["Retriever"] = None,
+    ):
+        # With no routes every turn goes to model_id.
+        self.router = ModelRouter(
+            model_id,
+            model_routes,
+            context_token_budget=context_token_budget,
+            response_cache=response_cache,
+            semantic_cache=semantic_cache,
+        )
+        self.ddb = DynamoDB(table_name, compression_threshold_bytes, ttl_seconds=session_ttl_seconds)
+        self.archiver = None
+        if archive_store is not None:
+            # Only import when archiving is configured, it is off the path of a turn.
+            from archive import Archiver
 
-    def converse(self, system_prompts, messages: Messages):
-        response = self.ddb.save_last_message(messages)
-        response = self.bedrock.converse(system_prompts, messages)
+            # Sessions with archived items are restored when they are next read.
+            self.archiver = Archiver(archive_store, self.ddb)
+            self.ddb.rehydrate = self.archiver.rehydrate
+        self.sessions = LRUCache(session_cache_size)
+        self.persistence_mode = PersistenceMode(persistence_mode)
+        self.execution_mode = ExecutionMode(execution_mode)
+        self.batch_concurrency = batch_concurrency
+        self.batch_turn_ms = batch_turn_ms
+        self._batch_executor = None
+        self.compaction_mode = CompactionMode(compaction_mode)
+        self.compactor = None
+        if self.compaction_mode != CompactionMode.OFF:
+            # Summaries are always written by the default model.
+            self.compactor = Compactor(
+                self.router.bedrock(model_id),
+                self.ddb,
+                max_turns=compaction_max_turns,
+                token_threshold=compaction_token_threshold,
+                keep_turns=compaction_keep_turns,
+            )
+        # Hands a session id to the separate compaction pass, for DEFERRED mode.
+        self.defer_compaction = defer_compaction
+        # Adds reference passages related to the prompt to the system prompts.
+        self.retriever = retriever
+        self.writer = None
+        if self.execution_mode == ExecutionMode.CONCURRENT:
+            self.writer = BackgroundWriter()
+            if response_cache is not None and response_cache.writer is None:
+                response_cache.writer = self.writer
+
+    def drain(self, timeout_seconds: float) -> int:
+        """
+        Waits a bounded time for background writes before a Lambda handler
+        returns, see BackgroundWriter.drain.  Returns how many had not finished.
+        """
+        if self.writer is None:
+            return 0
+        return self.writer.drain(timeout_seconds)
+
+    def close(self):
+        """
+        Waits for background writes to finish and stops the thread pools, for
+        processes that exit rather than being frozen like a Lambda container.
+        """
+        if self.writer is not None:
+            self.writer.shutdown()
+        if self._batch_executor is not None:
+            self._batch_executor.shutdown(wait=True)
+
+    def get_history(self, session_id: str) -> Messages:
+        """
+        Returns the conversation history for a session, from the in memory session
+        cache when this container served the previous turn, otherwise from DynamoDB.
+        """
+        messages = self.sessions.get(session_id)
+        if messages is None:
+            add_count("SessionCacheMiss")
+            messages = self.ddb.get_messages(session_id)
+        else:
+            add_count("SessionCacheHit")
+        # Hand out a copy so a failed turn can't leave a half updated entry in the cache.
+        return messages.copy()
+
+    def _save_prompt(self, messages: Messages) -> Optional[Future]:
+        if self.persistence_mode != PersistenceMode.WRITE_AHEAD:
+            return None
+        if self.writer is None:
+            # Already written, the future only carries the sequence it was written at.
+            written = Future()
+            written.set_result(self.ddb.save_last_message(messages, reserve_next=True))
+            return written
+        # Write a snapshot, the response is appended while the write is in flight.
+        snapshot = messages.copy()
+        return self.writer.submit(self.ddb.save_last_message, snapshot, reserve_next=True)
+
+    def _save_response(self, messages: Messages, pending: Optional[Future]):
+        # Where the prompt goes when no other writer added to the session during the turn.
+        expected = messages.sequence_after(len(messages.messages) - 2)
+        if self.persistence_mode == PersistenceMode.WRITE_AHEAD:
+            # The turn is only complete once the prompt write is confirmed too, and the
+            # response goes in the sequence reserved with the prompt, wherever it landed.
+            prompt_sequence = pending.result()
+            self.ddb.save_reserved_message(messages, prompt_sequence + 1)
+            in_order = prompt_sequence == expected
+        else:
+            in_order = self.ddb.save_last_messages(messages, count=2) == expected
+        self._cache_saved(messages, in_order)
+
+    def _discard_prompt(self, messages: Messages, pending: Optional[Future]):
+        # The model call failed after the prompt was written ahead, remove it and its
+        # reservation so the next turn's history still alternates user and assistant.
+        if pending is None:
+            return
+        try:
+            prompt_sequence = pending.result()
+        except Exception:
+            return  # Never written.
+        try:
+            self.ddb.delete_items(messages.session_id, [prompt_sequence, prompt_sequence + 1])
+        except Exception:
+            logger.exception(f"Could not remove the unanswered prompt of session {messages.session_id}")
+            add_count("UnansweredPromptKept")
+
+    def _cache_saved(self, messages: Messages, in_order: bool):
+        if in_order:
+            self.sessions.put(messages.session_id, messages)
+        else:
+            # Other writers added to the session during the turn, read it back with theirs next turn.
+            self.sessions.pop(messages.session_id)
+
+    def _system_prompts(self, system_prompts: List[Dict], messages: Messages) -> List[Dict]:
+        # The session's rolling summary, then any passages retrieved for the prompt,
+        # after a cache point so they don't change the prefix Bedrock caches.
+        per_turn = with_summary([], messages.summary)
+        if self.retriever is not None:
+            prompt = " ".join(item.text for item in messages.messages[-1].content)
+            per_turn = self.retriever.with_passages(per_turn, prompt)
+        if not per_turn:
+            return system_prompts
+        return list(system_prompts) + [CACHE_POINT] + per_turn
+
+    def converse(self, system_prompts, messages: Messages, use_cache: bool = True):
+        pending = self._save_prompt(messages)
+        try:
+            response = self.router.converse(
+                self._system_prompts(system_prompts, messages), messages, use_cache=use_cache
+            )
+        except BaseException:
+            self._discard_prompt(messages, pending)
+            raise
         messages.append(response)
-        response = self.ddb.save_last_message(messages)
-        return messages
\ No newline at end of file
+        self._save_response(messages, pending)
+        return messages
+
+    def converse_stream(self, system_prompts, messages: Messages, use_cache: bool = True):
+        """
+        Streams the model response as text deltas, persisting the assembled
+        assistant message once the stream has closed.
+        """
+        pending = self._save_prompt(messages)
+        try:
+            response = yield from self.router.converse_stream(
+                self._system_prompts(system_prompts, messages), messages, use_cache=use_cache
+            )
+        except BaseException:
+            # Including the client going away part way through the stream.
+            self._discard_prompt(messages, pending)
+            raise
+        messages.append(response)
+        self._save_response(messages, pending)
+        return messages
+
+    def maybe_compact(self, messages: Messages):
+        """
+        Compacts a server side session once it crosses the compaction thresholds,
+        straight away in INLINE mode or by handing it to defer_compaction.  Only
+        call this for sessions whose history is kept server side, a client that
+        sends its own history expects it back in full.
+        """
+        if self.compactor is None or not self.compactor.should_compact(messages):
+            return
+        try:
+            if self.compaction_mode == CompactionMode.INLINE or self.defer_compaction is None:
+                # From the stored session, which has any turns other writers added concurrently.
+                self.compact_session(messages.session_id)
+                return
+            self.defer_compaction(messages.session_id)
+        except Exception:
+            # The turn itself is saved, the next turn will try compacting again.
+            logger.exception(f"Compacting session {messages.session_id} failed")
+            add_count("CompactionFailed")
+            return
+        # Read the session back on its next turn, to pick up the summary.
+        self.sessions.pop(messages.session_id)
+
+    def compact_session(self, session_id: str):
+        """Compacts a stored session if it is over the thresholds, for the batch compaction pass."""
+        if self.compactor is None:
+            return
+        self.sessions.put(session_id, self.compactor.compact_session(session_id))
+
+    def _batch_turn(self, system_prompts, turn: Turn) -> Messages:
+        if not deadline_allows(self.batch_turn_ms + BATCH_SAVE_RESERVE_MS):
+            raise TurnOutOfTime(f"Not enough time left to run the turn for session {turn.session_id}")
+        if turn.history is None:
+            with timed("HistoryLoad"):
+                messages = self.get_history(turn.session_id)
+        else:
+            messages = Messages.from_message_list(turn.session_id, list(turn.history))
+        messages.append(turn.prompt)
+        messages.append(
+            self.router.converse(
+                self._system_prompts(system_prompts, messages), messages, use_cache=turn.use_cache
+            )
+        )
+        return messages
+
+    def converse_batch(self, system_prompts, turns: List[Turn]) -> List[Union[Messages, Exception]]:
+        """
+        Runs independent turns concurrently, bounded by batch_concurrency, over the
+        shared clients, then persists every completed turn with batched writes.
+        Returns, in the order of the turns, the updated conversation or the error
+        that turn failed with so one failure doesn't fail the whole batch.
+
+        Turns only start while the invocation deadline leaves time for one, and
+        turns still running when only the time to save the others is left fail
+        with TurnOutOfTime, so the completed turns are always saved.
+        """
+        if self._batch_executor is None:
+            self._batch_executor = ThreadPoolExecutor(
+                max_workers=self.batch_concurrency, thread_name_prefix="chatbot-batch"
+            )
+        # Each turn runs in a copy of the caller's context so it sees the invocation deadline.
+        futures = [
+            self._batch_executor.submit(
+                contextvars.copy_context().run, self._batch_turn, system_prompts, turn
+            )
+            for turn in turns
+        ]
+        remaining = remaining_ms()
+        timeout = None if remaining is None else max(remaining - BATCH_SAVE_RESERVE_MS, 0) / 1000
+        done, _ = wait(futures, timeout=timeout)
+        results = []
+        for future, turn in zip(futures, turns):
+            if future not in done:
+                # Left to finish in the background, its response is dropped.
+                future.cancel()
+                results.append(TurnOutOfTime(f"Turn for session {turn.session_id} did not finish in time"))
+                continue
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+
+        completed = [index for index, result in enumerate(results) if isinstance(result, Messages)]
+        written = self.ddb.save_turns([results[index] for index in completed], count=2) if completed else []
+        for index, sequence in zip(completed, written):
+            messages = results[index]
+            if isinstance(sequence, SessionWriteConflict):
+                results[index] = sequence
+            elif isinstance(sequence, Exception):
+                results[index] = TurnNotSaved(f"Turn for session {messages.session_id} was not saved")
+            else:
+                self._cache_saved(messages, sequence == messages.offset + len(messages.messages) - 1)
+        add_count("BatchTurnFailed", sum(not isinstance(result, Messages) for result in results))
+        add_count("BatchTurnOutOfTime", sum(isinstance(result, TurnOutOfTime) for result in results))
+        return results
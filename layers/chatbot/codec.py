@@ -0,0 +1,99 @@
+import json
+import zlib
+from decimal import Decimal
+from typing import Dict, Optional, Tuple
+
+try:
+    # Optional, zstd compresses text better and faster than zlib when installed.
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Items written before the codec have no format_version and always store content
+# plainly.  Version 2 items store it either plainly or compressed in content_z.
+FORMAT_VERSION = 2
+# Content up to one write unit is stored as is, compressing it can't save a unit.
+DEFAULT_COMPRESSION_THRESHOLD_BYTES = 1024
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def _compress(data: bytes) -> Tuple[str, bytes]:
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return "zlib", zlib.compress(data, ZLIB_LEVEL)
+
+
+def _decompress(codec: str, data: bytes) -> bytes:
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("Item is zstd compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"Unknown content codec {codec}")
+
+
+def encode_content(record: Dict, threshold_bytes: Optional[int] = DEFAULT_COMPRESSION_THRESHOLD_BYTES) -> Dict:
+    """
+    Returns the message record as stored, with content over the threshold
+    compressed into the content_z binary attribute when that makes it smaller.
+    Args:
+        record (Dict) : A message record, from to_record().
+        threshold_bytes (int) : Serialized content size above which it is compressed, None or 0 to never compress.
+
+    Returns:
+        item (Dict): The record to store.
+
+    """
+    item = dict(record, format_version=FORMAT_VERSION)
+    if not threshold_bytes:
+        return item
+    data = json.dumps(record["content"], separators=(",", ":")).encode("utf-8")
+    if len(data) <= threshold_bytes:
+        return item
+    codec, compressed = _compress(data)
+    if len(compressed) >= len(data):
+        return item
+    del item["content"]
+    item["content_z"] = compressed
+    item["codec"] = codec
+    return item
+
+
+def decode_content(item: Dict) -> Dict:
+    """Returns a stored item, of any format version, with its content as a plain list."""
+    if "content_z" not in item:
+        return item
+    record = dict(item)
+    # The deserializer wraps binary attributes in boto3's Binary.
+    data = record.pop("content_z")
+    data = getattr(data, "value", data)
+    record["content"] = json.loads(_decompress(record.pop("codec"), bytes(data)))
+    return record
+
+
+def item_size(item: Dict) -> int:
+    """
+    Estimates the size of an item as DynamoDB bills it, attribute names plus
+    values, which decides its write units (1 KB) and read units (4 KB).
+    """
+    return sum(len(name.encode("utf-8")) + _value_size(value) for name, value in item.items())
+
+
+def _value_size(value) -> int:
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, (int, float, Decimal)):
+        # Numbers take roughly one byte per two significant digits plus one.
+        return (len(str(abs(value)).replace(".", "")) + 1) // 2 + 1
+    if isinstance(value, dict):
+        return 3 + sum(len(name.encode("utf-8")) + _value_size(item) + 1 for name, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return 3 + sum(_value_size(item) + 1 for item in value)
+    value = getattr(value, "value", value)
+    return len(value)
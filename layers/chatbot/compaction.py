@@ -0,0 +1,136 @@
+from enum import Enum
+from typing import Dict, List, Optional
+
+from aws_lambda_powertools import Logger
+
+from bedrock import Bedrock
+from context_window import estimate_tokens, group_turns
+from dynamodb import DynamoDB
+from models import ContentRecord, MessageRecord, Messages, Role
+from telemetry import add_count, timed
+
+logger = Logger()
+
+# Compact once the stored tail passes either threshold.
+DEFAULT_COMPACTION_MAX_TURNS = 20
+DEFAULT_COMPACTION_TOKEN_THRESHOLD = 8000
+# Recent turns always kept verbatim after the summary.
+DEFAULT_COMPACTION_KEEP_TURNS = 4
+
+SUMMARY_SYSTEM_PROMPTS = [
+    {
+        "text": "You maintain a running summary of a conversation between a user and an assistant. "
+        "Extend the existing summary with the new turns, keeping names, facts, decisions and open "
+        "questions the assistant will need later. Carry messages marked [pinned] over word for word. "
+        "Reply with the updated summary only."
+    }
+]
+
+
+class CompactionMode(Enum):
+    # Sessions are never compacted.
+    OFF = "off"
+    # The turn that crosses the threshold compacts the session before returning.
+    INLINE = "inline"
+    # The turn that crosses the threshold hands the session to a separate batch pass.
+    DEFERRED = "deferred"
+
+
+def with_summary(system_prompts: List[Dict], summary: Optional[str]) -> List[Dict]:
+    """Returns the system prompts followed by the session's rolling summary, if it has one."""
+    if not summary:
+        return system_prompts
+    return list(system_prompts) + [{"text": f"Summary of the earlier conversation:\n{summary}"}]
+
+
+class Compactor:
+    """
+    Folds the older turns of a long session into a rolling summary stored under
+    the reserved summary sequence, so the context is built from the summary and
+    the recent tail.  Each compaction only sends the previous summary and the
+    turns since it to the model, never the whole history.  Pinned messages are
+    folded too, but the model is asked to carry them over word for word.
+    """
+
+    def __init__(
+        self,
+        bedrock: Bedrock,
+        ddb: DynamoDB,
+        max_turns: int = DEFAULT_COMPACTION_MAX_TURNS,
+        token_threshold: int = DEFAULT_COMPACTION_TOKEN_THRESHOLD,
+        keep_turns: int = DEFAULT_COMPACTION_KEEP_TURNS,
+    ):
+        self.bedrock = bedrock
+        self.ddb = ddb
+        self.max_turns = max_turns
+        self.token_threshold = token_threshold
+        self.keep_turns = keep_turns
+
+    def should_compact(self, messages: Messages) -> bool:
+        turns = group_turns(messages.messages)
+        if len(turns) <= self.keep_turns:
+            return False
+        if len(turns) > self.max_turns:
+            return True
+        return sum(estimate_tokens(message) for message in messages.messages) > self.token_threshold
+
+    def _fold_count(self, messages: Messages) -> int:
+        # Number of leading messages to fold, whole turns up to the kept tail.
+        turns = group_turns(messages.messages)
+        if len(turns) <= self.keep_turns:
+            return 0
+        return turns[-self.keep_turns][0]
+
+    def _summary_prompt(self, summary: Optional[str], folded: List) -> Messages:
+        transcript = "\n\n".join(
+            f"{'[pinned] ' if message.pinned else ''}{message.role.value.capitalize()}: "
+            f"{' '.join(item.text for item in message.content)}"
+            for message in folded
+        )
+        text = f"Existing summary:\n{summary or '(none yet)'}\n\nNew turns:\n{transcript}"
+        return Messages(
+            session_id="compaction", messages=[MessageRecord(Role.USER, [ContentRecord(text)])]
+        )
+
+    def compact(self, messages: Messages) -> Messages:
+        """
+        Folds the turns before the kept tail into the session's summary.
+        Args:
+            messages (Messages) : The session as loaded, summary plus the messages after it.
+
+        Returns:
+            messages (Messages): The compacted session, or the session unchanged when there was nothing to fold.
+
+        """
+        count = self._fold_count(messages)
+        if count == 0:
+            return messages
+        with timed("Compaction"):
+            response = self.bedrock.converse(
+                SUMMARY_SYSTEM_PROMPTS,
+                self._summary_prompt(messages.summary, messages.messages[:count]),
+                use_cache=False,
+            )
+        summary = " ".join(item.text for item in response.content)
+        # Where the last folded message is stored, the sequences can have gaps.
+        last = messages.messages[count - 1]
+        covers_through = last._sequence if last._sequence is not None else messages.sequence_after(count - 1)
+        if not self.ddb.save_summary(messages.session_id, summary, covers_through):
+            # Another pass got there first, keep serving what we have.
+            return messages
+        add_count("CompactedMessages", count)
+        logger.info(f"Compacted {count} messages of session {messages.session_id}")
+        return Messages(
+            session_id=messages.session_id,
+            messages=messages.messages[count:],
+            summary=summary,
+            offset=covers_through,
+        )
+
+    def compact_session(self, session_id: str) -> Messages:
+        """Compacts a stored session if it is over the thresholds, the batch pass entry point."""
+        messages = self.ddb.get_messages(session_id)
+        if not self.should_compact(messages):
+            return messages
+        return self.compact(messages)
+
@@ -0,0 +1,154 @@
+from math import ceil
+from typing import List, Optional
+
+from aws_lambda_powertools import Logger
+
+from models import Messages, Message, MessageRecord, Role
+
+logger = Logger()
+
+# Rough characters per token for English text, close enough for budgeting.
+CHARS_PER_TOKEN = 4
+# Allowance for the role and framing Bedrock adds around each message.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+DEFAULT_CONTEXT_TOKEN_BUDGET = 100000
+
+# Input token budgets per model family, leaving headroom below the context
+# limit for the response.  Keys are matched as substrings of the model id so
+# cross region inference profiles (e.g. us.anthropic...) resolve too.
+MODEL_CONTEXT_BUDGETS = {
+    "anthropic.claude": 180000,
+    "amazon.nova-micro": 120000,
+    "amazon.nova": 280000,
+    "amazon.titan": 7000,
+    "meta.llama3-1": 120000,
+    "meta.llama3": 7000,
+    "mistral": 30000,
+}
+
+
+def estimate_text_tokens(text: str) -> int:
+    return ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def model_token_budget(model_id: str) -> int:
+    for model_family, budget in MODEL_CONTEXT_BUDGETS.items():
+        if model_family in model_id:
+            return budget
+    return DEFAULT_CONTEXT_TOKEN_BUDGET
+
+
+def estimate_tokens(message: Message) -> int:
+    # Cache the estimate on the message, history is re-windowed every turn.
+    if message._token_count is None:
+        message._token_count = MESSAGE_OVERHEAD_TOKENS + sum(
+            estimate_text_tokens(item.text) for item in message.content
+        )
+    return message._token_count
+
+
+def group_turns(messages: List[Message]) -> List[List[int]]:
+    # Group message indexes into turns, each starting at a user message that
+    # follows an assistant message, so whole turns are kept or dropped and
+    # the user / assistant alternation stays valid.
+    turns = []
+    for index, message in enumerate(messages):
+        if not turns or (
+            message.role == Role.USER and messages[index - 1].role == Role.ASSISTANT
+        ):
+            turns.append([])
+        turns[-1].append(index)
+    return turns
+
+
+def alternate(messages: List[Message]) -> List[Message]:
+    """
+    Makes the messages valid for Converse, which needs them to start with a user
+    message and alternate roles.  Leading assistant messages are dropped and
+    consecutive messages of one role, e.g. prompts whose turns failed, merged.
+    Returns the same list when it is already valid.
+    """
+    start = next((index for index, message in enumerate(messages) if message.role == Role.USER), len(messages))
+    valid = messages[start:]
+    merged = []
+    for message in valid:
+        if merged and merged[-1].role == message.role:
+            previous = merged[-1]
+            merged[-1] = MessageRecord(
+                previous.role, list(previous.content) + list(message.content), previous.pinned or message.pinned
+            )
+        else:
+            merged.append(message)
+    if start == 0 and len(merged) == len(messages):
+        return messages
+    return merged
+
+
+class ContextWindow:
+    """
+    Trims a conversation to a token budget before it is sent to the model,
+    keeping the system prompt, the newest turns and any pinned turns.
+    """
+
+    def __init__(self, model_id: str, token_budget: Optional[int] = None):
+        self.model_id = model_id
+        self.token_budget = token_budget or model_token_budget(model_id)
+
+    def estimate_tokens(self, message: Message) -> int:
+        return estimate_tokens(message)
+
+    def select(self, system_prompts, messages: Messages) -> Messages:
+        """
+        Selects the messages to send to the model.
+        Args:
+            system_prompts (JSON) : The system prompts, which always count against the budget.
+            messages (Messages) : The full conversation, ending with the new user prompt.
+
+        Returns:
+            messages (Messages): The conversation trimmed to the token budget, starting with a user message and alternating roles.
+
+        """
+        turns = group_turns(messages.messages)
+        if not turns:
+            return messages
+
+        def turn_tokens(turn):
+            return sum(self.estimate_tokens(messages.messages[index]) for index in turn)
+
+        remaining = self.token_budget - sum(
+            estimate_text_tokens(prompt.get("text", "")) for prompt in system_prompts
+        )
+        # The latest turn holds the new prompt and is always sent.
+        keep = {len(turns) - 1}
+        remaining -= turn_tokens(turns[-1])
+
+        for position, turn in enumerate(turns[:-1]):
+            if any(messages.messages[index].pinned for index in turn):
+                keep.add(position)
+                remaining -= turn_tokens(turn)
+
+        for position in range(len(turns) - 2, -1, -1):
+            if position in keep:
+                continue
+            tokens = turn_tokens(turns[position])
+            if tokens > remaining:
+                break
+            keep.add(position)
+            remaining -= tokens
+
+        if len(keep) == len(turns):
+            selected = messages.messages
+        else:
+            selected = [
+                messages.messages[index]
+                for position in sorted(keep)
+                for index in turns[position]
+            ]
+            logger.info(
+                "Context window kept %s of %s messages", len(selected), len(messages.messages)
+            )
+        window = alternate(selected)
+        if window is messages.messages:
+            return messages
+        return Messages(session_id=messages.session_id, messages=window)
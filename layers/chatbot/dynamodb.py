@@ -1,51 +1,873 @@
-import boto3
+import base64
+import binascii
+import json
+import random
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 from aws_lambda_powertools import Logger
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
 from botocore.exceptions import ClientError, BotoCoreError
 
-from models import Messages, Message
+import aws_clients
+from codec import DEFAULT_COMPRESSION_THRESHOLD_BYTES, decode_content, encode_content
+from models import Messages, MessageRecord
+from resilience import ServiceUnavailable, deadline_allows
+from telemetry import add_consumed_capacity, add_count, timed
 
 logger = Logger()
 
+# BatchWriteItem accepts at most 25 put or delete requests.
+BATCH_WRITE_LIMIT = 25
+# TransactWriteItems accepts at most 100 actions.
+TRANSACT_WRITE_LIMIT = 100
+# Attempts at writing a turn before giving up on a session other writers keep appending to.
+DEFAULT_WRITE_ATTEMPTS = 5
+DEFAULT_WRITE_BACKOFF_SECONDS = 0.01
+# Messages are only written to free sequences, never over another writer's.
+NEW_SEQUENCE_CONDITION = "attribute_not_exists(#sequence)"
+# Holds the sequence after a prompt written ahead of its response, readers skip it.
+RESERVED_ATTRIBUTE = "reserved"
+NOT_RESERVED_FILTER = "attribute_not_exists(#reserved)"
+# Cancellation reasons of a transaction that lost the race for a sequence.
+CONFLICT_REASONS = {"ConditionalCheckFailed", "TransactionConflict"}
+# Messages are stored from sequence 1, the session's rolling summary lives at 0.
+SUMMARY_SEQUENCE = 0
+# Marks a session with items moved to the archive, it never expires.
+ARCHIVE_SEQUENCE = -1
+# Where the idle session scan stopped, kept like an archive marker under a name no session has.
+IDLE_SCAN_SESSION = "#idle-scan"
+# Time kept back from the function timeout when scanning for idle sessions, to save the position.
+DEFAULT_SCAN_RESERVE_MS = 10000
+# Characters of each message kept in its preview attribute for listing views.
+PREVIEW_CHARS = 120
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Attributes a history page can be projected to, content also needs its compressed form.
+MESSAGE_FIELDS = {
+    "sequence": ["sequence"],
+    "role": ["role"],
+    "preview": ["preview"],
+    "content": ["content", "content_z", "codec"],
+    "pinned": ["pinned"],
+    "model_id": ["model_id"],
+}
+# Returned when no fields are asked for, the preview only repeats the content.
+DEFAULT_MESSAGE_FIELDS = [field for field in MESSAGE_FIELDS if field != "preview"]
+
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+
+def serialize_item(item: dict) -> dict:
+    return {key: serializer.serialize(value) for key, value in item.items()}
+
+
+def deserialize_item(item: dict) -> dict:
+    return {key: deserializer.deserialize(value) for key, value in item.items()}
+
+
+class SessionWriteConflict(ServiceUnavailable):
+    """Other writers kept taking the session's next sequences, returned as a 409 so the client resends the turn."""
+
+    status_code = 409
+
+
+def is_write_conflict(error: ClientError) -> bool:
+    """Whether the write failed because another writer already has the sequence."""
+    code = error.response["Error"]["Code"]
+    if code == "ConditionalCheckFailedException":
+        return True
+    return code == "TransactionCanceledException" and any(
+        reason.get("Code") in CONFLICT_REASONS for reason in error.response.get("CancellationReasons", [])
+    )
+
+
+def encode_cursor(last_evaluated_key: dict) -> str:
+    """Turns a LastEvaluatedKey into an opaque token for the client to send back."""
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, session_id: str) -> dict:
+    """
+    Turns a cursor back into an ExclusiveStartKey.
+    Raises:
+        ValueError: When the cursor is malformed or belongs to another session.
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        valid = key["session_id"] == {"S": session_id} and set(key["sequence"]) == {"N"}
+    except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError):
+        valid = False
+    if not valid:
+        raise ValueError("Invalid cursor")
+    return key
+
 
 class DynamoDB:
-    def __init__(self, table_name: str):
+    def __init__(
+        self,
+        table_name: str,
+        compression_threshold_bytes: Optional[int] = DEFAULT_COMPRESSION_THRESHOLD_BYTES,
+        ttl_seconds: Optional[int] = None,
+    ):
+        self.table_name = table_name
+        # Message content larger than this is stored compressed, see codec.py.
+        self.compression_threshold_bytes = compression_threshold_bytes
+        # Items are written with an expires_at this far ahead for DynamoDB TTL, None to keep them.
+        self.ttl_seconds = ttl_seconds
+        # Restores a session's archived items, called when reading a session that has some.
+        self.rehydrate: Optional[Callable[[str], None]] = None
+        self._ddb_client = None
+
+    @property
+    def ddb_client(self):
+        # Created on first use so importing the function doesn't pay for it.
+        if self._ddb_client is None:
+            try:
+                self._ddb_client = self._create_ddb_client()
+            except Exception as e:
+                logger.error(f"Error initializing DynamoDB: {e}")
+                raise
+        return self._ddb_client
+
+    def _create_ddb_client(self):
         try:
-            self._create_ddb_table(table_name)
+            # The low level client, the resource API is noticeably slower to create.
+            return aws_clients.client("dynamodb")
+
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
         except Exception as e:
-            logger.error(f"Error initializing DynamoDB: {e}")
+            logger.error(f"Unexpected error creating DynamoDB client: {str(e)}")
+            raise
+
+    def _message_item(self, messages: Messages, index: int, sequence: Optional[int] = None) -> dict:
+        message = messages.messages[index]
+        item = encode_content(message.to_record(), self.compression_threshold_bytes)
+        item["preview"] = " ".join(content.text for content in message.content)[:PREVIEW_CHARS]
+        item["session_id"] = messages.session_id
+        item["sequence"] = messages.sequence_after(index) if sequence is None else sequence
+        return self._with_ttl(item)
+
+    @staticmethod
+    def _mark_stored(messages: Messages, count: int, sequence: int):
+        # Records where the last count messages were written, later turns number on from them.
+        for number, message in enumerate(messages.messages[-count:]):
+            message._sequence = sequence + number
+
+    def _turn_items(
+        self, messages: Messages, count: int, sequence: Optional[int] = None, reserve_next: bool = False
+    ) -> Tuple[int, List[dict]]:
+        # The last count messages, numbered on from sequence or else their place in the conversation.
+        first = max(len(messages.messages) - count, 0)
+        if sequence is None:
+            sequence = messages.sequence_after(first)
+        items = [
+            serialize_item(self._message_item(messages, index, sequence + index - first))
+            for index in range(first, len(messages.messages))
+        ]
+        if reserve_next:
+            reservation = {
+                "session_id": messages.session_id,
+                "sequence": sequence + len(items),
+                RESERVED_ATTRIBUTE: True,
+            }
+            items.append(serialize_item(self._with_ttl(reservation)))
+        return sequence, items
+
+    def _new_item_put(self, item: dict) -> dict:
+        return {
+            "TableName": self.table_name,
+            "Item": item,
+            "ConditionExpression": NEW_SEQUENCE_CONDITION,
+            "ExpressionAttributeNames": {"#sequence": "sequence"},
+        }
+
+    def _with_ttl(self, item: dict) -> dict:
+        if self.ttl_seconds:
+            item["expires_at"] = int(time.time()) + self.ttl_seconds
+        return item
+
+    def _batch_write(self, requests: List[dict], max_attempts: int = 3, backoff_seconds: float = 0.05) -> List[dict]:
+        # Sends put / delete requests in chunks, retrying unprocessed ones, returns those never written.
+        failed = []
+        with timed("DynamoDBBatchWriteItem"):
+            for start in range(0, len(requests), BATCH_WRITE_LIMIT):
+                pending = requests[start : start + BATCH_WRITE_LIMIT]
+                for attempt in range(1, max_attempts + 1):
+                    try:
+                        response = self.ddb_client.batch_write_item(
+                            RequestItems={self.table_name: pending},
+                            ReturnConsumedCapacity="TOTAL",
+                        )
+                    except (ClientError, BotoCoreError) as e:
+                        logger.error(f"Batch write failed: {e}")
+                        break
+                    add_consumed_capacity("ConsumedWriteCapacity", response.get("ConsumedCapacity"))
+                    pending = response.get("UnprocessedItems", {}).get(self.table_name, [])
+                    if not pending:
+                        break
+                    if attempt < max_attempts:
+                        time.sleep(backoff_seconds * 2 ** (attempt - 1))
+                if pending:
+                    logger.error(f"{len(pending)} items were not written")
+                    failed.extend(pending)
+        return failed
+
+    def next_sequence(self, session_id: str) -> int:
+        """
+        Allocates the sequence after the session's latest message, read
+        consistently, for a writer that lost the race for the one it expected.
+        """
+        try:
+            with timed("DynamoDBQuery"):
+                response = self.ddb_client.query(
+                    TableName=self.table_name,
+                    KeyConditionExpression="session_id = :session_id AND #sequence > :summary",
+                    ExpressionAttributeNames={"#sequence": "sequence"},
+                    ExpressionAttributeValues={
+                        ":session_id": {"S": session_id},
+                        ":summary": {"N": str(SUMMARY_SEQUENCE)},
+                    },
+                    ProjectionExpression="#sequence",
+                    ScanIndexForward=False,
+                    Limit=1,
+                    ConsistentRead=True,
+                    ReturnConsumedCapacity="TOTAL",
+                )
+            add_consumed_capacity("ConsumedReadCapacity", response.get("ConsumedCapacity"))
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
             raise
 
-    def _create_ddb_table(self, table_name: str):
+        if response["Items"]:
+            return int(response["Items"][0]["sequence"]["N"]) + 1
+        # No messages left in the table, don't reuse the sequences of archived or summarised ones.
+        state = self.get_session_state(session_id)
+        return max(state.get("archived_through", 0), state.get("covers_through", 0)) + 1
+
+    def _put_new_items(self, items: List[dict]):
+        if len(items) == 1:
+            with timed("DynamoDBPutItem"):
+                response = self.ddb_client.put_item(**self._new_item_put(items[0]), ReturnConsumedCapacity="TOTAL")
+        else:
+            # A transaction rather than BatchWriteItem so a turn is never half persisted.
+            with timed("DynamoDBTransactWriteItems"):
+                response = self.ddb_client.transact_write_items(
+                    TransactItems=[{"Put": self._new_item_put(item)} for item in items],
+                    ReturnConsumedCapacity="TOTAL",
+                )
+        add_consumed_capacity("ConsumedWriteCapacity", response.get("ConsumedCapacity"))
+
+    def save_last_messages(
+        self,
+        messages: Messages,
+        count: int = 2,
+        sequence: Optional[int] = None,
+        max_attempts: int = DEFAULT_WRITE_ATTEMPTS,
+        backoff_seconds: float = DEFAULT_WRITE_BACKOFF_SECONDS,
+        reserve_next: bool = False,
+    ) -> int:
+        """
+        Writes the last messages in the conversation in a single round trip.
+        The write only succeeds where the sequences are free, when another
+        writer to the session already has them the messages are written after
+        the session's latest message instead.
+        Args:
+            messages (Messages) : The conversation to persist.
+            count (int) : How many messages from the end of the conversation to write, typically the user prompt and the assistant response.
+            sequence (Optional[int]) : Where to write the first of them, by default after the messages before them in the conversation.
+            reserve_next (bool) : Also reserve the sequence after them for save_reserved_message, in the same transaction.
+
+        Returns:
+            sequence (int): The sequence the first message was written at, later than asked for when other writers got there first.
+
+        Raises:
+            SessionWriteConflict: When other writers took the session's next sequences on every attempt.
+
+        """
+        for attempt in range(1, max_attempts + 1):
+            sequence, items = self._turn_items(messages, count, sequence, reserve_next)
+            try:
+                self._put_new_items(items)
+                self._mark_stored(messages, count, sequence)
+                return sequence
+            except ClientError as e:
+                if not is_write_conflict(e):
+                    logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+                    raise  # Re-raise the exception after logging
+            except BotoCoreError as e:
+                logger.error(f"Boto3 Core Error: {str(e)}")
+                raise
+
+            add_count("SessionWriteConflict")
+            if attempt < max_attempts:
+                # Jittered, so writers that collided don't collide again on the next sequence.
+                time.sleep(random.uniform(0, backoff_seconds * 2 ** (attempt - 1)))
+                sequence = self.next_sequence(messages.session_id)
+
+        raise SessionWriteConflict(
+            f"Session {messages.session_id} is being written to concurrently, resend the turn"
+        )
+
+    def save_last_message(self, messages: Messages, sequence: Optional[int] = None, reserve_next: bool = False) -> int:
+        """Writes the last message in the conversation, see save_last_messages."""
+        return self.save_last_messages(messages, count=1, sequence=sequence, reserve_next=reserve_next)
+
+    def save_reserved_message(self, messages: Messages, sequence: int):
+        """
+        Writes the last message in the conversation over the reservation left at
+        sequence by save_last_message, so a response written after its prompt
+        stays next to it whatever other writers add to the session meanwhile.
+        Args:
+            messages (Messages) : The conversation to persist.
+            sequence (int) : The reserved sequence.
+
+        Raises:
+            SessionWriteConflict: When the sequence is no longer reserved.
+
+        """
+        item = serialize_item(self._message_item(messages, len(messages.messages) - 1, sequence))
         try:
-            ddb_resource = boto3.resource("dynamodb")
-            self.table = ddb_resource.Table(table_name)
+            with timed("DynamoDBPutItem"):
+                response = self.ddb_client.put_item(
+                    TableName=self.table_name,
+                    Item=item,
+                    ConditionExpression="attribute_exists(#reserved)",
+                    ExpressionAttributeNames={"#reserved": RESERVED_ATTRIBUTE},
+                    ReturnConsumedCapacity="TOTAL",
+                )
+            add_consumed_capacity("ConsumedWriteCapacity", response.get("ConsumedCapacity"))
+            self._mark_stored(messages, 1, sequence)
+        except ClientError as e:
+            if not is_write_conflict(e):
+                logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+                raise  # Re-raise the exception after logging
+            add_count("SessionWriteConflict")
+            raise SessionWriteConflict(
+                f"Session {messages.session_id} lost the sequence reserved for the response, resend the turn"
+            )
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
 
+    def save_turns(self, conversations: List[Messages], count: int = 2) -> List[Union[int, Exception]]:
+        """
+        Writes the last messages of many conversations in as few transactions
+        as possible.  A conversation whose sequences another writer already has
+        is written again on its own, after the session's latest message, and when
+        a transaction fails otherwise its conversations are each written on their
+        own, so only the ones that can't be written fail.
+        Args:
+            conversations (List[Messages]) : The conversations to persist.
+            count (int) : How many messages from the end of each conversation to write.
+
+        Returns:
+            results (List[Union[int, Exception]]): For each conversation, the sequence its first message was written at or the error it failed with.
+
+        """
+        results: List[Union[int, Exception]] = [0] * len(conversations)
+        per_transaction = max(TRANSACT_WRITE_LIMIT // max(count, 1), 1)
+        for start in range(0, len(conversations), per_transaction):
+            pending = list(range(start, min(start + per_transaction, len(conversations))))
+            while pending:
+                turns = {index: self._turn_items(conversations[index], count) for index in pending}
+                writes = [(index, item) for index in pending for item in turns[index][1]]
+                try:
+                    with timed("DynamoDBTransactWriteItems"):
+                        response = self.ddb_client.transact_write_items(
+                            TransactItems=[{"Put": self._new_item_put(item)} for _, item in writes],
+                            ReturnConsumedCapacity="TOTAL",
+                        )
+                    add_consumed_capacity("ConsumedWriteCapacity", response.get("ConsumedCapacity"))
+                    for index in pending:
+                        results[index] = turns[index][0]
+                        self._mark_stored(conversations[index], count, results[index])
+                    break
+                except ClientError as e:
+                    reasons = e.response.get("CancellationReasons", []) if is_write_conflict(e) else []
+                    # Cancellation reasons are in the order of the actions.
+                    conflicted = {
+                        index for (index, _), reason in zip(writes, reasons) if reason.get("Code") in CONFLICT_REASONS
+                    }
+                    if not conflicted:
+                        logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+                        self._save_each_turn(conversations, pending, count, results, e)
+                        break
+                except BotoCoreError as e:
+                    logger.error(f"Boto3 Core Error: {str(e)}")
+                    self._save_each_turn(conversations, pending, count, results, e)
+                    break
+
+                # The rest of the transaction is retried without them.
+                add_count("SessionWriteConflict", len(conflicted))
+                for index in sorted(conflicted):
+                    messages = conversations[index]
+                    try:
+                        results[index] = self.save_last_messages(
+                            messages, count=count, sequence=self.next_sequence(messages.session_id)
+                        )
+                    except (SessionWriteConflict, ClientError, BotoCoreError) as e:
+                        results[index] = e
+                pending = [index for index in pending if index not in conflicted]
+
+        return results
+
+    def _save_each_turn(
+        self,
+        conversations: List[Messages],
+        indexes: List[int],
+        count: int,
+        results: List[Union[int, Exception]],
+        error: Exception,
+    ):
+        """Writes the turns of a failed transaction one at a time, recording the result of each."""
+        if len(indexes) == 1:
+            results[indexes[0]] = error
+            return
+        add_count("SessionTransactionSplit")
+        for index in indexes:
+            try:
+                results[index] = self.save_last_messages(conversations[index], count=count)
+            except (SessionWriteConflict, ClientError, BotoCoreError) as e:
+                results[index] = e
+
+    def save_summary(self, session_id: str, summary: str, covers_through: int) -> bool:
+        """
+        Stores the session's rolling summary, unless a summary covering as many
+        messages was already written by a concurrent compaction.
+        Args:
+            session_id (str) : The session the summary belongs to.
+            summary (str) : The summary text.
+            covers_through (int) : Sequence of the last message folded into the summary.
+
+        Returns:
+            saved (bool): False when a newer summary is already stored.
+
+        """
+        try:
+            with timed("DynamoDBPutItem"):
+                response = self.ddb_client.put_item(
+                    TableName=self.table_name,
+                    Item=serialize_item(
+                        self._with_ttl(
+                            {
+                                "session_id": session_id,
+                                "sequence": SUMMARY_SEQUENCE,
+                                "summary": summary,
+                                "covers_through": covers_through,
+                            }
+                        )
+                    ),
+                    ConditionExpression="attribute_not_exists(covers_through) OR covers_through < :covers_through",
+                    ExpressionAttributeValues={":covers_through": {"N": str(covers_through)}},
+                    ReturnConsumedCapacity="TOTAL",
+                )
+            add_consumed_capacity("ConsumedWriteCapacity", response.get("ConsumedCapacity"))
         except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                logger.info(f"Session {session_id} already has a newer summary")
+                return False
             logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
             raise  # Re-raise the exception after logging
         except BotoCoreError as e:
             logger.error(f"Boto3 Core Error: {str(e)}")
             raise
-        except Exception as e:
-            logger.error(f"Unexpected error creating Bedrock client: {str(e)}")
+
+        return True
+
+    def get_session_state(self, session_id: str) -> Dict:
+        """
+        Reads the items kept below the messages, the rolling summary and the
+        archive marker, in one Query.
+        Returns:
+            state (Dict): summary and covers_through when the session was compacted, archived_through when items were archived.
+
+        """
+        try:
+            with timed("DynamoDBQuery"):
+                response = self.ddb_client.query(
+                    TableName=self.table_name,
+                    KeyConditionExpression="session_id = :session_id AND #sequence BETWEEN :archive AND :summary",
+                    ExpressionAttributeNames={"#sequence": "sequence"},
+                    ExpressionAttributeValues={
+                        ":session_id": {"S": session_id},
+                        ":archive": {"N": str(ARCHIVE_SEQUENCE)},
+                        ":summary": {"N": str(SUMMARY_SEQUENCE)},
+                    },
+                    ReturnConsumedCapacity="TOTAL",
+                )
+            add_consumed_capacity("ConsumedReadCapacity", response.get("ConsumedCapacity"))
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+
+        state = {}
+        for item in response["Items"]:
+            item = deserialize_item(item)
+            if item["sequence"] == SUMMARY_SEQUENCE:
+                state["summary"] = item["summary"]
+                state["covers_through"] = int(item["covers_through"])
+            else:
+                state["archived_through"] = int(item["archived_through"])
+        return state
+
+    def get_summary(self, session_id: str) -> Optional[Dict]:
+        """
+        Reads the session's rolling summary.
+        Returns:
+            summary (Optional[Dict]): The summary and covers_through, None if the session was never compacted.
+
+        """
+        state = self.get_session_state(session_id)
+        if "summary" not in state:
+            return None
+        return {"summary": state["summary"], "covers_through": state["covers_through"]}
+
+    def _restored_session_state(self, session_id: str) -> Dict:
+        """Reads the session state, restoring any archived items to the table first."""
+        state = self.get_session_state(session_id)
+        if "archived_through" in state and self.rehydrate is not None:
+            self.rehydrate(session_id)
+            state = self.get_session_state(session_id)
+        return state
+
+    def get_messages(self, session_id: str) -> Messages:
+        """
+        Reads the conversation history for a session back from the table, the
+        rolling summary and the messages after it when the session was compacted.
+        Archived items are restored to the table first.
+        Args:
+            session_id (str) : The session to read.
+
+        Returns:
+            messages (Messages): The messages in the session ordered by sequence.
+
+        """
+        state = self._restored_session_state(session_id)
+        messages = Messages(
+            session_id=session_id,
+            messages=[],
+            summary=state.get("summary"),
+            offset=state.get("covers_through", 0),
+        )
+        query_args = {
+            "TableName": self.table_name,
+            # Folded messages stay in the table but are never read back.
+            "KeyConditionExpression": "session_id = :session_id AND #sequence > :after",
+            "FilterExpression": NOT_RESERVED_FILTER,
+            "ExpressionAttributeNames": {"#sequence": "sequence", "#reserved": RESERVED_ATTRIBUTE},
+            "ExpressionAttributeValues": {
+                ":session_id": {"S": session_id},
+                ":after": {"N": str(messages.offset)},
+            },
+            "ScanIndexForward": True,
+            "ReturnConsumedCapacity": "TOTAL",
+        }
+        try:
+            # A single Query, following LastEvaluatedKey for sessions over 1 MB.
+            while True:
+                with timed("DynamoDBQuery"):
+                    response = self.ddb_client.query(**query_args)
+                add_consumed_capacity("ConsumedReadCapacity", response.get("ConsumedCapacity"))
+                for item in response["Items"]:
+                    data = decode_content(deserialize_item(item))
+                    message = MessageRecord.from_dict(data)
+                    message._sequence = int(data["sequence"])
+                    messages.append(message)
+                if "LastEvaluatedKey" not in response:
+                    break
+                query_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+
+        return messages
+
+    def query_messages(
+        self,
+        session_id: str,
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None,
+        ascending: bool = True,
+        fields: Optional[List[str]] = None,
+        consistent_read: bool = False,
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Reads one page of a session's stored messages, including any folded into
+        the rolling summary.  Archived items are restored to the table before the
+        first page.
+        Args:
+            session_id (str) : The session to read.
+            limit (int) : Most messages to return.
+            cursor (str) : Token from the previous page, None for the first page.
+            ascending (bool) : Oldest first when true, newest first otherwise.
+            fields (List[str]) : Attributes to return, from MESSAGE_FIELDS, None for all of them.
+            consistent_read (bool) : Use a strongly consistent read, at twice the read units.
+
+        Returns:
+            messages, cursor (List[Dict], Optional[str]): The page and the token for the next page, None on the last page.
+
+        Raises:
+            ValueError: When the cursor is invalid.
+
+        """
+        query_args = {
+            "TableName": self.table_name,
+            "KeyConditionExpression": "session_id = :session_id AND #sequence > :summary",
+            "FilterExpression": NOT_RESERVED_FILTER,
+            "ExpressionAttributeNames": {"#sequence": "sequence", "#reserved": RESERVED_ATTRIBUTE},
+            "ExpressionAttributeValues": {
+                ":session_id": {"S": session_id},
+                ":summary": {"N": str(SUMMARY_SEQUENCE)},
+            },
+            "ScanIndexForward": ascending,
+            "Limit": min(limit, MAX_PAGE_SIZE),
+            "ConsistentRead": consistent_read,
+            "ReturnConsumedCapacity": "TOTAL",
+        }
+        if cursor is not None:
+            query_args["ExclusiveStartKey"] = decode_cursor(cursor, session_id)
+        elif self.rehydrate is not None:
+            self._restored_session_state(session_id)
+        if fields is not None:
+            # Read units are charged on the whole item, projecting saves the transfer and decoding.
+            attributes = [attribute for field in fields for attribute in MESSAGE_FIELDS[field]]
+            query_args["ExpressionAttributeNames"].update(
+                {f"#{attribute}": attribute for attribute in attributes}
+            )
+            query_args["ProjectionExpression"] = ", ".join(f"#{attribute}" for attribute in attributes)
+        try:
+            with timed("DynamoDBQuery"):
+                response = self.ddb_client.query(**query_args)
+            add_consumed_capacity("ConsumedReadCapacity", response.get("ConsumedCapacity"))
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+
+        messages = []
+        for item in response["Items"]:
+            # Only the message fields, not table attributes such as the expiry time.
+            stored = decode_content(deserialize_item(item))
+            message = {field: stored[field] for field in fields or DEFAULT_MESSAGE_FIELDS if field in stored}
+            if "sequence" in message:
+                message["sequence"] = int(message["sequence"])
+            messages.append(message)
+        last_key = response.get("LastEvaluatedKey")
+        return messages, encode_cursor(last_key) if last_key else None
+
+    def get_items(self, session_id: str) -> List[Dict]:
+        """Reads every stored item of a session, the summary and messages but not the archive marker."""
+        items = []
+        query_args = {
+            "TableName": self.table_name,
+            "KeyConditionExpression": "session_id = :session_id AND #sequence >= :summary",
+            "ExpressionAttributeNames": {"#sequence": "sequence"},
+            "ExpressionAttributeValues": {
+                ":session_id": {"S": session_id},
+                ":summary": {"N": str(SUMMARY_SEQUENCE)},
+            },
+            "ReturnConsumedCapacity": "TOTAL",
+        }
+        try:
+            while True:
+                with timed("DynamoDBQuery"):
+                    response = self.ddb_client.query(**query_args)
+                add_consumed_capacity("ConsumedReadCapacity", response.get("ConsumedCapacity"))
+                items.extend(deserialize_item(item) for item in response["Items"])
+                if "LastEvaluatedKey" not in response:
+                    break
+                query_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+
+        return items
+
+    def put_items(self, session_id: str, records: List[Dict]):
+        """
+        Writes archived records back to the table with a fresh TTL.
+        Raises:
+            RuntimeError: When some of them could not be written.
+        """
+        requests = []
+        for record in records:
+            item = encode_content(record, self.compression_threshold_bytes) if "content" in record else dict(record)
+            item["session_id"] = session_id
+            requests.append({"PutRequest": {"Item": serialize_item(self._with_ttl(item))}})
+        if self._batch_write(requests):
+            raise RuntimeError(f"Could not restore every item of session {session_id}")
+
+    def delete_items(self, session_id: str, sequences: List[int]):
+        """
+        Deletes items once they are archived, or a prompt whose turn failed.
+        Raises:
+            RuntimeError: When some of them could not be deleted.
+        """
+        requests = [
+            {"DeleteRequest": {"Key": {"session_id": {"S": session_id}, "sequence": {"N": str(sequence)}}}}
+            for sequence in sequences
+        ]
+        if self._batch_write(requests):
+            raise RuntimeError(f"Could not delete every item of session {session_id}")
+
+    def mark_archived(self, session_id: str, archived_through: int):
+        """Records that items up to archived_through are in the archive, never lowering it."""
+        try:
+            self.ddb_client.put_item(
+                TableName=self.table_name,
+                Item=serialize_item(
+                    {"session_id": session_id, "sequence": ARCHIVE_SEQUENCE, "archived_through": archived_through}
+                ),
+                ConditionExpression="attribute_not_exists(archived_through) OR archived_through < :archived_through",
+                ExpressionAttributeValues={":archived_through": {"N": str(archived_through)}},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+
+    def clear_archived(self, session_id: str, archived_through: int):
+        """Removes the archive marker once restored, unless more items were archived meanwhile."""
+        try:
+            self.ddb_client.delete_item(
+                TableName=self.table_name,
+                Key={"session_id": {"S": session_id}, "sequence": {"N": str(ARCHIVE_SEQUENCE)}},
+                ConditionExpression="archived_through = :archived_through",
+                ExpressionAttributeValues={":archived_through": {"N": str(archived_through)}},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
             raise
 
-    def save_last_message(self, messages: Messages):
-        message: Message = messages.messages[-1]
+    def _idle_scan_position(self) -> Optional[dict]:
         try:
-            self.table.put_item(
-                Item={
-                    "session_id": messages.session_id,
-                    "sequence": len(messages.messages),
-                    "role": message.role.value,
-                    "content": [item.to_dict() for item in message.content]
-                }
+            response = self.ddb_client.get_item(
+                TableName=self.table_name,
+                Key={"session_id": {"S": IDLE_SCAN_SESSION}, "sequence": {"N": str(ARCHIVE_SEQUENCE)}},
+                ConsistentRead=True,
             )
         except ClientError as e:
             logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
             raise  # Re-raise the exception after logging
         except BotoCoreError as e:
             logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+        return response.get("Item", {}).get("resume_after", {}).get("M")
+
+    def _save_idle_scan_position(self, resume_after: Optional[dict]):
+        """Saves the key the next scan starts after, None once a pass reached the end of the table."""
+        key = {"session_id": {"S": IDLE_SCAN_SESSION}, "sequence": {"N": str(ARCHIVE_SEQUENCE)}}
+        try:
+            if resume_after is None:
+                self.ddb_client.delete_item(TableName=self.table_name, Key=key)
+            else:
+                self.ddb_client.put_item(TableName=self.table_name, Item=dict(key, resume_after={"M": resume_after}))
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+
+    def idle_sessions(
+        self,
+        idle_seconds: int,
+        page_size: Optional[int] = None,
+        reserve_ms: float = DEFAULT_SCAN_RESERVE_MS,
+    ) -> Iterator[str]:
+        """
+        Scans for sessions with no writes in the last idle_seconds, judged by the
+        newest item's expires_at.  Items written before TTL was enabled count as idle.
+
+        A pass over a large table takes more than one invocation, so the scan
+        resumes where the last one stopped.  The position is saved after each
+        page and cleared once the pass reaches the end of the table, and the scan
+        stops early when the invocation deadline is near.  Sessions after the
+        saved position can be yielded again by the next scan.
+        Args:
+            idle_seconds (int) : How long a session has had no writes.
+            page_size (int) : Items read per Scan call, None for DynamoDB's 1 MB pages.
+            reserve_ms (float) : Time left in the invocation at which to stop.
+
+        """
+        written_before = int(time.time()) + (self.ttl_seconds or 0) - idle_seconds
+        scan_args = {
+            "TableName": self.table_name,
+            "ProjectionExpression": "session_id, #sequence, expires_at",
+            "ExpressionAttributeNames": {"#sequence": "sequence"},
+        }
+        if page_size is not None:
+            scan_args["Limit"] = page_size
+        resume_after = self._idle_scan_position()
+        if resume_after is not None:
+            scan_args["ExclusiveStartKey"] = resume_after
+
+        # A session's items are scanned together, so it is complete once the next
+        # session's items start.  The one a page ends in carries over to the next page.
+        session_id, newest, last_key = None, 0, None
+        while True:
+            try:
+                with timed("DynamoDBScan"):
+                    response = self.ddb_client.scan(**scan_args)
+            except ClientError as e:
+                logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+                raise  # Re-raise the exception after logging
+            except BotoCoreError as e:
+                logger.error(f"Boto3 Core Error: {str(e)}")
+                raise
+
+            completed_key = None
+            for item in response["Items"]:
+                item = deserialize_item(item)
+                if item["sequence"] == ARCHIVE_SEQUENCE:
+                    continue
+                if item["session_id"] != session_id:
+                    if session_id is not None:
+                        completed_key = last_key
+                        if newest <= written_before:
+                            yield session_id
+                    session_id, newest = item["session_id"], 0
+                newest = max(newest, int(item.get("expires_at", 0)))
+                last_key = {"session_id": {"S": session_id}, "sequence": {"N": str(item["sequence"])}}
+            if "LastEvaluatedKey" not in response:
+                break
+            if completed_key is not None:
+                self._save_idle_scan_position(completed_key)
+            if not deadline_allows(reserve_ms):
+                logger.info("Stopping the idle session scan near the deadline, the next scan resumes it")
+                return
+            scan_args["ExclusiveStartKey"] = response["LastEvaluatedKey"]
 
-        return message
\ No newline at end of file
+        if session_id is not None and newest <= written_before:
+            yield session_id
+        self._save_idle_scan_position(None)
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import time
+from enum import Enum
+from typing import Callable, Dict, Optional
+
+from aws_lambda_powertools import Logger
+from botocore.exceptions import ClientError, BotoCoreError
+
+import aws_clients
+from dynamodb import serialize_item, deserialize_item
+from resilience import ServiceUnavailable, remaining_ms
+from telemetry import add_count
+
+logger = Logger()
+
+# Long enough to cover a client's retries, records are removed by DynamoDB TTL after it.
+DEFAULT_IDEMPOTENCY_TTL_SECONDS = 3600
+# How long a request stays in flight outside Lambda, or when the deadline is unknown,
+# before a retry may take it over as the container running it has gone.
+DEFAULT_IN_PROGRESS_SECONDS = 60
+
+
+class IdempotencyStatus(str, Enum):
+    IN_PROGRESS = "in_progress"
+    COMPLETED = "completed"
+
+
+class RequestInProgress(ServiceUnavailable):
+    """A duplicate of the request is still running, returned as a 409 so the client retries later."""
+
+    status_code = 409
+
+
+class IdempotencyKeyReused(ValueError):
+    """The idempotency key was already used for a request with a different body."""
+
+
+def request_fingerprint(request: Dict) -> str:
+    """Hash of the request body, independent of key order and whitespace."""
+    encoded = json.dumps(request, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Records the response to each request by idempotency key so a retried
+    request gets the first response back instead of generating another.  A
+    request is marked in progress with a conditional write before it runs, so
+    only one of several concurrent duplicates runs and the others get a 409.
+    Records are removed by DynamoDB TTL on the expires_at attribute.
+    """
+
+    def __init__(self, table_name: str, ttl_seconds: int = DEFAULT_IDEMPOTENCY_TTL_SECONDS):
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+        self._ddb_client = None
+
+    @property
+    def ddb_client(self):
+        if self._ddb_client is None:
+            try:
+                self._ddb_client = aws_clients.client("dynamodb")
+            except Exception as e:
+                logger.error(f"Error initializing idempotency table: {e}")
+                raise
+        return self._ddb_client
+
+    def start(self, key: str, fingerprint: str) -> Optional[str]:
+        """
+        Marks the request in progress, unless the key has already been used.
+
+        Args:
+            key: The idempotency key.
+            fingerprint: Hash of the request, a key is only replayed for the same request.
+
+        Returns:
+            The recorded response when the request already completed, otherwise
+            None and the caller runs it.
+
+        Raises:
+            RequestInProgress: A duplicate is still running.
+            IdempotencyKeyReused: The key was used for a different request.
+        """
+        now = int(time.time())
+        # In flight for as long as the invocation can run, then a retry may take over.
+        remaining = remaining_ms()
+        in_progress_seconds = remaining / 1000 if remaining is not None else DEFAULT_IN_PROGRESS_SECONDS
+        try:
+            self.ddb_client.put_item(
+                TableName=self.table_name,
+                Item=serialize_item(
+                    {
+                        "idempotency_key": key,
+                        "status": IdempotencyStatus.IN_PROGRESS.value,
+                        "fingerprint": fingerprint,
+                        "in_progress_until": now + max(int(in_progress_seconds), 1),
+                        "expires_at": now + self.ttl_seconds,
+                    }
+                ),
+                # TTL deletion is lazy, so expired records can still be in the table.
+                ConditionExpression=(
+                    "attribute_not_exists(idempotency_key) OR expires_at <= :now"
+                    " OR (#status = :in_progress AND in_progress_until <= :now)"
+                ),
+                ExpressionAttributeNames={"#status": "status"},
+                ExpressionAttributeValues=serialize_item(
+                    {":now": now, ":in_progress": IdempotencyStatus.IN_PROGRESS.value}
+                ),
+                ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            )
+            return None
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                # Idempotency guards against double work, don't fail the request without it.
+                logger.warning(f"Idempotency record write failed: {e}")
+                return None
+            existing = deserialize_item(e.response["Item"])
+        except BotoCoreError as e:
+            logger.warning(f"Idempotency record write failed: {e}")
+            return None
+
+        if existing["fingerprint"] != fingerprint:
+            raise IdempotencyKeyReused("The idempotency key was already used for a different request")
+        if existing["status"] == IdempotencyStatus.COMPLETED.value:
+            add_count("IdempotentReplay")
+            return existing["response"]
+        add_count("IdempotencyConflict")
+        raise RequestInProgress(
+            "A request with this idempotency key is in progress",
+            retry_after_seconds=min(int(existing["in_progress_until"]) - now, DEFAULT_IN_PROGRESS_SECONDS),
+        )
+
+    def complete(self, key: str, fingerprint: str, response: str):
+        """Records the response duplicates of the request get back."""
+        try:
+            self.ddb_client.put_item(
+                TableName=self.table_name,
+                Item=serialize_item(
+                    {
+                        "idempotency_key": key,
+                        "status": IdempotencyStatus.COMPLETED.value,
+                        "fingerprint": fingerprint,
+                        "response": response,
+                        "expires_at": int(time.time()) + self.ttl_seconds,
+                    }
+                ),
+            )
+        except (ClientError, BotoCoreError) as e:
+            # The response is still returned, a retry would just run again.
+            logger.warning(f"Idempotency record write failed: {e}")
+
+    def release(self, key: str):
+        """Removes the in progress marker of a request that failed, so it can be retried."""
+        try:
+            self.ddb_client.delete_item(
+                TableName=self.table_name,
+                Key={"idempotency_key": {"S": key}},
+                ConditionExpression="#status = :in_progress",
+                ExpressionAttributeNames={"#status": "status"},
+                ExpressionAttributeValues={":in_progress": {"S": IdempotencyStatus.IN_PROGRESS.value}},
+            )
+        except (ClientError, BotoCoreError) as e:
+            logger.warning(f"Idempotency record release failed: {e}")
+
+    def run(self, key: str, fingerprint: str, function: Callable[[], str]) -> str:
+        """
+        Returns the recorded response for the key, or runs function once and
+        records the response it returns.
+        """
+        response = self.start(key, fingerprint)
+        if response is not None:
+            return response
+        try:
+            response = function()
+        except Exception:
+            self.release(key)
+            raise
+        self.complete(key, fingerprint, response)
+        return response
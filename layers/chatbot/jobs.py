@@ -0,0 +1,251 @@
+import json
+import time
+from collections import deque
+from enum import Enum
+from typing import Callable, Dict, List, Optional, Protocol
+from uuid import uuid4
+
+from aws_lambda_powertools import Logger
+from botocore.exceptions import ClientError, BotoCoreError
+
+import aws_clients
+from dynamodb import serialize_item, deserialize_item
+from models import ContentItem, Message, Messages
+from resilience import ServiceUnavailable
+
+logger = Logger()
+
+# Finished jobs are removed by DynamoDB TTL after a day.
+DEFAULT_JOB_TTL_SECONDS = 86400
+# SQS rejects message bodies over 256 KB.
+MAX_JOB_PAYLOAD_BYTES = 256 * 1024
+
+
+class JobStatus(Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+def new_job(
+    system_prompts: List[Dict],
+    session_id: str,
+    prompt: str,
+    messages: Optional[List[Dict]] = None,
+    use_cache: bool = True,
+) -> Dict:
+    """Builds the queue payload for a turn, messages is None to use the server side history."""
+    return {
+        "job_id": uuid4().hex,
+        "system_prompts": system_prompts,
+        "session_id": session_id,
+        "prompt": prompt,
+        "messages": messages,
+        "use_cache": use_cache,
+    }
+
+
+class JobTooLarge(ValueError):
+    """The turn doesn't fit in a queue message, typically a long history sent with the request."""
+
+
+def check_payload_size(job: Dict):
+    """
+    Raises:
+        JobTooLarge: When the job is over the queue's message size limit.
+    """
+    size = len(json.dumps(job).encode("utf-8"))
+    if size > MAX_JOB_PAYLOAD_BYTES:
+        raise JobTooLarge(
+            f"The request is {size} bytes, over the {MAX_JOB_PAYLOAD_BYTES} byte limit for async turns, "
+            "send it without messages to use the server side history"
+        )
+
+
+def new_compaction_job(session_id: str) -> Dict:
+    """Builds the queue payload asking the worker to compact a session, these have no job record."""
+    return {"job_id": uuid4().hex, "type": "compact", "session_id": session_id}
+
+
+class JobQueue(Protocol):
+    def send(self, job: Dict): ...
+
+
+class SQSJobQueue:
+    def __init__(self, queue_url: str):
+        self.queue_url = queue_url
+        self._sqs_client = None
+
+    @property
+    def sqs_client(self):
+        if self._sqs_client is None:
+            try:
+                self._sqs_client = aws_clients.client("sqs")
+            except Exception as e:
+                logger.error(f"Error initializing SQS client: {e}")
+                raise
+        return self._sqs_client
+
+    def send(self, job: Dict):
+        try:
+            self.sqs_client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(job))
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+
+
+class LocalJobQueue:
+    """In process stand in for SQS, jobs wait until drained by a worker."""
+
+    def __init__(self):
+        self.jobs = deque()
+
+    def send(self, job: Dict):
+        # Round trip through JSON like a real queue message.
+        self.jobs.append(json.dumps(job))
+
+    def drain(self, handler: Callable[[Dict], None]):
+        while self.jobs:
+            handler(json.loads(self.jobs.popleft()))
+
+
+class JobStore:
+    """Status and result of each job, keyed by job_id."""
+
+    def __init__(self, table_name: str, ttl_seconds: int = DEFAULT_JOB_TTL_SECONDS):
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+        self._ddb_client = None
+
+    @property
+    def ddb_client(self):
+        if self._ddb_client is None:
+            try:
+                self._ddb_client = aws_clients.client("dynamodb")
+            except Exception as e:
+                logger.error(f"Error initializing jobs table: {e}")
+                raise
+        return self._ddb_client
+
+    def put(self, job: Dict):
+        now = int(time.time())
+        try:
+            self.ddb_client.put_item(
+                TableName=self.table_name,
+                Item=serialize_item(
+                    {
+                        "job_id": job["job_id"],
+                        "session_id": job["session_id"],
+                        "status": JobStatus.PENDING.value,
+                        "created_at": now,
+                        "updated_at": now,
+                        "expires_at": now + self.ttl_seconds,
+                    }
+                ),
+            )
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+
+    def update(self, job_id: str, status: JobStatus, result: Optional[Dict] = None, error: Optional[Dict] = None):
+        expression = "SET #status = :status, updated_at = :updated_at"
+        names = {"#status": "status"}
+        values = {":status": status.value, ":updated_at": int(time.time())}
+        # result and error are reserved words so they need names too.
+        for name, value in (("result", result), ("error", error)):
+            if value is not None:
+                expression += f", #{name} = :{name}"
+                names[f"#{name}"] = name
+                values[f":{name}"] = value
+        try:
+            self.ddb_client.update_item(
+                TableName=self.table_name,
+                Key={"job_id": {"S": job_id}},
+                UpdateExpression=expression,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=serialize_item(values),
+            )
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        try:
+            response = self.ddb_client.get_item(
+                TableName=self.table_name, Key={"job_id": {"S": job_id}}
+            )
+        except ClientError as e:
+            logger.error(f"AWS Client Error: {e.response['Error']['Message']}")
+            raise  # Re-raise the exception after logging
+        except BotoCoreError as e:
+            logger.error(f"Boto3 Core Error: {str(e)}")
+            raise
+        if "Item" not in response:
+            return None
+        item = deserialize_item(response["Item"])
+        # Numbers come back as Decimal, the API returns plain JSON.
+        for key in ("created_at", "updated_at", "expires_at"):
+            item[key] = int(item[key])
+        return item
+
+
+class JobWorker:
+    """Runs queued turns through the chatbot, recording progress on the job."""
+
+    def __init__(self, chatbot, store: JobStore):
+        self.chatbot = chatbot
+        self.store = store
+
+    def process(self, job: Dict):
+        if job.get("type") == "compact":
+            # Compaction is idempotent, a redelivered job finds nothing left to fold.
+            self.chatbot.compact_session(job["session_id"])
+            return
+
+        existing = self.store.get(job["job_id"])
+        if existing is not None and existing["status"] == JobStatus.SUCCEEDED.value:
+            # Queues deliver at least once, don't add the turn to the history twice.
+            logger.info("Skipping job that already succeeded", job_id=job["job_id"])
+            return
+
+        self.store.update(job["job_id"], JobStatus.RUNNING)
+        try:
+            if job.get("messages") is None:
+                messages = self.chatbot.get_history(job["session_id"])
+            else:
+                messages = Messages.from_message_list(
+                    job["session_id"], [Message.from_dict(message) for message in job["messages"]]
+                )
+            messages.append(Message(role="user", content=[ContentItem(text=job["prompt"])]))
+            messages = self.chatbot.converse(
+                job["system_prompts"], messages, use_cache=job.get("use_cache", True)
+            )
+        except ServiceUnavailable as e:
+            # Leave it to the queue to redeliver once the model has capacity.
+            logger.warning("Job throttled, will be retried", job_id=job["job_id"], reason=str(e))
+            self.store.update(job["job_id"], JobStatus.PENDING)
+            raise
+        except Exception as e:
+            logger.exception("Job failed", job_id=job["job_id"])
+            self.store.update(
+                job["job_id"], JobStatus.FAILED, error={"error": type(e).__name__, "message": str(e)}
+            )
+            return
+
+        self.store.update(
+            job["job_id"],
+            JobStatus.SUCCEEDED,
+            result={"session_id": messages.session_id, "message": messages.messages[-1].to_record()},
+        )
+        if job.get("messages") is None:
+            self.chatbot.maybe_compact(messages)
@@ -1,7 +1,8 @@
+import json
 from uuid import uuid4
 from enum import Enum
-from pydantic import BaseModel, Field
-from typing import List, Dict, Optional
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, field_validator
+from typing import List, Dict, Optional, Union
 
 class Role(Enum):
     USER = 'user'
@@ -18,6 +19,12 @@ class ContentItem(BaseModel):
 class Message(BaseModel):
     role: Role = Role.USER 
     content: List[ContentItem]
+    # Pinned messages are always kept when the context window is trimmed.
+    pinned: bool = False
+    # Estimated token count, filled in lazily by the context window.
+    _token_count: Optional[int] = PrivateAttr(default=None)
+    # Where the message is stored in the session, once it is.
+    _sequence: Optional[int] = PrivateAttr(default=None)
 
     def to_dict(self) -> Dict:
         return {
@@ -29,16 +36,114 @@ class Message(BaseModel):
     def from_dict(cls, data: Dict) -> 'Message':
         return cls(
             role=Role(data['role']),
-            content=[ContentItem(**item) for item in data['content']]
+            content=[ContentItem(**item) for item in data['content']],
+            pinned=data.get('pinned', False)
         )
 
-class Messages(BaseModel):
-    session_id: str
-    messages: List[Message]
+    def to_record(self) -> Dict:
+        # to_dict plus the attributes we store but don't send to the model.
+        record = self.to_dict()
+        if self.pinned:
+            record['pinned'] = True
+        return record
 
-    def append(self, message: Message):
+# Pydantic models are used to validate data at the API boundary (Event).  Data we
+# produced ourselves, items read back from our table, cached responses and
+# Bedrock's response, is decoded straight into these compact slotted records
+# which mirror the Message / ContentItem interface without re-validating it.
+
+class ContentRecord:
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def to_dict(self) -> Dict:
+        return {
+            'text': self.text
+        }
+
+class MessageRecord:
+    __slots__ = ('role', 'content', 'pinned', 'model_id', '_token_count', '_sequence')
+
+    def __init__(
+        self,
+        role: Role,
+        content: List[ContentRecord],
+        pinned: bool = False,
+        model_id: Optional[str] = None
+    ):
+        self.role = role
+        self.content = content
+        self.pinned = pinned
+        # The model that generated an assistant message, stored for per model analysis.
+        self.model_id = model_id
+        self._token_count = None
+        self._sequence = None
+
+    def to_dict(self) -> Dict:
+        return {
+            'role': self.role.value,
+            'content': [item.to_dict() for item in self.content]
+        }
+
+    def to_record(self) -> Dict:
+        record = self.to_dict()
+        if self.pinned:
+            record['pinned'] = True
+        if self.model_id:
+            record['model_id'] = self.model_id
+        return record
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'MessageRecord':
+        return cls(
+            Role(data['role']),
+            [ContentRecord(item['text']) for item in data['content']],
+            data.get('pinned', False),
+            data.get('model_id')
+        )
+
+class Messages:
+    """
+    A conversation, internal to the chatbot so it is a plain slotted class rather
+    than a pydantic model.  Messages may be validated Message models (from the
+    request) or MessageRecords (from trusted sources).
+    """
+    __slots__ = ('session_id', 'messages', 'summary', 'offset')
+
+    def __init__(
+        self,
+        session_id: str,
+        messages: List[Union[Message, MessageRecord]],
+        summary: Optional[str] = None,
+        offset: int = 0
+    ):
+        self.session_id = session_id
+        self.messages = messages
+        # Once a session is compacted, the summary of the turns folded into it
+        # and the number of stored messages it covers, which the messages follow.
+        self.summary = summary
+        self.offset = offset
+
+    def copy(self) -> 'Messages':
+        return Messages(self.session_id, list(self.messages), self.summary, self.offset)
+
+    def append(self, message: Union[Message, MessageRecord]):
         self.messages.append(message)
 
+    def sequence_after(self, index: int) -> int:
+        """
+        Where the message at index is stored when it directly follows the
+        messages before it, counted on from the last one that is stored, as
+        sequences can have gaps.
+        """
+        for position in range(index - 1, -1, -1):
+            sequence = self.messages[position]._sequence
+            if sequence is not None:
+                return sequence + index - position
+        return self.offset + index + 1
+
     @classmethod
     def from_message_list(cls, session_id: str, messages: List[Message]) -> 'Messages':
         return cls(session_id=session_id, messages=messages)
@@ -48,10 +153,39 @@ class Messages(BaseModel):
             'messages': [message.to_dict() for message in self.messages]
         }
 
+    def to_record(self) -> Dict:
+        record = {
+            'session_id': self.session_id,
+            'messages': [message.to_record() for message in self.messages]
+        }
+        if self.summary is not None:
+            record['summary'] = self.summary
+        return record
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_record())
+
+    @classmethod
+    def from_json(cls, data: str) -> 'Messages':
+        # Trusted data only, the messages are not validated.
+        decoded = json.loads(data)
+        return cls(
+            session_id=decoded['session_id'],
+            messages=[MessageRecord.from_dict(message) for message in decoded['messages']],
+            summary=decoded.get('summary')
+        )
+
 class Event(BaseModel):
     session_id: Optional[str] = Field(default_factory=lambda: uuid4().hex)
     prompt: str
-    messages: List[Message]
+    # When omitted the conversation history is loaded server side from the session_id.
+    messages: Optional[List[Message]] = None
+    # Set to false to always call the model rather than return a cached response.
+    use_cache: bool = True
+    # Set to true to queue the turn and poll GET /jobs/{job_id} for the result.
+    async_: bool = Field(default=False, alias='async')
+
+    model_config = ConfigDict(populate_by_name=True)
 
     # def to_dict(self) -> Dict:
     #     return {
@@ -63,3 +197,19 @@ class Event(BaseModel):
     #     return cls(messages=messages)
 
 
+
+
+# Largest number of turns accepted by a single batch request.
+MAX_BATCH_ITEMS = 25
+
+class BatchEvent(BaseModel):
+    items: List[Event] = Field(..., min_length=1, max_length=MAX_BATCH_ITEMS)
+
+    @field_validator('items')
+    @classmethod
+    def unique_sessions(cls, items: List[Event]) -> List[Event]:
+        # Turns in a batch run concurrently so two can't extend the same session.
+        session_ids = [item.session_id for item in items]
+        if len(set(session_ids)) != len(session_ids):
+            raise ValueError('each item in a batch must have a different session_id')
+        return items
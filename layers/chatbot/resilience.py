@@ -0,0 +1,219 @@
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+from math import ceil
+from threading import Lock
+from typing import Any, Callable, Optional, Tuple
+
+from aws_lambda_powertools import Logger
+from botocore.exceptions import (
+    ClientError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
+
+from telemetry import add_count
+
+logger = Logger()
+
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BASE_DELAY_SECONDS = 0.25
+DEFAULT_MAX_DELAY_SECONDS = 4.0
+# Time kept back from the function timeout to build and return an error response.
+DEFAULT_RESERVE_MS = 2000
+
+DEFAULT_FAILURE_RATE_THRESHOLD = 0.5
+DEFAULT_WINDOW_SIZE = 20
+DEFAULT_MINIMUM_CALLS = 10
+DEFAULT_OPEN_SECONDS = 30
+
+
+class ServiceUnavailable(Exception):
+    """A dependency can't serve the request right now, returned to the caller as a 503."""
+
+    status_code = 503
+
+    def __init__(self, message: str, retry_after_seconds: float = 1):
+        super().__init__(message)
+        self.retry_after_seconds = retry_after_seconds
+
+    @property
+    def retry_after(self) -> str:
+        # The Retry-After header is in whole seconds.
+        return str(max(ceil(self.retry_after_seconds), 1))
+
+
+class Throttled(ServiceUnavailable):
+    """Still throttled once the retries ran out, returned as a 429."""
+
+    status_code = 429
+
+
+class CircuitOpen(ServiceUnavailable):
+    """Shed without calling the dependency as it has been failing."""
+
+
+# Error codes worth retrying and the error raised once the retries run out.
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException": Throttled,
+    "TooManyRequestsException": Throttled,
+    "ServiceUnavailableException": ServiceUnavailable,
+    "ModelNotReadyException": ServiceUnavailable,
+    "InternalServerException": ServiceUnavailable,
+}
+# Timeouts and connection failures never reached the model or got no answer, also worth retrying.
+RETRYABLE_EXCEPTIONS = (ConnectTimeoutError, ReadTimeoutError, EndpointConnectionError)
+
+# Monotonic time the current invocation has to finish by, when running in Lambda.
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+def start_deadline(remaining_ms: Optional[int]):
+    """Sets the deadline for the current invocation, from context.get_remaining_time_in_millis()."""
+    _deadline.set(time.monotonic() + remaining_ms / 1000 if remaining_ms is not None else None)
+
+
+def remaining_ms() -> Optional[float]:
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return (deadline - time.monotonic()) * 1000
+
+
+def deadline_allows(milliseconds: float) -> bool:
+    remaining = remaining_ms()
+    return remaining is None or remaining >= milliseconds
+
+
+class RetryPolicy:
+    """
+    Retries throttling and transient server errors with full jitter exponential
+    backoff, but only while the invocation deadline leaves time for another
+    attempt plus the reserve needed to return a clean error response.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        base_delay_seconds: float = DEFAULT_BASE_DELAY_SECONDS,
+        max_delay_seconds: float = DEFAULT_MAX_DELAY_SECONDS,
+        reserve_ms: float = DEFAULT_RESERVE_MS,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.reserve_ms = reserve_ms
+        self.sleep = sleep
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self.max_delay_seconds, self.base_delay_seconds * 2 ** (attempt - 1))
+        )
+
+    def call(self, function: Callable, *args, **kwargs) -> Tuple[Any, int]:
+        """
+        Calls the function, retrying retryable errors.
+        Returns:
+            result, retries: The function's result and how many retries it took.
+
+        Raises:
+            Throttled / ServiceUnavailable: Once retries are exhausted or the deadline is too close.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            start = time.monotonic()
+            try:
+                return function(*args, **kwargs), attempt - 1
+            except ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code not in RETRYABLE_ERROR_CODES:
+                    raise
+                error, unavailable = e, RETRYABLE_ERROR_CODES[code]
+            except RETRYABLE_EXCEPTIONS as e:
+                code = type(e).__name__
+                error, unavailable = e, ServiceUnavailable
+
+            delay = self.backoff(attempt)
+            # Assume the next attempt takes as long as the last one did.
+            needed_ms = delay * 1000 + (time.monotonic() - start) * 1000 + self.reserve_ms
+            if attempt == self.max_attempts or not deadline_allows(needed_ms):
+                logger.warning(f"Giving up after {attempt} attempts: {error}")
+                raise unavailable(
+                    f"{code} after {attempt} attempts",
+                    retry_after_seconds=self.base_delay_seconds * 2 ** attempt,
+                ) from error
+            logger.info(f"Retrying in {delay:.3f}s after {code}")
+            self.sleep(delay)
+
+
+class CircuitBreaker:
+    """
+    Per container circuit breaker.  Once the failure rate over the recent calls
+    crosses the threshold, calls are shed straight away for open_seconds, then a
+    single probe call decides whether to close the circuit again.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_rate_threshold: float = DEFAULT_FAILURE_RATE_THRESHOLD,
+        window_size: int = DEFAULT_WINDOW_SIZE,
+        minimum_calls: int = DEFAULT_MINIMUM_CALLS,
+        open_seconds: float = DEFAULT_OPEN_SECONDS,
+    ):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.minimum_calls = minimum_calls
+        self.open_seconds = open_seconds
+        self._outcomes = deque(maxlen=window_size)
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.open_seconds - time.monotonic()
+            if remaining <= 0 and not self._probing:
+                # Half open, let this call through to probe the dependency.
+                self._probing = True
+                return
+        add_count("CircuitOpen")
+        raise CircuitOpen(
+            f"Circuit for {self.name} is open", retry_after_seconds=max(remaining, 1)
+        )
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"Closing circuit for {self.name}")
+                self._outcomes.clear()
+            self._opened_at = None
+            self._probing = False
+            self._outcomes.append(False)
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(True)
+            if self._probing:
+                # The probe failed, stay open for another period.
+                self._opened_at = time.monotonic()
+                self._probing = False
+                return
+            failures = sum(self._outcomes)
+            if (
+                self._opened_at is None
+                and len(self._outcomes) >= self.minimum_calls
+                and failures / len(self._outcomes) >= self.failure_rate_threshold
+            ):
+                logger.warning(
+                    f"Opening circuit for {self.name}, {failures} of the last {len(self._outcomes)} calls failed"
+                )
+                self._opened_at = time.monotonic()
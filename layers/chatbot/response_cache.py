@@ -0,0 +1,148 @@
+import hashlib
+import json
+import time
+from typing import Dict, Optional
+
+from aws_lambda_powertools import Logger
+from botocore.exceptions import ClientError, BotoCoreError
+
+import aws_clients
+from background import BackgroundWriter
+from dynamodb import serialize_item, deserialize_item
+from lru import LRUCache
+from telemetry import add_count
+
+logger = Logger()
+
+DEFAULT_RESPONSE_CACHE_SIZE = 256
+DEFAULT_RESPONSE_CACHE_TTL_SECONDS = 3600
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def cache_key(converse_args: Dict) -> str:
+    """
+    Builds a canonical hash of everything that determines the model response,
+    the model id, system prompts, inference configuration and messages.  Message
+    text is whitespace normalized so trivially different prompts share an entry.
+    """
+    canonical = {
+        "modelId": converse_args["modelId"],
+        "system": [_normalize_text(prompt.get("text", "")) for prompt in converse_args["system"]],
+        "inferenceConfig": converse_args.get("inferenceConfig", {}),
+        "additionalModelRequestFields": converse_args.get("additionalModelRequestFields", {}),
+        "messages": [
+            [message["role"]] + [_normalize_text(item.get("text", "")) for item in message["content"]]
+            for message in converse_args["messages"]
+        ],
+    }
+    encoded = json.dumps(canonical, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def namespace_key(converse_args: Dict) -> str:
+    """Hash of the request without its messages, used to scope semantic cache matches."""
+    return cache_key(dict(converse_args, messages=[]))
+
+
+class DynamoDBResponseCache:
+    """Shared cache tier, items are removed by DynamoDB TTL on the expires_at attribute."""
+
+    def __init__(self, table_name: str, ttl_seconds: int = DEFAULT_RESPONSE_CACHE_TTL_SECONDS):
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+        self._ddb_client = None
+
+    @property
+    def ddb_client(self):
+        if self._ddb_client is None:
+            try:
+                self._ddb_client = aws_clients.client("dynamodb")
+            except Exception as e:
+                logger.error(f"Error initializing response cache table: {e}")
+                raise
+        return self._ddb_client
+
+    def get(self, key: str) -> Optional[Dict]:
+        try:
+            response = self.ddb_client.get_item(
+                TableName=self.table_name, Key={"cache_key": {"S": key}}
+            )
+        except (ClientError, BotoCoreError) as e:
+            # The cache is an optimisation, fall through to the model on errors.
+            logger.warning(f"Response cache read failed: {e}")
+            return None
+        if "Item" not in response:
+            return None
+        item = deserialize_item(response["Item"])
+        # TTL deletion is lazy so expired items can still be returned by a read.
+        if item["expires_at"] <= int(time.time()):
+            return None
+        return item["message"]
+
+    def put(self, key: str, message: Dict, raise_errors: bool = False):
+        try:
+            self.ddb_client.put_item(
+                TableName=self.table_name,
+                Item=serialize_item(
+                    {
+                        "cache_key": key,
+                        "message": message,
+                        "expires_at": int(time.time()) + self.ttl_seconds,
+                    }
+                ),
+            )
+        except (ClientError, BotoCoreError) as e:
+            if raise_errors:
+                raise
+            logger.warning(f"Response cache write failed: {e}")
+
+
+class ResponseCache:
+    """
+    Exact match cache of model responses with an in process LRU tier, which
+    survives across warm invocations, in front of an optional shared DynamoDB tier.
+    """
+
+    def __init__(
+        self,
+        max_size: int = DEFAULT_RESPONSE_CACHE_SIZE,
+        ttl_seconds: int = DEFAULT_RESPONSE_CACHE_TTL_SECONDS,
+        table_name: Optional[str] = None,
+        writer: Optional[BackgroundWriter] = None,
+    ):
+        self.local = LRUCache(max_size, ttl_seconds=ttl_seconds)
+        # When set, shared tier writes happen in the background off the request path.
+        self.writer = writer
+        self.shared = DynamoDBResponseCache(table_name, ttl_seconds) if table_name else None
+
+    def get(self, key: str) -> Optional[Dict]:
+        message = self.local.get(key)
+        if message is not None:
+            # The tier is in the name, like the other per outcome counts.
+            add_count("ResponseCacheLocalHit")
+            logger.info("Response cache hit", cache_tier="local")
+            return message
+
+        if self.shared is not None:
+            message = self.shared.get(key)
+            if message is not None:
+                add_count("ResponseCacheSharedHit")
+                self.local.put(key, message)
+                logger.info("Response cache hit", cache_tier="shared")
+                return message
+
+        add_count("ResponseCacheMiss")
+        logger.info("Response cache miss")
+        return None
+
+    def put(self, key: str, message: Dict):
+        self.local.put(key, message)
+        if self.shared is None:
+            return
+        if self.writer is not None:
+            self.writer.submit(self.shared.put, key, message, raise_errors=True)
+        else:
+            self.shared.put(key, message)
@@ -0,0 +1,190 @@
+"""
+Retrieval of reference passages for the model from a document index that is
+built offline and packaged in the layer, e.g.
+
+    PYTHONPATH=layers/chatbot python layers/chatbot/retrieval.py docs layers/chatbot/retrieval_index/documents
+
+Documents are split into passages of whole paragraphs, embedded and saved in
+the VectorIndex format, vectors that are memory mapped on load and a JSON list
+of the passages.  Rebuilding only embeds documents that were added or changed
+since the last build, recognised by a digest of their text.
+"""
+import hashlib
+import os
+import re
+import sys
+from typing import Dict, List, Optional
+
+import numpy as np
+from aws_lambda_powertools import Logger
+
+from telemetry import add_count, timed
+from vector_index import Embedder, HashingEmbedder, VectorIndex
+
+logger = Logger()
+
+DEFAULT_CHUNK_CHARS = 1000
+DEFAULT_TOP_K = 3
+# Hashing embedder similarity below which a passage is unrelated to the prompt.
+DEFAULT_MIN_SCORE = 0.2
+# Files read when building from a directory.
+DOCUMENT_SUFFIXES = (".md", ".txt", ".rst")
+
+_PARAGRAPH = re.compile(r"\n\s*\n")
+
+
+def chunk_text(text: str, max_chars: int = DEFAULT_CHUNK_CHARS) -> List[str]:
+    """
+    Splits a document into passages of whole paragraphs up to max_chars,
+    paragraphs longer than that are split at the last space that fits.
+    """
+    pieces = []
+    for paragraph in _PARAGRAPH.split(text):
+        paragraph = " ".join(paragraph.split())
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind(" ", 0, max_chars + 1)
+            cut = cut if cut > 0 else max_chars
+            pieces.append(paragraph[:cut])
+            paragraph = paragraph[cut:].lstrip()
+        if paragraph:
+            pieces.append(paragraph)
+
+    chunks: List[str] = []
+    for piece in pieces:
+        if chunks and len(chunks[-1]) + 2 + len(piece) <= max_chars:
+            chunks[-1] = f"{chunks[-1]}\n\n{piece}"
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+def document_digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def read_documents(directory: str) -> Dict[str, str]:
+    """Reads the corpus, keyed by path relative to the directory."""
+    documents = {}
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.endswith(DOCUMENT_SUFFIXES):
+                path = os.path.join(root, name)
+                with open(path, "r", encoding="utf-8") as file:
+                    documents[os.path.relpath(path, directory)] = file.read()
+    return documents
+
+
+def build_index(
+    path: str,
+    documents: Dict[str, str],
+    embedder: Optional[Embedder] = None,
+    chunk_chars: int = DEFAULT_CHUNK_CHARS,
+) -> Dict[str, int]:
+    """
+    Brings the index at path up to date with the documents, embedding only the
+    documents that are new or changed since it was built.  Passages of
+    documents no longer in the corpus are dropped.
+
+    Args:
+        path: Index path, written as <path>.npy and <path>.json.
+        documents: The whole corpus, text keyed by source name.
+        embedder: Must be the embedder the Retriever uses.
+        chunk_chars: Longest passage.
+
+    Returns:
+        Counts of the passages kept from the previous build, embedded and in the index.
+    """
+    embedder = embedder or HashingEmbedder()
+    digests = {source: document_digest(text) for source, text in documents.items()}
+
+    kept_vectors = np.zeros((0, embedder.dimensions), dtype=np.float32)
+    kept_metadata: List[Dict] = []
+    if os.path.exists(f"{path}.npy"):
+        previous = VectorIndex.load(path)
+        if previous.dimensions == embedder.dimensions:
+            rows = [
+                row
+                for row, item in enumerate(previous.metadata)
+                if digests.get(item["source"]) == item["digest"]
+            ]
+            kept_metadata = [previous.metadata[row] for row in rows]
+            # Copied out of the memory map before the files are replaced.
+            kept_vectors = np.array(previous.vectors[rows], dtype=np.float32)
+        else:
+            logger.info("Embedder dimensions changed, re-embedding the whole corpus")
+    indexed = {item["source"] for item in kept_metadata}
+
+    new_metadata = []
+    for source in sorted(set(documents) - indexed):
+        for number, text in enumerate(chunk_text(documents[source], chunk_chars)):
+            new_metadata.append({"source": source, "chunk": number, "digest": digests[source], "text": text})
+    new_vectors = embedder.embed([item["text"] for item in new_metadata]) if new_metadata else kept_vectors[:0]
+
+    index = VectorIndex.from_vectors(
+        np.concatenate([kept_vectors, new_vectors]), kept_metadata + new_metadata
+    )
+    # Written alongside then swapped in, so a reader never sees a half written index.
+    index.save(f"{path}.building")
+    for suffix in (".npy", ".json"):
+        os.replace(f"{path}.building{suffix}", f"{path}{suffix}")
+    return {"kept": len(kept_metadata), "embedded": len(new_metadata), "passages": len(index)}
+
+
+class Retriever:
+    """
+    Top k cosine similarity search over the document index, the vectors are
+    memory mapped read only so searches are safe across threads and only the
+    pages touched are read in on a cold start.
+    """
+
+    def __init__(
+        self,
+        index_path: str,
+        embedder: Optional[Embedder] = None,
+        k: int = DEFAULT_TOP_K,
+        min_score: float = DEFAULT_MIN_SCORE,
+    ):
+        self.embedder = embedder or HashingEmbedder()
+        self.index = VectorIndex.load(index_path)
+        if self.index.dimensions != self.embedder.dimensions:
+            raise ValueError(
+                f"Index has {self.index.dimensions} dimensions, the embedder {self.embedder.dimensions}"
+            )
+        self.k = k
+        self.min_score = min_score
+        logger.info("Loaded document index with %s passages", len(self.index))
+
+    def retrieve(self, query: str) -> List[Dict]:
+        """Returns up to k passages related to the query, most similar first."""
+        with timed("Retrieval"):
+            vector = self.embedder.embed([query])[0]
+            results = self.index.search(vector, k=self.k)
+        passages = [item for score, item in results if score >= self.min_score]
+        add_count("RetrievedPassages", len(passages))
+        return passages
+
+    def with_passages(self, system_prompts: List[Dict], query: str) -> List[Dict]:
+        """Returns the system prompts followed by the passages retrieved for the query, if any."""
+        passages = self.retrieve(query)
+        if not passages:
+            return system_prompts
+        text = "\n\n".join(f"[{passage['source']}]\n{passage['text']}" for passage in passages)
+        return list(system_prompts) + [
+            {"text": f"Reference passages, use them to answer when they are relevant:\n\n{text}"}
+        ]
+
+
+def main(argv: List[str]):
+    if len(argv) != 2:
+        sys.exit("Usage: retrieval.py <corpus directory> <index path>")
+    directory, path = argv
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    counts = build_index(path, read_documents(directory))
+    print(
+        f"Indexed {counts['passages']} passages, embedded {counts['embedded']} "
+        f"and kept {counts['kept']} from the previous build"
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
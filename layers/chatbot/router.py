@@ -0,0 +1,179 @@
+import json
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+from aws_lambda_powertools import Logger
+
+from bedrock import Bedrock
+from context_window import ContextWindow, estimate_text_tokens
+from models import Messages, MessageRecord
+from resilience import RetryPolicy, ServiceUnavailable, deadline_allows
+from response_cache import ResponseCache
+from telemetry import add_count, metrics
+
+if TYPE_CHECKING:
+    from semantic_cache import SemanticCache
+
+logger = Logger()
+
+# Time a fallback call needs left before the deadline to be worth trying.
+FALLBACK_MIN_REMAINING_MS = 5000
+
+
+class ModelRoute:
+    """
+    A model in the routing pool and the conditions a turn must meet to use it.
+    Conditions left unset always match, so a route with none is a catch all.
+    """
+
+    def __init__(
+        self,
+        model_id: str,
+        max_prompt_tokens: Optional[int] = None,
+        max_history_messages: Optional[int] = None,
+        keywords: Optional[List[str]] = None,
+        fallback: Optional[str] = None,
+    ):
+        self.model_id = model_id
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_history_messages = max_history_messages
+        self.keywords = [keyword.lower() for keyword in keywords or []]
+        # Model to retry on when this one is throttled.
+        self.fallback = fallback
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "ModelRoute":
+        return cls(
+            data["model_id"],
+            max_prompt_tokens=data.get("max_prompt_tokens"),
+            max_history_messages=data.get("max_history_messages"),
+            keywords=data.get("keywords"),
+            fallback=data.get("fallback"),
+        )
+
+    def matches(self, prompt: str, history_messages: int) -> bool:
+        if self.max_prompt_tokens is not None and estimate_text_tokens(prompt) > self.max_prompt_tokens:
+            return False
+        if self.max_history_messages is not None and history_messages > self.max_history_messages:
+            return False
+        if self.keywords and not any(keyword in prompt.lower() for keyword in self.keywords):
+            return False
+        return True
+
+
+def parse_routes(config: Optional[str]) -> List[ModelRoute]:
+    """Parses the MODEL_ROUTES setting, a JSON list of routes checked in order."""
+    if not config:
+        return []
+    return [ModelRoute.from_dict(route) for route in json.loads(config)]
+
+
+class ModelRouter:
+    """
+    Picks the model for each turn from a pool, the first route whose conditions
+    match the new prompt and the history size, falling back to the default
+    model.  Each model has its own Bedrock client, circuit breaker and context
+    window, and a call that is still throttled after retrying, or shed by an
+    open circuit, is retried once on the route's fallback model.
+    """
+
+    def __init__(
+        self,
+        default_model_id: str,
+        routes: Optional[List[ModelRoute]] = None,
+        context_token_budget: Optional[int] = None,
+        response_cache: Optional[ResponseCache] = None,
+        semantic_cache: Optional["SemanticCache"] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+    ):
+        self.default_model_id = default_model_id
+        self.routes = routes or []
+        self.context_token_budget = context_token_budget
+        self.response_cache = response_cache
+        self.semantic_cache = semantic_cache
+        self.retry_policy = retry_policy
+        self._models: Dict[str, Bedrock] = {}
+        self._context_windows: Dict[str, ContextWindow] = {}
+
+    def bedrock(self, model_id: str) -> Bedrock:
+        if model_id not in self._models:
+            self._models[model_id] = Bedrock(
+                model_id,
+                response_cache=self.response_cache,
+                semantic_cache=self.semantic_cache,
+                retry_policy=self.retry_policy,
+            )
+        return self._models[model_id]
+
+    def context_window(self, model_id: str) -> ContextWindow:
+        if model_id not in self._context_windows:
+            self._context_windows[model_id] = ContextWindow(model_id, self.context_token_budget)
+        return self._context_windows[model_id]
+
+    def route(self, messages: Messages) -> List[str]:
+        """
+        Returns the model to use for the turn followed by the model to fall back
+        to if it is throttled.
+        """
+        prompt = " ".join(item.text for item in messages.messages[-1].content)
+        history_messages = len(messages.messages) - 1
+        for route in self.routes:
+            if route.matches(prompt, history_messages):
+                candidates = [route.model_id]
+                fallback = route.fallback or self.default_model_id
+                if fallback != route.model_id:
+                    candidates.append(fallback)
+                return candidates
+        return [self.default_model_id]
+
+    def _should_fall_back(self, error: ServiceUnavailable, model_id: str, candidates: List[str]) -> bool:
+        # Throttled after retrying, or shed by the model's open circuit.
+        if model_id == candidates[-1] or not deadline_allows(FALLBACK_MIN_REMAINING_MS):
+            return False
+        logger.warning(f"Model {model_id} is unavailable, falling back: {error}")
+        add_count("ModelFallback")
+        return True
+
+    def _routed(self, message: MessageRecord, model_id: str) -> MessageRecord:
+        message.model_id = model_id
+        metrics.add_metadata(key="routed_model_id", value=model_id)
+        return message
+
+    def converse(self, system_prompts, messages: Messages, use_cache: bool = True) -> MessageRecord:
+        candidates = self.route(messages)
+        for model_id in candidates:
+            try:
+                message = self.bedrock(model_id).converse(
+                    system_prompts,
+                    self.context_window(model_id).select(system_prompts, messages),
+                    use_cache=use_cache,
+                    # Decided before trimming, which can leave a long conversation with one message.
+                    first_turn=len(messages.messages) == 1,
+                )
+            except ServiceUnavailable as e:
+                if self._should_fall_back(e, model_id, candidates):
+                    continue
+                raise
+            return self._routed(message, model_id)
+
+    def converse_stream(self, system_prompts, messages: Messages, use_cache: bool = True):
+        candidates = self.route(messages)
+        for model_id in candidates:
+            stream = self.bedrock(model_id).converse_stream(
+                system_prompts,
+                self.context_window(model_id).select(system_prompts, messages),
+                use_cache=use_cache,
+                first_turn=len(messages.messages) == 1,
+            )
+            # Throttling surfaces before the first delta, after that the response
+            # is partly sent and can't switch models.
+            try:
+                first = next(stream)
+            except StopIteration as stop:
+                return self._routed(stop.value, model_id)
+            except ServiceUnavailable as e:
+                if self._should_fall_back(e, model_id, candidates):
+                    continue
+                raise
+            yield first
+            message = yield from stream
+            return self._routed(message, model_id)
@@ -0,0 +1,131 @@
+"""
+Near duplicate prompt cache, optionally seeded from an index of answers built
+offline and packaged in the layer, e.g.
+
+    PYTHONPATH=layers/chatbot python layers/chatbot/semantic_cache.py \
+        <model id> system_prompts.json answers.jsonl layers/chatbot/semantic_cache_index/answers
+
+answers.jsonl holds one {"prompt": ..., "answer": ...} object per line, and
+system_prompts.json the system prompts the function sends, which scope matches.
+"""
+import json
+import os
+import sys
+from threading import Lock
+from typing import Dict, List, Optional
+
+from aws_lambda_powertools import Logger
+
+from models import ContentRecord, MessageRecord, Messages, Role
+from vector_index import Embedder, HashingEmbedder, VectorIndex
+
+logger = Logger()
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.9
+DEFAULT_SEMANTIC_CACHE_SIZE = 1000
+
+
+class SemanticCache:
+    """
+    Near duplicate prompt cache for first turn / stateless prompts.  Prompts are
+    embedded and matched by cosine similarity against previously answered
+    prompts that were sent with the same model, system prompts and inference
+    configuration (the namespace).
+    """
+
+    def __init__(
+        self,
+        embedder: Optional[Embedder] = None,
+        threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+        max_size: int = DEFAULT_SEMANTIC_CACHE_SIZE,
+        index_path: Optional[str] = None,
+    ):
+        self.embedder = embedder or HashingEmbedder()
+        self.threshold = threshold
+        if index_path and os.path.exists(f"{index_path}.npy"):
+            self.index = VectorIndex.load(index_path, max_size=max_size)
+            logger.info("Loaded semantic cache index with %s entries", len(self.index))
+        else:
+            self.index = VectorIndex(self.embedder.dimensions, max_size=max_size)
+        self.stats = {"hits": 0, "misses": 0}
+        self._lock = Lock()
+
+    def get(self, namespace: str, prompt: str) -> Optional[Dict]:
+        vector = self.embedder.embed([prompt])[0]
+        with self._lock:
+            results = self.index.search(
+                vector, k=1, where=lambda item: item["namespace"] == namespace
+            )
+        if results and results[0][0] >= self.threshold:
+            score, item = results[0]
+            self.stats["hits"] += 1
+            logger.info(
+                "Semantic cache hit", similarity=round(score, 4), cache_stats=self.stats
+            )
+            return item["message"]
+
+        self.stats["misses"] += 1
+        logger.info("Semantic cache miss", cache_stats=self.stats)
+        return None
+
+    def put(self, namespace: str, prompt: str, message: Dict):
+        vector = self.embedder.embed([prompt])[0]
+        with self._lock:
+            self.index.add(
+                vector, {"namespace": namespace, "prompt": prompt, "message": message}
+            )
+
+    def save(self, index_path: str):
+        with self._lock:
+            self.index.save(index_path)
+
+
+def build_index(
+    path: str,
+    model_id: str,
+    system_prompts: List[Dict],
+    answers: List[Dict],
+    embedder: Optional[Embedder] = None,
+    max_size: int = DEFAULT_SEMANTIC_CACHE_SIZE,
+) -> int:
+    """
+    Writes an index of prepared answers that SemanticCache memory maps on load.
+    Args:
+        path: Index path, written as <path>.npy and <path>.json.
+        model_id: The model the function sends first turns to.
+        system_prompts: The system prompts the function sends.
+        answers: Objects with the prompt and its answer.
+        embedder: Must be the embedder the function's SemanticCache uses.
+        max_size: Most answers kept, the later ones when there are more.
+
+    Returns:
+        The number of answers in the index.
+    """
+    # Only import when building, the namespace is the one Bedrock matches turns in.
+    from bedrock import Bedrock
+    from response_cache import namespace_key
+
+    bedrock = Bedrock(model_id)
+    cache = SemanticCache(embedder, max_size=max_size)
+    for answer in answers:
+        prompt = Messages("semantic-cache", [MessageRecord(Role.USER, [ContentRecord(answer["prompt"])])])
+        message = MessageRecord(Role.ASSISTANT, [ContentRecord(answer["answer"])])
+        cache.put(namespace_key(bedrock._converse_args(system_prompts, prompt)), answer["prompt"], message.to_dict())
+    cache.save(path)
+    return len(cache.index)
+
+
+def main(argv: List[str]):
+    if len(argv) != 4:
+        sys.exit("Usage: semantic_cache.py <model id> <system prompts JSON> <answers JSONL> <index path>")
+    model_id, system_prompts_path, answers_path, path = argv
+    with open(system_prompts_path, "r", encoding="utf-8") as file:
+        system_prompts = json.load(file)
+    with open(answers_path, "r", encoding="utf-8") as file:
+        answers = [json.loads(line) for line in file if line.strip()]
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    print(f"Indexed {build_index(path, model_id, system_prompts, answers)} answers")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
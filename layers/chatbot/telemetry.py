@@ -0,0 +1,50 @@
+import time
+from contextlib import contextmanager
+from typing import Optional, Union
+
+from aws_lambda_powertools import Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+
+# Metrics instances share one metric set, so every module adds to the EMF blob
+# that the handler flushes at the end of the invocation.
+metrics = Metrics()
+
+
+def add_latency(name: str, milliseconds: float):
+    metrics.add_metric(name=f"{name}Latency", unit=MetricUnit.Milliseconds, value=milliseconds)
+
+
+@contextmanager
+def timed(name: str):
+    """
+    Records how long the block took as a <name>Latency metric, failed calls are
+    timed too so slow throttled or erroring calls still show up.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_latency(name, (time.perf_counter() - start) * 1000)
+
+
+def add_count(name: str, value: float = 1):
+    metrics.add_metric(name=name, unit=MetricUnit.Count, value=value)
+
+
+def add_consumed_capacity(name: str, consumed: Optional[Union[dict, list]]):
+    """
+    Adds the capacity units from a DynamoDB ConsumedCapacity response field, a
+    single entry for item operations or one per table for transactions.
+    """
+    if not consumed:
+        return
+    if isinstance(consumed, dict):
+        consumed = [consumed]
+    units = sum(entry.get("CapacityUnits", 0) for entry in consumed)
+    metrics.add_metric(name=name, unit=MetricUnit.Count, value=units)
+
+
+def add_retry_attempts(name: str, response: dict, retries: int = 0):
+    # Our own retries plus any botocore reports making before the call succeeded.
+    attempts = response.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+    add_count(f"{name}RetryAttempts", attempts + retries)
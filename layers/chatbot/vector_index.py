@@ -0,0 +1,147 @@
+import json
+import re
+import zlib
+from typing import Callable, Dict, List, Optional, Protocol, Tuple
+
+import numpy as np
+
+DEFAULT_DIMENSIONS = 512
+
+_WORD = re.compile(r"\w+")
+
+
+class Embedder(Protocol):
+    dimensions: int
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Returns one L2 normalised float32 row per text."""
+        ...
+
+
+class HashingEmbedder:
+    """
+    Deterministic hashing vectorizer, words and character trigrams are hashed
+    into a fixed number of signed buckets.  Needs no model or network access so
+    it works offline and produces identical vectors across containers.
+    """
+
+    def __init__(self, dimensions: int = DEFAULT_DIMENSIONS, ngram: int = 3):
+        self.dimensions = dimensions
+        self.ngram = ngram
+
+    def _features(self, text: str) -> List[str]:
+        words = _WORD.findall(text.lower())
+        features = list(words)
+        for word in words:
+            padded = f"<{word}>"
+            features.extend(
+                padded[i : i + self.ngram] for i in range(len(padded) - self.ngram + 1)
+            )
+        return features
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                hashed = zlib.crc32(feature.encode("utf-8"))
+                sign = 1.0 if hashed & 0x80000000 else -1.0
+                vectors[row, hashed % self.dimensions] += sign
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+class VectorIndex:
+    """
+    Bounded cosine similarity index over L2 normalised vectors with a metadata
+    dict per row.  When full, the least recently matched row is overwritten.
+
+    Saved as <path>.npy (vectors) and <path>.json (metadata) so the vectors can
+    be memory mapped on load rather than rebuilt on a cold start.
+    """
+
+    def __init__(self, dimensions: int = DEFAULT_DIMENSIONS, max_size: int = 1000):
+        self.dimensions = dimensions
+        self.max_size = max_size
+        self._vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self._metadata: List[Dict] = []
+        self._last_used = np.zeros(0, dtype=np.int64)
+        self._clock = 0
+
+    def __len__(self) -> int:
+        return len(self._metadata)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors[: len(self)]
+
+    @property
+    def metadata(self) -> List[Dict]:
+        return self._metadata
+
+    def _writable(self):
+        # Memory mapped vectors are read only, copy them into a buffer sized for the
+        # index the first time it is modified.
+        if self._vectors.flags.writeable and len(self._vectors) == self.max_size:
+            return
+        buffer = np.zeros((self.max_size, self.dimensions), dtype=np.float32)
+        buffer[: len(self)] = self._vectors[: len(self)]
+        last_used = np.zeros(self.max_size, dtype=np.int64)
+        last_used[: len(self)] = self._last_used[: len(self)]
+        self._vectors, self._last_used = buffer, last_used
+
+    def add(self, vector: np.ndarray, metadata: Dict) -> int:
+        self._writable()
+        self._clock += 1
+        if len(self) < self.max_size:
+            row = len(self)
+            self._metadata.append(metadata)
+        else:
+            row = int(np.argmin(self._last_used))
+            self._metadata[row] = metadata
+        self._vectors[row] = vector
+        self._last_used[row] = self._clock
+        return row
+
+    def search(
+        self,
+        vector: np.ndarray,
+        k: int = 1,
+        where: Optional[Callable[[Dict], bool]] = None,
+    ) -> List[Tuple[float, Dict]]:
+        if len(self) == 0:
+            return []
+        scores = self._vectors[: len(self)] @ vector
+        if where is not None:
+            mask = np.fromiter((where(item) for item in self._metadata), dtype=bool, count=len(self))
+            scores = np.where(mask, scores, -np.inf)
+        k = min(k, len(self))
+        rows = np.argpartition(-scores, k - 1)[:k]
+        rows = rows[np.argsort(-scores[rows])]
+        results = [(float(scores[row]), self._metadata[row]) for row in rows if scores[row] > -np.inf]
+        if results:
+            # Kept for memory mapped rows too, the recency array is always writable.
+            self._clock += 1
+            self._last_used[rows[0]] = self._clock
+        return results
+
+    def save(self, path: str):
+        np.save(f"{path}.npy", np.ascontiguousarray(self._vectors[: len(self)]))
+        with open(f"{path}.json", "w") as file:
+            json.dump(self._metadata, file)
+
+    @classmethod
+    def from_vectors(cls, vectors: np.ndarray, metadata: List[Dict], max_size: int = 1000) -> "VectorIndex":
+        """Wraps existing rows without copying them, read only arrays are copied on the first add."""
+        index = cls(dimensions=vectors.shape[1], max_size=max(max_size, len(metadata)))
+        index._vectors = vectors
+        index._metadata = metadata
+        index._last_used = np.zeros(len(metadata), dtype=np.int64)
+        return index
+
+    @classmethod
+    def load(cls, path: str, max_size: int = 1000, mmap: bool = True) -> "VectorIndex":
+        vectors = np.load(f"{path}.npy", mmap_mode="r" if mmap else None)
+        with open(f"{path}.json", "r") as file:
+            metadata = json.load(file)
+        return cls.from_vectors(vectors, metadata, max_size=max_size)
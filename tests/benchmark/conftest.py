@@ -0,0 +1,74 @@
+import os
+import sys
+import pytest
+import boto3
+import botocore.client
+
+from unittest.mock import patch
+from moto import mock_aws
+
+sys.path.append(os.path.join(os.getcwd(), "functions"))
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+orig = botocore.client.BaseClient._make_api_call
+
+# Read when the metrics singleton is created, which can be at collection time.
+os.environ.setdefault("POWERTOOLS_METRICS_NAMESPACE", "ServerlessChatbot")
+
+
+@pytest.fixture(autouse=True)
+def aws_credentials():
+    """Mocked AWS Credentials for moto."""
+    os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+    os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+    os.environ["AWS_SECURITY_TOKEN"] = "testing"
+    os.environ["AWS_SESSION_TOKEN"] = "testing"
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+
+@pytest.fixture()
+def ddb_table_name():
+    with mock_aws():
+        table_name = "ChatbotHistory"
+        boto3.client("dynamodb").create_table(
+            TableName=table_name,
+            KeySchema=[
+                {"AttributeName": "session_id", "KeyType": "HASH"},
+                {"AttributeName": "sequence", "KeyType": "RANGE"}
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "session_id", "AttributeType": "S"},
+                {"AttributeName": "sequence", "AttributeType": "N"}
+            ],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        os.environ["DDB_TABLE_NAME"] = table_name
+        yield table_name
+
+
+@pytest.fixture()
+def api_calls():
+    """
+    Replaces Bedrock with a canned response and records every AWS API call made,
+    other calls are passed through to moto.
+    """
+    calls = []
+
+    def fake_make_api_call(self, operation_name, kwarg):
+        calls.append(operation_name)
+        if operation_name == "Converse":
+            return {
+                "output": {
+                    "message": {
+                        "role": "assistant",
+                        "content": [{"text": "Baa baa, I'm a goat."}],
+                    }
+                },
+                "stopReason": "end_turn",
+                "usage": {"inputTokens": 54, "outputTokens": 156, "totalTokens": 210},
+                "metrics": {"latencyMs": 0},
+            }
+        return orig(self, operation_name, kwarg)
+
+    with patch("botocore.client.BaseClient._make_api_call", new=fake_make_api_call):
+        yield calls
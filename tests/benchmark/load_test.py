@@ -0,0 +1,308 @@
+"""
+Offline load test for the chatbot lambda_handler.
+
+Each worker process stands in for a warm Lambda container, handling one request
+at a time like Lambda does, with its own moto DynamoDB and a fake Bedrock that
+has configurable latency, jitter and throttling.  Results are written as JSON so
+runs can be compared, e.g.
+
+    python tests/benchmark/load_test.py --concurrency 4 --sessions 40 --turns 10 \\
+        --output .benchmarks/load.json --baseline .benchmarks/previous.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+TABLE_NAME = "ChatbotHistory"
+
+
+@dataclass
+class LoadTestConfig:
+    concurrency: int = 2
+    sessions: int = 8
+    turns: int = 5
+    bedrock_latency_ms: float = 50
+    bedrock_jitter_ms: float = 10
+    throttle_rate: float = 0.0
+    ddb_latency_ms: float = 0
+    # Send the full transcript (client) or only the session id (server) each turn.
+    history: str = "server"
+    answer_chars: int = 600
+    seed: int = 1
+
+
+class FakeLambdaContext:
+    def __init__(self, timeout_ms: int = 30000):
+        self.function_name = "load-test"
+        self.function_version = "$LATEST"
+        self.invoked_function_arn = "arn:aws:lambda:us-east-1:123456789012:function:load-test"
+        self.memory_limit_in_mb = 128
+        self.aws_request_id = "load-test-request"
+        self.log_group_name = "load-test"
+        self.log_stream_name = "load-test"
+        self._deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(int((self._deadline - time.monotonic()) * 1000), 0)
+
+
+def api_gateway_event(path: str, body: Dict) -> Dict:
+    return {
+        "body": json.dumps(body),
+        "resource": path,
+        "path": path,
+        "httpMethod": "POST",
+        "headers": {"Content-Type": "application/json"},
+        "multiValueHeaders": {},
+        "queryStringParameters": None,
+        "multiValueQueryStringParameters": None,
+        "pathParameters": None,
+        "stageVariables": None,
+        "isBase64Encoded": False,
+        "requestContext": {
+            "resourcePath": path,
+            "httpMethod": "POST",
+            "path": f"/prod{path}",
+            "stage": "prod",
+            "requestId": "load-test",
+            "identity": {"sourceIp": "127.0.0.1"},
+        },
+    }
+
+
+def percentile(values: List[float], percent: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(percent / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return round(ordered[index], 3)
+
+
+def run_container(config: LoadTestConfig, worker: int, session_count: int) -> Dict:
+    """Runs in a worker process, returns the per turn records for its sessions."""
+    os.environ.update(
+        {
+            "AWS_ACCESS_KEY_ID": "testing",
+            "AWS_SECRET_ACCESS_KEY": "testing",
+            "AWS_SESSION_TOKEN": "testing",
+            "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
+            "BEDROCK_MODEL_ID": MODEL_ID,
+            "DDB_TABLE_NAME": TABLE_NAME,
+            "POWERTOOLS_LOG_LEVEL": "ERROR",
+            "POWERTOOLS_TRACE_DISABLED": "true",
+            "POWERTOOLS_METRICS_NAMESPACE": "LoadTest",
+        }
+    )
+    for path in (os.path.join(ROOT, "functions", "chatbot"), os.path.join(ROOT, "layers", "chatbot")):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+    import boto3
+    import botocore.client
+    from botocore.exceptions import ClientError
+    from moto import mock_aws
+    from unittest.mock import patch
+
+    rng = random.Random(config.seed + worker)
+    orig = botocore.client.BaseClient._make_api_call
+    stages: Dict[str, float] = {}
+
+    def fake_make_api_call(self, operation_name, kwarg):
+        start = time.perf_counter()
+        try:
+            if operation_name == "Converse":
+                delay = config.bedrock_latency_ms + rng.uniform(-1, 1) * config.bedrock_jitter_ms
+                time.sleep(max(delay, 0) / 1000)
+                if rng.random() < config.throttle_rate:
+                    raise ClientError(
+                        {"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}},
+                        operation_name,
+                    )
+                text = ("Goats are browsers. " * (config.answer_chars // 20 + 1))[: config.answer_chars]
+                return {
+                    "ResponseMetadata": {"HTTPStatusCode": 200, "RetryAttempts": 0},
+                    "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+                    "stopReason": "end_turn",
+                    "usage": {"inputTokens": 100, "outputTokens": 150, "totalTokens": 250},
+                    "metrics": {"latencyMs": int(delay)},
+                }
+            if config.ddb_latency_ms:
+                time.sleep(config.ddb_latency_ms / 1000)
+            return orig(self, operation_name, kwarg)
+        finally:
+            stages[operation_name] = stages.get(operation_name, 0.0) + (time.perf_counter() - start) * 1000
+
+    records = []
+    with mock_aws():
+        boto3.client("dynamodb").create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[
+                {"AttributeName": "session_id", "KeyType": "HASH"},
+                {"AttributeName": "sequence", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "session_id", "AttributeType": "S"},
+                {"AttributeName": "sequence", "AttributeType": "N"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        init_start = time.perf_counter()
+        from app import lambda_handler
+        init_ms = (time.perf_counter() - init_start) * 1000
+
+        with patch("botocore.client.BaseClient._make_api_call", new=fake_make_api_call):
+            for session in range(session_count):
+                session_id = f"load-{worker}-{session}"
+                messages = []
+                for turn in range(config.turns):
+                    body = {"session_id": session_id, "prompt": f"{session_id} question {turn}"}
+                    if config.history == "client":
+                        body["messages"] = messages
+                    stages.clear()
+                    started_at = time.time()
+                    start = time.perf_counter()
+                    try:
+                        response = lambda_handler(
+                            api_gateway_event("/chat", body), FakeLambdaContext()
+                        )
+                        status = response["statusCode"]
+                        if status == 200:
+                            messages = json.loads(response["body"])["messages"]
+                    except Exception as e:
+                        status = type(e).__name__
+                    latency_ms = (time.perf_counter() - start) * 1000
+                    stage_ms = dict(stages)
+                    stage_ms["handler"] = max(latency_ms - sum(stages.values()), 0.0)
+                    records.append(
+                        {
+                            "started_at": started_at,
+                            "latency_ms": latency_ms,
+                            "status": status,
+                            "stages": stage_ms,
+                        }
+                    )
+
+    return {"init_ms": init_ms, "records": records}
+
+
+def summarize(config: LoadTestConfig, results: List[Dict]) -> Dict:
+    records = [record for result in results for record in result["records"]]
+    # Measured from the first request to the last response, excluding process start up.
+    wall_seconds = max(
+        (record["started_at"] + record["latency_ms"] / 1000 for record in records), default=0
+    ) - min((record["started_at"] for record in records), default=0)
+    succeeded = [record for record in records if record["status"] == 200]
+    latencies = [record["latency_ms"] for record in succeeded]
+    stage_names = sorted({name for record in succeeded for name in record["stages"]})
+    stages = {}
+    for name in stage_names:
+        values = [record["stages"].get(name, 0.0) for record in succeeded]
+        stages[name] = {
+            "mean_ms": round(sum(values) / len(values), 3),
+            "p95_ms": percentile(values, 95),
+        }
+    errors: Dict[str, int] = {}
+    for record in records:
+        if record["status"] != 200:
+            errors[str(record["status"])] = errors.get(str(record["status"]), 0) + 1
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": asdict(config),
+        "requests": len(records),
+        "errors": errors,
+        "throughput_rps": round(len(records) / wall_seconds, 3) if wall_seconds else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": percentile(latencies, 100),
+        },
+        "init_ms": percentile([result["init_ms"] for result in results], 50),
+        "stages": stages,
+    }
+
+
+def run_load_test(config: LoadTestConfig) -> Dict:
+    # Spread the sessions over the workers, each worker is one warm container.
+    per_worker = [
+        config.sessions // config.concurrency + (1 if worker < config.sessions % config.concurrency else 0)
+        for worker in range(config.concurrency)
+    ]
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(config.concurrency) as pool:
+        results = pool.starmap(
+            run_container,
+            [(config, worker, count) for worker, count in enumerate(per_worker) if count],
+        )
+    return summarize(config, results)
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float = 0.1) -> List[str]:
+    """Returns a description of each latency percentile that regressed past the tolerance."""
+    regressions = []
+    for name, value in report["latency_ms"].items():
+        previous = baseline["latency_ms"].get(name)
+        if value is not None and previous and value > previous * (1 + tolerance):
+            regressions.append(f"{name} {previous:.1f} ms -> {value:.1f} ms")
+    return regressions
+
+
+def main(argv=None):
+    defaults = LoadTestConfig()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=defaults.concurrency)
+    parser.add_argument("--sessions", type=int, default=defaults.sessions)
+    parser.add_argument("--turns", type=int, default=defaults.turns)
+    parser.add_argument("--bedrock-latency-ms", type=float, default=defaults.bedrock_latency_ms)
+    parser.add_argument("--bedrock-jitter-ms", type=float, default=defaults.bedrock_jitter_ms)
+    parser.add_argument("--throttle-rate", type=float, default=defaults.throttle_rate)
+    parser.add_argument("--ddb-latency-ms", type=float, default=defaults.ddb_latency_ms)
+    parser.add_argument("--history", choices=["server", "client"], default=defaults.history)
+    parser.add_argument("--answer-chars", type=int, default=defaults.answer_chars)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--output", default=os.path.join(".benchmarks", "load_test.json"))
+    parser.add_argument("--baseline", help="Previous results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    config = LoadTestConfig(
+        concurrency=args.concurrency,
+        sessions=args.sessions,
+        turns=args.turns,
+        bedrock_latency_ms=args.bedrock_latency_ms,
+        bedrock_jitter_ms=args.bedrock_jitter_ms,
+        throttle_rate=args.throttle_rate,
+        ddb_latency_ms=args.ddb_latency_ms,
+        history=args.history,
+        answer_chars=args.answer_chars,
+        seed=args.seed,
+    )
+    report = run_load_test(config)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        if regressions:
+            print("Latency regressions: " + ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
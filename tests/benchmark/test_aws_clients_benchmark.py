@@ -0,0 +1,121 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+
+import aws_clients
+from bedrock import Bedrock, config
+
+# Each request fans out this many concurrent calls, as a batch request does
+# for history reads, and waits for them all before the next request.
+FAN_OUT = 24
+REQUESTS = 11
+# Simulated service time, and the cost of a new connection, roughly what a TLS
+# handshake takes on a small Lambda, which plain HTTP on localhost doesn't have.
+SERVICE_LATENCY_SECONDS = 0.05
+CONNECT_LATENCY_SECONDS = 0.05
+
+
+class StubDynamoDB(BaseHTTPRequestHandler):
+    """Answers every DynamoDB call with an empty GetItem response, counting the connections opened."""
+
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with StubDynamoDB.lock:
+            StubDynamoDB.connections += 1
+        time.sleep(CONNECT_LATENCY_SECONDS)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(SERVICE_LATENCY_SECONDS)
+        body = json.dumps({}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-amz-json-1.0")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(ddb_client) -> dict:
+    StubDynamoDB.connections = 0
+
+    def get_item(index):
+        ddb_client.get_item(TableName="ChatbotHistory", Key={"session_id": {"S": str(index)}})
+
+    # Warm up so connection setup on the first calls isn't counted as the warm path.
+    ddb_client.get_item(TableName="ChatbotHistory", Key={"session_id": {"S": "warm"}})
+    latencies = []
+    with ThreadPoolExecutor(FAN_OUT) as executor:
+        for request in range(REQUESTS):
+            start = time.perf_counter()
+            list(executor.map(get_item, range(request * FAN_OUT, (request + 1) * FAN_OUT)))
+            latencies.append(time.perf_counter() - start)
+    # The first request opens the shared client's connections too.
+    latencies = sorted(latencies[1:])
+    return {
+        "connections": StubDynamoDB.connections,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "max_ms": latencies[-1] * 1000,
+    }
+
+
+def test_shared_client_reuses_connections_on_the_warm_path():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubDynamoDB)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint_url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        results = {"default": run(boto3.client("dynamodb", endpoint_url=endpoint_url))}
+        aws_clients.set_endpoint_url("dynamodb", endpoint_url)
+        results["shared"] = run(aws_clients.client("dynamodb"))
+    finally:
+        aws_clients.set_endpoint_url("dynamodb", None)
+        server.shutdown()
+        server.server_close()
+
+    for name, result in results.items():
+        print(
+            f"{name}: {result['connections']} connections, mean {result['mean_ms']:.1f} ms, "
+            f"max {result['max_ms']:.1f} ms per request of {FAN_OUT} calls"
+        )
+
+    # The default pool keeps 10 connections, so each request opens the rest again
+    # and throws them away afterwards.
+    assert results["shared"]["connections"] <= FAN_OUT + 1
+    assert results["shared"]["connections"] * 4 < results["default"]["connections"]
+    assert results["shared"]["mean_ms"] < results["default"]["mean_ms"]
+
+
+def test_routed_models_share_a_client():
+    model_ids = [
+        "anthropic.claude-3-haiku-20240307-v1:0",
+        "anthropic.claude-3-5-sonnet-20240620-v1:0",
+        "amazon.nova-lite-v1:0",
+        "amazon.nova-pro-v1:0",
+    ]
+    # Both paths have loaded the service model already, as a warm container has.
+    boto3.client("bedrock-runtime", config=config)
+    aws_clients.client("bedrock-runtime", config=config)
+
+    # Each routed model, and each DynamoDB table wrapper, used to create its own client.
+    start = time.perf_counter()
+    clients = [boto3.client("bedrock-runtime", config=config) for _ in model_ids]
+    per_model_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    shared = [Bedrock(model_id).bedrock_client for model_id in model_ids]
+    shared_ms = (time.perf_counter() - start) * 1000
+
+    print(f"per model clients: {per_model_ms:.1f} ms, shared client: {shared_ms:.1f} ms for {len(model_ids)} models")
+    assert len({id(client) for client in clients}) == len(model_ids)
+    assert len({id(client) for client in shared}) == 1
+    assert shared_ms < per_model_ms
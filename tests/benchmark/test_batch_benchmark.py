@@ -0,0 +1,58 @@
+import time
+import botocore.client
+
+from unittest.mock import patch
+
+from chatbot_client import Chatbot, Turn
+from models import ContentItem, Message, Messages
+
+orig = botocore.client.BaseClient._make_api_call
+
+ITEMS = 16
+# Simulated service latency, moto itself answers in well under a millisecond.
+BEDROCK_LATENCY_SECONDS = 0.05
+DDB_WRITE_LATENCY_SECONDS = 0.01
+
+
+def slow_make_api_call(self, operation_name, kwarg):
+    if operation_name == "Converse":
+        time.sleep(BEDROCK_LATENCY_SECONDS)
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": "Ticket is about billing."}]}},
+            "stopReason": "end_turn",
+            "usage": {"inputTokens": 54, "outputTokens": 6, "totalTokens": 60},
+            "metrics": {"latencyMs": BEDROCK_LATENCY_SECONDS * 1000},
+        }
+    if operation_name in ("TransactWriteItems", "BatchWriteItem"):
+        time.sleep(DDB_WRITE_LATENCY_SECONDS)
+    return orig(self, operation_name, kwarg)
+
+
+def prompt(index):
+    return Message(role="user", content=[ContentItem(text=f"Classify ticket {index}: my bill is wrong")])
+
+
+def test_batch_beats_one_call_per_item(ddb_table_name):
+    model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
+    system_prompts = [{"text": "Classify the support ticket"}]
+    chatbot = Chatbot(model_id, ddb_table_name, response_cache=None, batch_concurrency=8)
+
+    with patch("botocore.client.BaseClient._make_api_call", new=slow_make_api_call):
+        start = time.perf_counter()
+        for index in range(ITEMS):
+            chatbot.converse(system_prompts, Messages(f"serial-{index}", [prompt(index)]))
+        serial_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        results = chatbot.converse_batch(
+            system_prompts, [Turn(f"batch-{index}", prompt(index), history=[]) for index in range(ITEMS)]
+        )
+        batch_ms = (time.perf_counter() - start) * 1000
+
+    print(
+        f"{ITEMS} items: one call each {serial_ms:.0f} ms ({ITEMS / serial_ms * 1000:.1f} items/s), "
+        f"batch {batch_ms:.0f} ms ({ITEMS / batch_ms * 1000:.1f} items/s)"
+    )
+
+    assert all(isinstance(result, Messages) for result in results)
+    assert batch_ms < serial_ms / 3
@@ -0,0 +1,50 @@
+from math import ceil
+
+from codec import encode_content, item_size
+
+# Transcript in the style of the nursery rhyme fixtures, longer answers as the
+# model gives when asked for more verses.
+VERSES = [
+    "Little Billy Goat\nOn the rocky hill did stoat\nMunching grass and leaves galore\nHis tummy full, he asked for more",
+    "See the goats upon the ridge\nPrancing, skipping off the bridge\nLeaping over rocks and logs\nWagging their little tails like dogs",
+    "Nanny goats with kids so small\nClimbing up the stone wall\nNibbling here and munching there\nGoats are funny I do swear!",
+    "Little kid, little kid, munching leaves so green,\nClimbing up the old oak tree, the happiest ever seen.\nFrolicking and leaping high, your antics make us smile,\nBringing joy to the farmyard, if only for a while.",
+    "Billy goats with horns so grand, guarding the herd with care,\nButting heads in playful jest, without a worry or care.\nProviding milk and cheese for us, in your simple way,\nDelightful little creatures, enjoying each new day.",
+]
+
+
+def transcript():
+    records = []
+    for turn in range(1, 11):
+        records.append({"role": "user", "content": [{"text": f"Now give me {turn + 1} verses about goats"}]})
+        answer = "Here's a nursery rhyme about goats:\n\n" + "\n\n".join(
+            VERSES[verse % len(VERSES)] for verse in range(turn + 1)
+        )
+        records.append({"role": "assistant", "content": [{"text": answer}]})
+    return records
+
+
+def stored(record, threshold):
+    return dict(encode_content(record, threshold), session_id="a" * 32, sequence=1)
+
+
+def test_compression_saves_write_and_read_units():
+    records = transcript()
+    results = {}
+    for name, threshold in (("plain", None), ("compressed", 1024)):
+        sizes = [item_size(stored(record, threshold)) for record in records]
+        # Writes are billed per 1 KB item, a Query per 4 KB read in total.
+        results[name] = {
+            "bytes": sum(sizes),
+            "wcu": sum(ceil(size / 1024) for size in sizes),
+            "rcu": ceil(sum(sizes) / 4096),
+        }
+        print(
+            f"{name}: {results[name]['bytes']} bytes, {results[name]['wcu']} write units, "
+            f"{results[name]['rcu']} read units for the session"
+        )
+
+    # Short prompts and answers stay plain, so the saving comes from the long answers.
+    assert results["compressed"]["bytes"] < results["plain"]["bytes"] * 0.8
+    assert results["compressed"]["wcu"] < results["plain"]["wcu"]
+    assert results["compressed"]["rcu"] < results["plain"]["rcu"]
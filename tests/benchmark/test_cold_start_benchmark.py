@@ -0,0 +1,54 @@
+import json
+import os
+import subprocess
+import sys
+
+# Fails the benchmark if importing the function regresses past this budget,
+# about 1.3x the ~580 ms measured once the off-path modules were deferred.
+IMPORT_TIME_BUDGET_MS = float(os.environ.get("IMPORT_TIME_BUDGET_MS", 760))
+RUNS = 3
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import app
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({
+    "import_ms": elapsed,
+    "chatbot_created": app._chatbot_client is not None,
+    "numpy_imported": "numpy" in sys.modules,
+    "off_path_imported": sorted({"archive", "idempotency", "jobs"} & set(sys.modules)),
+}))
+"""
+
+
+def measure_import():
+    env = dict(
+        os.environ,
+        BEDROCK_MODEL_ID="anthropic.claude-3-sonnet-20240229-v1:0",
+        DDB_TABLE_NAME="ChatbotHistory",
+        PYTHONPATH=os.pathsep.join(
+            [os.path.join(os.getcwd(), "functions", "chatbot"), os.path.join(os.getcwd(), "layers", "chatbot")]
+        ),
+    )
+    # A fresh interpreter per run so nothing is already imported.
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT], env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def test_import_time_within_budget():
+    runs = [measure_import() for _ in range(RUNS)]
+    import_ms = sorted(run["import_ms"] for run in runs)
+
+    print(
+        f"Function import: min {import_ms[0]:.0f} ms, median {import_ms[len(import_ms) // 2]:.0f} ms "
+        f"(budget {IMPORT_TIME_BUDGET_MS:.0f} ms)"
+    )
+
+    # Clients are created on the first request and optional features stay unimported
+    assert not any(run["chatbot_created"] for run in runs)
+    assert not any(run["numpy_imported"] for run in runs)
+    assert not any(run["off_path_imported"] for run in runs)
+    assert import_ms[0] <= IMPORT_TIME_BUDGET_MS
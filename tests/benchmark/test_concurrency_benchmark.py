@@ -0,0 +1,77 @@
+import time
+import boto3
+import botocore.client
+
+from unittest.mock import patch
+
+from chatbot_client import Chatbot, ExecutionMode, PersistenceMode
+from models import ContentItem, Message, Messages
+from response_cache import ResponseCache
+
+orig = botocore.client.BaseClient._make_api_call
+
+TURNS = 10
+# Simulated service latency, moto itself answers in well under a millisecond.
+BEDROCK_LATENCY_SECONDS = 0.08
+DDB_WRITE_LATENCY_SECONDS = 0.02
+
+
+def slow_make_api_call(self, operation_name, kwarg):
+    if operation_name == "Converse":
+        time.sleep(BEDROCK_LATENCY_SECONDS)
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": "Baa baa."}]}},
+            "stopReason": "end_turn",
+            "usage": {"inputTokens": 54, "outputTokens": 156, "totalTokens": 210},
+            "metrics": {"latencyMs": BEDROCK_LATENCY_SECONDS * 1000},
+        }
+    if operation_name in ("PutItem", "TransactWriteItems"):
+        time.sleep(DDB_WRITE_LATENCY_SECONDS)
+    return orig(self, operation_name, kwarg)
+
+
+def create_cache_table():
+    boto3.client("dynamodb").create_table(
+        TableName="ChatbotResponseCache",
+        KeySchema=[{"AttributeName": "cache_key", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "cache_key", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+def run_session(chatbot: Chatbot, session_id: str) -> float:
+    messages = Messages(session_id=session_id, messages=[])
+    start = time.perf_counter()
+    with patch("botocore.client.BaseClient._make_api_call", new=slow_make_api_call):
+        for turn in range(TURNS):
+            messages.append(
+                Message(role="user", content=[ContentItem(text=f"{session_id}: tell me goat fact {turn}")])
+            )
+            messages = chatbot.converse([{"text": "You are a chatbot"}], messages)
+    return (time.perf_counter() - start) / TURNS * 1000
+
+
+def test_concurrent_execution_cuts_turn_wall_time(ddb_table_name):
+    create_cache_table()
+    model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
+    results = {}
+    for mode in ExecutionMode:
+        chatbot = Chatbot(
+            model_id,
+            ddb_table_name,
+            persistence_mode=PersistenceMode.WRITE_AHEAD,
+            response_cache=ResponseCache(table_name="ChatbotResponseCache"),
+            execution_mode=mode,
+        )
+        results[mode] = run_session(chatbot, f"benchmark-{mode.value}")
+        # Every message was persisted in both modes
+        assert len(chatbot.ddb.get_messages(f"benchmark-{mode.value}").messages) == TURNS * 2
+
+    print(
+        f"Write ahead turn with shared cache: serial {results[ExecutionMode.SERIAL]:.1f} ms, "
+        f"concurrent {results[ExecutionMode.CONCURRENT]:.1f} ms"
+    )
+
+    # At least one of the two overlapped writes comes off the critical path
+    saving = results[ExecutionMode.SERIAL] - results[ExecutionMode.CONCURRENT]
+    assert saving >= DDB_WRITE_LATENCY_SECONDS * 1000
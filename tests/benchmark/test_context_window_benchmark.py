@@ -0,0 +1,59 @@
+import botocore.client
+
+from unittest.mock import patch
+
+from chatbot_client import Chatbot
+from context_window import estimate_text_tokens
+from models import ContentItem, Message, Messages
+
+orig = botocore.client.BaseClient._make_api_call
+
+TURNS = 60
+ANSWER = "Goats are browsers rather than grazers and prefer leaves and shrubs. " * 20
+
+
+def run_session(chatbot: Chatbot, session_id: str) -> list:
+    input_tokens = []
+
+    def fake_make_api_call(self, operation_name, kwarg):
+        if operation_name == "Converse":
+            # Report input tokens the way Bedrock would, from what was actually sent
+            tokens = sum(
+                estimate_text_tokens(item["text"])
+                for message in kwarg["messages"]
+                for item in message["content"]
+            )
+            input_tokens.append(tokens)
+            return {
+                "output": {"message": {"role": "assistant", "content": [{"text": ANSWER}]}},
+                "stopReason": "end_turn",
+                "usage": {"inputTokens": tokens, "outputTokens": 300, "totalTokens": tokens + 300},
+                "metrics": {"latencyMs": 0},
+            }
+        return orig(self, operation_name, kwarg)
+
+    messages = Messages(session_id=session_id, messages=[])
+    with patch("botocore.client.BaseClient._make_api_call", new=fake_make_api_call):
+        for turn in range(TURNS):
+            messages.append(
+                Message(role="user", content=[ContentItem(text=f"Tell me goat fact {turn}")])
+            )
+            messages = chatbot.converse([{"text": "You are a chatbot"}], messages)
+    return input_tokens
+
+
+def test_context_window_caps_input_tokens(ddb_table_name):
+    model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
+    unbounded = run_session(Chatbot(model_id, ddb_table_name), "benchmark-unbounded")
+    windowed = run_session(
+        Chatbot(model_id, ddb_table_name, context_token_budget=8000), "benchmark-windowed"
+    )
+
+    print(
+        f"{TURNS} turns: {sum(unbounded)} input tokens unbounded, {sum(windowed)} with an 8000 token window, "
+        f"last turn {unbounded[-1]} vs {windowed[-1]}"
+    )
+
+    assert max(windowed) <= 8000
+    assert unbounded[-1] > 8000
+    assert sum(windowed) < sum(unbounded) * 0.7
@@ -0,0 +1,53 @@
+import json
+
+import load_test
+
+
+def test_load_test_reports_latency_and_stages(tmp_path):
+    output = tmp_path / "load_test.json"
+
+    exit_code = load_test.main(
+        [
+            "--concurrency", "2",
+            "--sessions", "4",
+            "--turns", "3",
+            "--bedrock-latency-ms", "20",
+            "--bedrock-jitter-ms", "5",
+            "--output", str(output),
+        ]
+    )
+
+    assert exit_code == 0
+    report = json.loads(output.read_text())
+    assert report["requests"] == 12
+    assert report["errors"] == {}
+    assert report["latency_ms"]["p50"] >= 15
+    assert report["latency_ms"]["p50"] <= report["latency_ms"]["p95"] <= report["latency_ms"]["p99"]
+    assert report["throughput_rps"] > 0
+    # Server side history mode writes each turn once and calls the model once
+    assert {"Converse", "TransactWriteItems", "handler"} <= set(report["stages"])
+
+
+def test_throttling_is_reported_as_errors(tmp_path):
+    output = tmp_path / "load_test.json"
+
+    load_test.main(
+        [
+            "--concurrency", "1",
+            "--sessions", "2",
+            "--turns", "2",
+            "--bedrock-latency-ms", "1",
+            "--throttle-rate", "1",
+            "--output", str(output),
+        ]
+    )
+
+    report = json.loads(output.read_text())
+    assert sum(report["errors"].values()) == 4
+
+
+def test_compare_flags_regressions():
+    baseline = {"latency_ms": {"p50": 100.0, "p95": 200.0, "p99": 300.0, "max": 400.0}}
+    report = {"latency_ms": {"p50": 105.0, "p95": 260.0, "p99": 300.0, "max": 400.0}}
+
+    assert load_test.compare(report, baseline, tolerance=0.1) == ["p95 200.0 ms -> 260.0 ms"]
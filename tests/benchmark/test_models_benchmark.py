@@ -0,0 +1,70 @@
+import json
+import time
+
+from pydantic import TypeAdapter
+from typing import List
+
+from models import Message, MessageRecord, Messages
+
+SESSION_LENGTH = 1000
+RUNS = 20
+
+items = [
+    {
+        "role": "user" if index % 2 == 0 else "assistant",
+        "content": [{"text": f"Turn {index}: goats are curious and clever animals. " * 10}],
+    }
+    for index in range(SESSION_LENGTH)
+]
+payload = json.dumps({"session_id": "benchmark-session", "messages": items})
+
+
+def best_of(function) -> float:
+    timings = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def validated_round_trip():
+    decoded = json.loads(payload)
+    messages = Messages(
+        session_id=decoded["session_id"],
+        messages=TypeAdapter(List[Message]).validate_python(decoded["messages"]),
+    )
+    return json.dumps(
+        {
+            "session_id": messages.session_id,
+            "messages": [message.model_dump(mode="json") for message in messages.messages],
+        }
+    )
+
+
+def trusted_round_trip():
+    return Messages.from_json(payload).to_json()
+
+
+def test_trusted_codec_is_faster_than_validation():
+    validated_ms = best_of(validated_round_trip)
+    trusted_ms = best_of(trusted_round_trip)
+
+    print(
+        f"{SESSION_LENGTH} message session decode + encode: validated {validated_ms:.2f} ms, "
+        f"trusted {trusted_ms:.2f} ms ({validated_ms / trusted_ms:.1f}x)"
+    )
+
+    # Both paths produce the same messages
+    assert [message["content"] for message in json.loads(trusted_round_trip())["messages"]] == [
+        message["content"] for message in json.loads(validated_round_trip())["messages"]
+    ]
+    assert trusted_ms < validated_ms
+
+
+def test_record_matches_model_interface():
+    record = MessageRecord.from_dict(items[0])
+    model = Message.from_dict(items[0])
+
+    assert record.to_dict() == model.to_dict()
+    assert record.to_record() == model.to_record()
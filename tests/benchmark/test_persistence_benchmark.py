@@ -0,0 +1,40 @@
+import time
+
+from chatbot_client import Chatbot, PersistenceMode
+from models import ContentItem, Message, Messages
+
+TURNS = 25
+
+
+def run_session(chatbot: Chatbot, session_id: str):
+    messages = Messages(session_id=session_id, messages=[])
+    for turn in range(TURNS):
+        messages.append(
+            Message(role="user", content=[ContentItem(text=f"Tell me goat fact {turn}")])
+        )
+        messages = chatbot.converse([{"text": "You are a chatbot"}], messages)
+    return messages
+
+
+def test_batched_persistence_halves_write_round_trips(ddb_table_name, api_calls):
+    results = {}
+    for mode in PersistenceMode:
+        chatbot = Chatbot("anthropic.claude-3-sonnet-20240229-v1:0", ddb_table_name, persistence_mode=mode)
+        api_calls.clear()
+        start = time.perf_counter()
+        messages = run_session(chatbot, f"benchmark-{mode.value}")
+        elapsed = time.perf_counter() - start
+
+        writes = [call for call in api_calls if call in ("PutItem", "TransactWriteItems")]
+        results[mode] = len(writes)
+        print(
+            f"{mode.value}: {len(writes) / TURNS:.1f} write round trips per turn, "
+            f"{elapsed / TURNS * 1000:.2f} ms per turn against moto"
+        )
+
+        # Both modes leave the full conversation in the table
+        stored = chatbot.ddb.get_messages(messages.session_id)
+        assert len(stored.messages) == TURNS * 2
+
+    assert results[PersistenceMode.WRITE_AHEAD] == TURNS * 2
+    assert results[PersistenceMode.BATCHED] == TURNS
@@ -0,0 +1,66 @@
+import random
+import statistics
+import time
+
+from context_window import estimate_text_tokens
+from retrieval import Retriever, build_index
+
+DOCUMENTS = 200
+PARAGRAPHS = 6
+QUERIES = 200
+ANIMALS = ["goat", "sheep", "cow", "llama", "alpaca", "pig", "duck", "horse", "donkey", "hen"]
+TOPICS = ["feeding", "housing", "shearing", "milking", "breeding", "health", "fencing", "grazing"]
+
+
+def corpus() -> dict:
+    rng = random.Random(7)
+    documents = {}
+    for number in range(DOCUMENTS):
+        animal, topic = ANIMALS[number % len(ANIMALS)], TOPICS[number % len(TOPICS)]
+        paragraphs = [
+            " ".join(
+                f"The {animal} {topic} guide section {paragraph} notes {rng.choice(TOPICS)} "
+                f"and {rng.choice(ANIMALS)} care in paddock {rng.randint(1, 500)}."
+                for _ in range(8)
+            )
+            for paragraph in range(PARAGRAPHS)
+        ]
+        documents[f"{animal}/{topic}-{number}.md"] = "\n\n".join(paragraphs)
+    return documents
+
+
+def test_retrieval_is_fast_and_small_next_to_the_corpus(tmp_path):
+    path = str(tmp_path / "documents")
+    documents = corpus()
+
+    start = time.perf_counter()
+    full = build_index(path, documents)
+    full_ms = (time.perf_counter() - start) * 1000
+
+    documents["goat/new-kids.md"] = "Kids are weaned from their mothers at around three months."
+    start = time.perf_counter()
+    incremental = build_index(path, documents)
+    incremental_ms = (time.perf_counter() - start) * 1000
+
+    retriever = Retriever(path, k=3)
+    latencies = []
+    prompt_tokens = []
+    for number in range(QUERIES):
+        query = f"How should I handle {TOPICS[number % len(TOPICS)]} for my {ANIMALS[number % len(ANIMALS)]}?"
+        start = time.perf_counter()
+        system_prompts = retriever.with_passages([], query)
+        latencies.append((time.perf_counter() - start) * 1000)
+        prompt_tokens.append(sum(estimate_text_tokens(prompt["text"]) for prompt in system_prompts))
+    corpus_tokens = sum(estimate_text_tokens(text) for text in documents.values())
+    p95 = statistics.quantiles(latencies, n=20)[-1]
+
+    print(
+        f"{full['passages']} passages: full build {full_ms:.0f} ms, adding a document {incremental_ms:.0f} ms "
+        f"({incremental['embedded']} embedded); retrieval p50 {statistics.median(latencies):.2f} ms, "
+        f"p95 {p95:.2f} ms; {statistics.mean(prompt_tokens):.0f} prompt tokens vs {corpus_tokens} for the corpus"
+    )
+
+    assert incremental == {"kept": full["passages"], "embedded": 1, "passages": full["passages"] + 1}
+    assert incremental_ms < full_ms / 3
+    assert p95 < 20
+    assert max(prompt_tokens) < corpus_tokens / 50
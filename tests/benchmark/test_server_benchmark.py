@@ -0,0 +1,109 @@
+import http.client
+import json
+import os
+import sys
+import time
+import boto3
+import botocore.client
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from load_test import FakeLambdaContext, api_gateway_event
+
+sys.path.append(os.path.join(os.getcwd(), "functions", "chatbot"))
+
+orig = botocore.client.BaseClient._make_api_call
+
+REQUESTS = 80
+WORKERS = 4
+# Simulated model latency, the rest of a turn is moto and the function itself.
+BEDROCK_LATENCY_SECONDS = 0.05
+
+
+def slow_make_api_call(self, operation_name, kwarg):
+    if operation_name == "Converse":
+        time.sleep(BEDROCK_LATENCY_SECONDS)
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": "Baa baa."}]}},
+            "stopReason": "end_turn",
+            "usage": {"inputTokens": 54, "outputTokens": 156, "totalTokens": 210},
+            "metrics": {"latencyMs": BEDROCK_LATENCY_SECONDS * 1000},
+        }
+    return orig(self, operation_name, kwarg)
+
+
+def body(index: int) -> dict:
+    # A new session and prompt per request, so every turn reads and writes history
+    # and calls the model rather than the response cache.
+    return {"session_id": f"server-{index}", "prompt": f"Tell me goat fact {index}"}
+
+
+def empty_table(table_name: str):
+    # moto copies every table on each transaction, so each run starts from empty.
+    ddb_client = boto3.client("dynamodb")
+    description = ddb_client.describe_table(TableName=table_name)["Table"]
+    ddb_client.delete_table(TableName=table_name)
+    ddb_client.create_table(
+        TableName=table_name,
+        KeySchema=description["KeySchema"],
+        AttributeDefinitions=description["AttributeDefinitions"],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+def lambda_path() -> float:
+    """Requests per second through one warm container, which handles one request at a time."""
+    from app import lambda_handler
+
+    lambda_handler(api_gateway_event("/chat", body(-1)), FakeLambdaContext())
+    start = time.perf_counter()
+    for index in range(REQUESTS):
+        assert lambda_handler(api_gateway_event("/chat", body(index)), FakeLambdaContext())["statusCode"] == 200
+    return REQUESTS / (time.perf_counter() - start)
+
+
+def server_path(workers: int) -> float:
+    """Requests per second through the standalone server, with a client per worker."""
+    from server import ChatbotServer
+
+    chatbot_server = ChatbotServer(host="127.0.0.1", port=0, workers=workers)
+    chatbot_server.start()
+
+    def post(index):
+        connection = http.client.HTTPConnection(*chatbot_server.server_address, timeout=30)
+        connection.request("POST", "/chat", body=json.dumps(body(index)))
+        return connection.getresponse().status
+
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            # Warm every worker up, as the Lambda container was.
+            list(executor.map(post, range(-workers, 0)))
+            start = time.perf_counter()
+            statuses = list(executor.map(post, range(REQUESTS)))
+            elapsed = time.perf_counter() - start
+    finally:
+        chatbot_server.stop()
+    assert statuses == [200] * REQUESTS
+    return REQUESTS / elapsed
+
+
+def test_server_throughput_against_lambda(ddb_table_name):
+    os.environ["BEDROCK_MODEL_ID"] = "anthropic.claude-3-sonnet-20240229-v1:0"
+    with patch("botocore.client.BaseClient._make_api_call", new=slow_make_api_call):
+        results = {}
+        for name, run in (
+            ("lambda container", lambda_path),
+            ("server, 1 worker", lambda: server_path(1)),
+            (f"server, {WORKERS} workers", lambda: server_path(WORKERS)),
+        ):
+            empty_table(ddb_table_name)
+            results[name] = run()
+
+    for name, rps in results.items():
+        print(f"{name}: {rps:.1f} requests/s")
+
+    # One worker costs about what one container does, the HTTP layer is small.
+    assert results["server, 1 worker"] > results["lambda container"] * 0.7
+    # Workers serve requests concurrently from the one listening socket.
+    assert results[f"server, {WORKERS} workers"] > results["lambda container"] * WORKERS / 2
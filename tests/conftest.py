@@ -14,6 +14,10 @@ class LambdaContext:
         self.aws_request_id = context.get("aws_request_id", "test-request-id")
         self.log_group_name = context.get("log_group_name", "test-log-group")
         self.log_stream_name = context.get("log_stream_name", "test-log-stream")
+        self.remaining_time_in_millis = context.get("remaining_time_in_millis", 30000)
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_time_in_millis
 
 
 @pytest.fixture
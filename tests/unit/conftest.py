@@ -4,6 +4,9 @@ import boto3
 
 from moto import mock_aws
 
+# Read when the metrics singleton is created, which can be at collection time.
+os.environ.setdefault("POWERTOOLS_METRICS_NAMESPACE", "ServerlessChatbot")
+
 @pytest.fixture(autouse=True)
 def aws_credentials():
     """Mocked AWS Credentials for moto."""
@@ -0,0 +1,92 @@
+import base64
+import boto3
+import gzip
+import json
+import os
+import sys
+
+from importlib import reload
+from moto import mock_aws
+
+sys.path.append(os.path.join(os.getcwd(), "functions"))
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from codec import encode_content
+
+LONG_ANSWER = "Goats can climb trees and steep cliffs, and they are very curious. " * 30
+
+
+def remove_record(sequence, principal):
+    return {
+        "eventID": str(sequence),
+        "eventName": "REMOVE",
+        "eventSource": "aws:dynamodb",
+        "awsRegion": "us-east-1",
+        "dynamodb": {
+            "Keys": {"session_id": {"S": "expired"}, "sequence": {"N": str(sequence)}},
+            "OldImage": {
+                "session_id": {"S": "expired"},
+                "sequence": {"N": str(sequence)},
+                "role": {"S": "user"},
+                "content": {"L": [{"M": {"text": {"S": f"Goat fact {sequence}"}}}]},
+                "expires_at": {"N": "1"},
+            },
+            "StreamViewType": "OLD_IMAGE",
+        },
+        "userIdentity": {"type": "Service", "principalId": principal},
+    }
+
+
+def compressed_remove_record(sequence):
+    item = encode_content({"role": "assistant", "content": [{"text": LONG_ANSWER}]})
+    record = remove_record(sequence, "dynamodb.amazonaws.com")
+    image = record["dynamodb"]["OldImage"]
+    del image["content"]
+    # Binary attributes arrive base64 encoded in the stream's JSON.
+    image["content_z"] = {"B": base64.b64encode(item["content_z"]).decode("ascii")}
+    image["codec"] = {"S": item["codec"]}
+    image["format_version"] = {"N": str(item["format_version"])}
+    return record
+
+
+def archived_records():
+    (obj,) = boto3.client("s3").list_objects_v2(Bucket="chatbot-archive")["Contents"]
+    body = boto3.client("s3").get_object(Bucket="chatbot-archive", Key=obj["Key"])["Body"].read()
+    return [json.loads(line) for line in gzip.decompress(body).splitlines()]
+
+
+@mock_aws
+class TestArchiver:
+    def test_archives_only_ttl_deletes(self, base_lambda_context, create_ddb_table):
+        boto3.client("s3").create_bucket(Bucket="chatbot-archive")
+        os.environ["ARCHIVE_BUCKET_NAME"] = "chatbot-archive"
+        from archiver.app import lambda_handler
+        app = reload(sys.modules["archiver.app"])
+
+        event = {
+            "Records": [
+                remove_record(1, "dynamodb.amazonaws.com"),
+                # A delete made by the archiver itself is already archived.
+                remove_record(2, "arn:aws:sts::123456789012:assumed-role/archiver"),
+            ]
+        }
+        assert app.lambda_handler(event, base_lambda_context) == {"archived_items": 1}
+
+        (obj,) = boto3.client("s3").list_objects_v2(Bucket="chatbot-archive")["Contents"]
+        assert obj["Key"].startswith("sessions/expired/")
+        body = boto3.client("s3").get_object(Bucket="chatbot-archive", Key=obj["Key"])["Body"].read()
+        assert b"Goat fact 1" in gzip.decompress(body)
+        assert app.get_archiver().ddb.get_session_state("expired") == {"archived_through": 1}
+
+    def test_archives_compressed_items(self, base_lambda_context, create_ddb_table):
+        boto3.client("s3").create_bucket(Bucket="chatbot-archive")
+        os.environ["ARCHIVE_BUCKET_NAME"] = "chatbot-archive"
+        from archiver.app import lambda_handler
+        app = reload(sys.modules["archiver.app"])
+
+        event = {"Records": [compressed_remove_record(2)]}
+        assert app.lambda_handler(event, base_lambda_context) == {"archived_items": 1}
+
+        (record,) = archived_records()
+        assert record["content"] == [{"text": LONG_ANSWER}]
+        assert "content_z" not in record
@@ -1,8 +1,10 @@
 import json
 import boto3
 import botocore.client
+import botocore.exceptions
 import os
 import sys
+import threading
 import pytest
 
 from importlib import reload
@@ -56,6 +58,26 @@ def mock_make_api_call(self, operation_name, kwarg):
         if len(kwarg["messages"]) == 3:
             response["output"]["message"]["content"][0]["text"] = test_messages[3]
             return response
+    if operation_name == "ConverseStream":
+        # Fake event stream splitting the canned response into a handful of text deltas
+        text = test_messages[1] if len(kwarg["messages"]) == 1 else test_messages[3]
+        chunks = [text[i : i + 64] for i in range(0, len(text), 64)]
+        stream = [{"messageStart": {"role": "assistant"}}]
+        stream += [
+            {"contentBlockDelta": {"delta": {"text": chunk}, "contentBlockIndex": 0}}
+            for chunk in chunks
+        ]
+        stream += [
+            {"contentBlockStop": {"contentBlockIndex": 0}},
+            {"messageStop": {"stopReason": "end_turn"}},
+            {
+                "metadata": {
+                    "usage": {"inputTokens": 54, "outputTokens": 156, "totalTokens": 210},
+                    "metrics": {"latencyMs": 3466},
+                }
+            },
+        ]
+        return {"stream": iter(stream)}
     return orig(self, operation_name, kwarg)
 
 
@@ -105,6 +127,9 @@ class TestBedrockChatbot:
         assert items[1]["session_id"] == session_id
         assert items[1]["role"] == "assistant"
         assert items[1]["content"][0]["text"] == test_messages[1]
+        # The model that answered is recorded on the assistant message only
+        assert items[1]["model_id"] == bedrock_model_id
+        assert "model_id" not in items[0]
 
     def test_chatbot_two_interaction_success(
         self,
@@ -186,6 +211,497 @@ class TestBedrockChatbot:
         assert items[3]["role"] == "assistant"
         assert items[3]["content"][0]["text"] == test_messages[3]
 
+    def test_chatbot_server_side_history_success(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+
+        # First turn starts a new session
+        event = chatbot_lambda_event
+        event["body"] = json.dumps({"prompt": test_messages[0], "messages": []})
+        with patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+            response = lambda_handler(event, base_lambda_context)
+        assert response["statusCode"] == 200
+        session_id = json.loads(response["body"])["session_id"]
+
+        # Drop the warm session cache so the history has to be read back from DynamoDB
+        app.get_chatbot_client().sessions.clear()
+
+        # Second turn only sends the session id and the new prompt
+        event["body"] = json.dumps({"session_id": session_id, "prompt": test_messages[2]})
+        with patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+            response = lambda_handler(event, base_lambda_context)
+
+        # Verify the conversation was rebuilt from the table before calling the model
+        assert response["statusCode"] == 200
+        body = json.loads(response["body"])
+        assert len(body["messages"]) == 4
+        assert body["messages"][0]["content"][0]["text"] == test_messages[0]
+        assert body["messages"][3]["content"][0]["text"] == test_messages[3]
+        items = self._get_current_items(session_id)
+        assert len(items) == 4
+        assert items[3]["content"][0]["text"] == test_messages[3]
+
+    def test_chatbot_server_side_history_uses_session_cache(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+
+        event = chatbot_lambda_event
+        event["body"] = json.dumps({"prompt": test_messages[0], "messages": []})
+        with patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+            response = lambda_handler(event, base_lambda_context)
+        session_id = json.loads(response["body"])["session_id"]
+
+        # Record the API calls made for the follow up turn
+        operations = []
+
+        def recording_make_api_call(self, operation_name, kwarg):
+            operations.append(operation_name)
+            return mock_make_api_call(self, operation_name, kwarg)
+
+        event["body"] = json.dumps({"session_id": session_id, "prompt": test_messages[2]})
+        with patch("botocore.client.BaseClient._make_api_call", new=recording_make_api_call):
+            response = lambda_handler(event, base_lambda_context)
+
+        # The warm container already holds the session so no Query is needed
+        assert response["statusCode"] == 200
+        assert len(json.loads(response["body"])["messages"]) == 4
+        assert "Query" not in operations
+
+    def test_chatbot_stream_success(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+
+        # Call the streaming route rather than /chat
+        event = chatbot_lambda_event
+        event["path"] = "/chat/stream"
+        event["resource"] = "/chat/stream"
+        event["body"] = json.dumps({"prompt": test_messages[0], "messages": []})
+        with patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+            response = lambda_handler(event, base_lambda_context)
+
+        # The body is newline delimited JSON, text deltas followed by the full conversation
+        assert response["statusCode"] == 200
+        lines = [json.loads(line) for line in response["body"].splitlines()]
+        deltas = [line["delta"] for line in lines[:-1]]
+        assert len(deltas) > 1
+        assert "".join(deltas) == test_messages[1]
+        body = lines[-1]
+        assert len(body["messages"]) == 2
+        assert body["messages"][1]["role"] == "assistant"
+        assert body["messages"][1]["content"][0]["text"] == test_messages[1]
+
+        # The assembled assistant message is persisted once the stream closes
+        items = self._get_current_items(body["session_id"])
+        assert len(items) == 2
+        assert items[1]["role"] == "assistant"
+        assert items[1]["content"][0]["text"] == test_messages[1]
+
+    def test_chatbot_emits_metrics(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+        capsys,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+
+        event = chatbot_lambda_event
+        event["body"] = json.dumps({"prompt": test_messages[0], "messages": []})
+        with patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+            app.lambda_handler(event, base_lambda_context)
+            capsys.readouterr()
+            event["body"] = json.dumps({"prompt": test_messages[0] + "?", "messages": []})
+            response = app.lambda_handler(event, base_lambda_context)
+        assert response["statusCode"] == 200
+
+        # Metrics are printed as EMF blobs alongside the JSON log lines
+        blobs = [json.loads(line) for line in capsys.readouterr().out.splitlines() if '"_aws"' in line]
+        assert len(blobs) == 1
+        blob = blobs[0]
+        assert blob["ModelId"] == bedrock_model_id
+        assert blob["Start"] == "warm"
+        for name in ["ValidationLatency", "TurnLatency", "BedrockLatency", "DynamoDBTransactWriteItemsLatency"]:
+            assert blob[name][0] >= 0
+        assert blob["BedrockModelLatency"] == [3466]
+        assert blob["BedrockRetryAttempts"] == [5]
+        assert blob["InputTokens"] == [54]
+        assert blob["OutputTokens"] == [156]
+        assert blob["TotalTokens"] == [210]
+        assert blob["StopReasonEndTurn"] == [1]
+
+    def test_chatbot_counts_background_writes_left_running(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+        capsys,
+        monkeypatch,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        monkeypatch.setenv("BACKGROUND_DRAIN_MS", "50")
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+
+        event = chatbot_lambda_event
+        event["body"] = json.dumps({"prompt": test_messages[0], "messages": []})
+        released = threading.Event()
+        with patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+            app.lambda_handler(event, base_lambda_context)
+            # A shared cache write that outlasts the bound on waiting for it.
+            app._chatbot_client.writer.submit(released.wait)
+            capsys.readouterr()
+            response = app.lambda_handler(event, base_lambda_context)
+        released.set()
+        assert response["statusCode"] == 200
+
+        blobs = [json.loads(line) for line in capsys.readouterr().out.splitlines() if '"_aws"' in line]
+        assert blobs[0]["BackgroundWritesUnfinished"] == [1]
+
+    def test_chatbot_throttled_returns_retry_after(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+
+        def throttled_make_api_call(self, operation_name, kwarg):
+            if operation_name == "Converse":
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}},
+                    operation_name,
+                )
+            return orig(self, operation_name, kwarg)
+
+        # Too little time left to retry, so the throttle is returned straight away
+        base_lambda_context.remaining_time_in_millis = 1000
+        event = chatbot_lambda_event
+        event["body"] = json.dumps({"prompt": test_messages[0], "messages": []})
+        with patch("botocore.client.BaseClient._make_api_call", new=throttled_make_api_call):
+            response = app.lambda_handler(event, base_lambda_context)
+
+        assert response["statusCode"] == 429
+        assert int(response["multiValueHeaders"]["Retry-After"][0]) >= 1
+
+    def test_chatbot_session_write_conflict_returns_409(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+
+        def contended_make_api_call(self, operation_name, kwarg):
+            # Other writers take the session's next sequences on every attempt
+            if operation_name == "TransactWriteItems":
+                raise botocore.exceptions.ClientError(
+                    {
+                        "Error": {"Code": "TransactionCanceledException", "Message": "Transaction cancelled"},
+                        "CancellationReasons": [{"Code": "ConditionalCheckFailed"}, {"Code": "None"}],
+                    },
+                    operation_name,
+                )
+            return mock_make_api_call(self, operation_name, kwarg)
+
+        event = chatbot_lambda_event
+        event["body"] = json.dumps({"session_id": "shared", "prompt": test_messages[0], "use_cache": False})
+        with patch("botocore.client.BaseClient._make_api_call", new=contended_make_api_call):
+            response = app.lambda_handler(event, base_lambda_context)
+
+        assert response["statusCode"] == 409
+        assert int(response["multiValueHeaders"]["Retry-After"][0]) >= 1
+        assert len(self._get_current_items("shared")) == 0
+
+    def test_chatbot_batch_returns_per_item_results(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+
+        def failing_make_api_call(self, operation_name, kwarg):
+            # The model rejects one of the prompts in the batch
+            if operation_name == "Converse" and kwarg["messages"][-1]["content"][0]["text"] == "reject me":
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "ValidationException", "Message": "Bad prompt"}},
+                    operation_name,
+                )
+            return mock_make_api_call(self, operation_name, kwarg)
+
+        event = chatbot_lambda_event
+        event["path"] = "/chat/batch"
+        event["resource"] = "/chat/batch"
+        event["body"] = json.dumps(
+            {
+                "items": [
+                    {"session_id": "batch-1", "prompt": test_messages[0], "messages": []},
+                    {"session_id": "batch-2", "prompt": "reject me", "messages": []},
+                    {"session_id": "batch-3", "prompt": test_messages[0], "messages": []},
+                ]
+            }
+        )
+        with patch("botocore.client.BaseClient._make_api_call", new=failing_make_api_call):
+            response = app.lambda_handler(event, base_lambda_context)
+
+        # One bad item doesn't fail the batch, results are in request order
+        assert response["statusCode"] == 200
+        results = json.loads(response["body"])["results"]
+        assert [result["session_id"] for result in results] == ["batch-1", "batch-2", "batch-3"]
+        assert [result["status_code"] for result in results] == [200, 502, 200]
+        assert results[0]["messages"][1]["content"][0]["text"] == test_messages[1]
+        assert results[1]["error"] == "ValidationException"
+
+        # Only the completed turns are persisted
+        assert len(self._get_current_items("batch-1")) == 2
+        assert len(self._get_current_items("batch-2")) == 0
+        assert len(self._get_current_items("batch-3")) == 2
+
+    def test_chatbot_batch_rejects_duplicate_sessions(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+
+        event = chatbot_lambda_event
+        event["path"] = "/chat/batch"
+        event["resource"] = "/chat/batch"
+        event["body"] = json.dumps(
+            {"items": [{"session_id": "same", "prompt": "one"}, {"session_id": "same", "prompt": "two"}]}
+        )
+        response = app.lambda_handler(event, base_lambda_context)
+
+        assert response["statusCode"] == 422
+
+    def test_chatbot_async_job_success(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+        from jobs import JobStore, JobWorker, LocalJobQueue
+
+        # Stand the in process queue in for SQS
+        boto3.client("dynamodb").create_table(
+            TableName="ChatbotJobs",
+            KeySchema=[{"AttributeName": "job_id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "job_id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        app._job_queue = LocalJobQueue()
+        app._job_store = JobStore("ChatbotJobs")
+
+        # Submitting returns straight away without calling the model
+        event = chatbot_lambda_event
+        event["body"] = json.dumps({"prompt": test_messages[0], "messages": [], "async": True})
+        with patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+            response = app.lambda_handler(event, base_lambda_context)
+        assert response["statusCode"] == 202
+        submitted = json.loads(response["body"])
+        assert submitted["status"] == "pending"
+        assert self._get_current_items(submitted["session_id"]) == []
+
+        poll = dict(chatbot_lambda_event, httpMethod="GET", body=None)
+        poll["path"] = poll["resource"] = f"/jobs/{submitted['job_id']}"
+        response = app.lambda_handler(poll, base_lambda_context)
+        assert json.loads(response["body"])["status"] == "pending"
+
+        # The worker runs the turn and records the result on the job and in the history
+        worker = JobWorker(app.get_chatbot_client(), app._job_store)
+        with patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+            app._job_queue.drain(worker.process)
+
+        response = app.lambda_handler(poll, base_lambda_context)
+        assert response["statusCode"] == 200
+        job = json.loads(response["body"])
+        assert job["status"] == "succeeded"
+        assert job["result"]["session_id"] == submitted["session_id"]
+        assert job["result"]["message"]["content"][0]["text"] == test_messages[1]
+        items = self._get_current_items(submitted["session_id"])
+        assert [item["role"] for item in items] == ["user", "assistant"]
+
+        # Unknown jobs are a 404
+        poll["path"] = poll["resource"] = "/jobs/missing"
+        assert app.lambda_handler(poll, base_lambda_context)["statusCode"] == 404
+
+    def test_chatbot_async_job_that_cannot_be_queued(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+        from jobs import MAX_JOB_PAYLOAD_BYTES, JobStore, LocalJobQueue
+
+        boto3.client("dynamodb").create_table(
+            TableName="ChatbotJobs",
+            KeySchema=[{"AttributeName": "job_id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "job_id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        app._job_queue = LocalJobQueue()
+        app._job_store = JobStore("ChatbotJobs")
+
+        # A history too large for a queue message is refused before a job is recorded
+        event = chatbot_lambda_event
+        history = [{"role": "user", "content": [{"text": "goat " * MAX_JOB_PAYLOAD_BYTES}]}]
+        event["body"] = json.dumps({"prompt": test_messages[0], "messages": history, "async": True})
+        response = app.lambda_handler(event, base_lambda_context)
+        assert response["statusCode"] == 400
+        assert boto3.client("dynamodb").scan(TableName="ChatbotJobs")["Items"] == []
+
+        # A job whose send fails is marked failed rather than left pending
+        def fail_send(job):
+            raise botocore.exceptions.EndpointConnectionError(endpoint_url="https://sqs")
+
+        app._job_queue.send = fail_send
+        event["body"] = json.dumps({"prompt": test_messages[0], "messages": [], "async": True})
+        with pytest.raises(botocore.exceptions.EndpointConnectionError):
+            app.lambda_handler(event, base_lambda_context)
+        (job,) = boto3.client("dynamodb").scan(TableName="ChatbotJobs")["Items"]
+        assert job["status"]["S"] == "failed"
+
+    def test_chatbot_session_messages_pages(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+
+        event = chatbot_lambda_event
+        event["body"] = json.dumps({"prompt": test_messages[0], "messages": []})
+        with patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+            session_id = json.loads(lambda_handler(event, base_lambda_context)["body"])["session_id"]
+            event["body"] = json.dumps({"session_id": session_id, "prompt": test_messages[2]})
+            lambda_handler(event, base_lambda_context)
+
+        def get_page(**params):
+            request = dict(chatbot_lambda_event, httpMethod="GET", body=None)
+            request["path"] = f"/sessions/{session_id}/messages"
+            request["resource"] = "/sessions/{session_id}/messages"
+            request["pathParameters"] = {"session_id": session_id}
+            request["queryStringParameters"] = params
+            request["multiValueQueryStringParameters"] = {key: [value] for key, value in params.items()}
+            return app.lambda_handler(request, base_lambda_context)
+
+        # A listing view only gets the projected attributes
+        response = get_page(limit="3", fields="role,sequence,preview")
+        assert response["statusCode"] == 200
+        page = json.loads(response["body"])
+        assert [message["sequence"] for message in page["messages"]] == [1, 2, 3]
+        assert set(page["messages"][1]) == {"role", "sequence", "preview"}
+        assert page["messages"][1]["preview"] == test_messages[1][:120]
+
+        # The cursor picks up where the last page stopped
+        page = json.loads(get_page(limit="3", cursor=page["cursor"])["body"])
+        assert [message["sequence"] for message in page["messages"]] == [4]
+        assert page["messages"][0]["content"][0]["text"] == test_messages[3]
+
+        page = json.loads(get_page(limit="2", order="desc", fields="sequence")["body"])
+        assert page["messages"] == [{"sequence": 4}, {"sequence": 3}]
+
+        assert get_page(cursor="not-a-cursor")["statusCode"] == 400
+        assert get_page(fields="role,password")["statusCode"] == 400
+        assert get_page(limit="1000")["statusCode"] == 422
+
+    def test_chatbot_idempotent_retry(
+        self,
+        bedrock_model_id,
+        chatbot_lambda_event,
+        base_lambda_context,
+        create_ddb_table,
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        from chatbot.app import lambda_handler
+        app = reload(sys.modules["chatbot.app"])
+        from idempotency import IdempotencyStore
+
+        boto3.client("dynamodb").create_table(
+            TableName="ChatbotIdempotency",
+            KeySchema=[{"AttributeName": "idempotency_key", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "idempotency_key", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        app._idempotency_store = IdempotencyStore("ChatbotIdempotency")
+        converse_calls = []
+
+        def counting_make_api_call(self, operation_name, kwarg):
+            if operation_name == "Converse":
+                converse_calls.append(kwarg)
+            return mock_make_api_call(self, operation_name, kwarg)
+
+        def post(body, key=None):
+            event = dict(chatbot_lambda_event, body=json.dumps(body))
+            event["headers"] = dict(event["headers"], **({"Idempotency-Key": key} if key else {}))
+            with patch("botocore.client.BaseClient._make_api_call", new=counting_make_api_call):
+                return app.lambda_handler(event, base_lambda_context)
+
+        # A client side history retry is recognised by its session and sequence
+        body = {"session_id": "client-side", "prompt": test_messages[0], "messages": []}
+        first, retry = post(body), post(body)
+        assert first["body"] == retry["body"]
+        assert len(converse_calls) == 1
+
+        # A server side history retry needs the client's key, the history has moved on
+        body = {"session_id": "server-side", "prompt": test_messages[0], "use_cache": False}
+        first, retry = post(body, key="turn-1"), post(body, key="turn-1")
+        assert first["body"] == retry["body"]
+        assert len(converse_calls) == 2
+        assert len(self._get_current_items("server-side")) == 2
+
+        # Reusing a key for a different request is an error
+        assert post(dict(body, prompt=test_messages[2]), key="turn-1")["statusCode"] == 400
+
     # Get the current items from the mock DDB table based on the session id.
     def _get_current_items(self, session_id):
         table_name = os.environ["DDB_TABLE_NAME"]
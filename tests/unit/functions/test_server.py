@@ -0,0 +1,118 @@
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import botocore.client
+
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.getcwd(), "functions", "chatbot"))
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+orig = botocore.client.BaseClient._make_api_call
+
+# Long enough for the shutdown to start while the request is in flight.
+BEDROCK_LATENCY_SECONDS = 0.5
+
+
+def slow_make_api_call(self, operation_name, kwarg):
+    if operation_name == "Converse":
+        time.sleep(BEDROCK_LATENCY_SECONDS)
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": "Baa baa."}]}},
+            "stopReason": "end_turn",
+            "usage": {"inputTokens": 54, "outputTokens": 156, "totalTokens": 210},
+            "metrics": {"latencyMs": 500},
+        }
+    return orig(self, operation_name, kwarg)
+
+
+def streaming_make_api_call(self, operation_name, kwarg):
+    if operation_name == "ConverseStream":
+
+        def events():
+            yield {"messageStart": {"role": "assistant"}}
+            yield {"contentBlockDelta": {"delta": {"text": "Baa"}, "contentBlockIndex": 0}}
+            # The rest of the answer takes a while to generate.
+            time.sleep(BEDROCK_LATENCY_SECONDS)
+            yield {"contentBlockDelta": {"delta": {"text": " baa."}, "contentBlockIndex": 0}}
+            yield {"contentBlockStop": {"contentBlockIndex": 0}}
+            yield {"messageStop": {"stopReason": "end_turn"}}
+            yield {
+                "metadata": {
+                    "usage": {"inputTokens": 54, "outputTokens": 2, "totalTokens": 56},
+                    "metrics": {"latencyMs": 500},
+                }
+            }
+
+        return {"stream": events()}
+    return orig(self, operation_name, kwarg)
+
+
+def request(address, method, path, body=None):
+    connection = http.client.HTTPConnection(*address, timeout=10)
+    connection.request(method, path, body=json.dumps(body) if body is not None else None)
+    response = connection.getresponse()
+    return response.status, response.read().decode("utf-8")
+
+
+class TestServer:
+    def test_server_serves_routes_and_stops_gracefully(self, create_ddb_table):
+        os.environ["BEDROCK_MODEL_ID"] = "anthropic.claude-3-sonnet-20240229-v1:0"
+        from server import ChatbotServer
+
+        with patch("botocore.client.BaseClient._make_api_call", new=slow_make_api_call):
+            # Workers are forked with the patched Bedrock and moto tables.
+            chatbot_server = ChatbotServer(host="127.0.0.1", port=0, workers=2)
+            chatbot_server.start()
+            try:
+                address = chatbot_server.server_address
+                status, body = request(address, "GET", "/sessions/goats/messages?limit=0")
+                assert status == 422
+                assert request(address, "GET", "/nothing-here")[0] == 404
+
+                results = []
+                chat = threading.Thread(
+                    target=lambda: results.append(
+                        request(address, "POST", "/chat", {"session_id": "goats", "prompt": "Hi", "messages": []})
+                    )
+                )
+                chat.start()
+                time.sleep(BEDROCK_LATENCY_SECONDS / 2)
+            finally:
+                chatbot_server.stop(grace_seconds=10)
+            chat.join()
+
+        # The request in flight when the shutdown started was still answered.
+        status, body = results[0]
+        assert status == 200
+        assert json.loads(body)["messages"][1]["content"][0]["text"] == "Baa baa."
+
+    def test_stream_is_written_as_it_is_generated(self, create_ddb_table):
+        os.environ["BEDROCK_MODEL_ID"] = "anthropic.claude-3-sonnet-20240229-v1:0"
+        from server import ChatbotServer
+
+        with patch("botocore.client.BaseClient._make_api_call", new=streaming_make_api_call):
+            chatbot_server = ChatbotServer(host="127.0.0.1", port=0, workers=1)
+            chatbot_server.start()
+            try:
+                connection = http.client.HTTPConnection(*chatbot_server.server_address, timeout=10)
+                start = time.perf_counter()
+                connection.request("POST", "/chat/stream", body=json.dumps({"prompt": "Hi", "messages": []}))
+                response = connection.getresponse()
+                first = json.loads(response.readline())
+                first_ms = (time.perf_counter() - start) * 1000
+                lines = [json.loads(line) for line in response.read().splitlines()]
+                total_ms = (time.perf_counter() - start) * 1000
+            finally:
+                chatbot_server.stop(grace_seconds=10)
+
+        assert response.status == 200
+        assert response.getheader("Content-Type") == "application/x-ndjson"
+        # The first delta arrived while the model was still generating the rest.
+        assert first == {"delta": "Baa"}
+        assert total_ms - first_ms >= BEDROCK_LATENCY_SECONDS * 1000 * 0.9
+        assert lines[0] == {"delta": " baa."}
+        assert lines[-1]["messages"][1]["content"][0]["text"] == "Baa baa."
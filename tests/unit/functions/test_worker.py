@@ -0,0 +1,93 @@
+import json
+import boto3
+import botocore.client
+import botocore.exceptions
+import os
+import sys
+
+from importlib import reload
+from unittest.mock import patch
+from moto import mock_aws
+
+sys.path.append(os.path.join(os.getcwd(), "functions"))
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+orig = botocore.client.BaseClient._make_api_call
+
+
+def mock_make_api_call(self, operation_name, kwarg):
+    if operation_name == "Converse":
+        if kwarg["messages"][-1]["content"][0]["text"] == "throttle me":
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}},
+                operation_name,
+            )
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": "Baa baa."}]}},
+            "stopReason": "end_turn",
+            "usage": {"inputTokens": 54, "outputTokens": 156, "totalTokens": 210},
+            "metrics": {"latencyMs": 100},
+        }
+    return orig(self, operation_name, kwarg)
+
+
+def sqs_record(message_id, job):
+    return {
+        "messageId": message_id,
+        "receiptHandle": message_id,
+        "body": json.dumps(job),
+        "attributes": {"ApproximateReceiveCount": "1"},
+        "messageAttributes": {},
+        "md5OfBody": "",
+        "eventSource": "aws:sqs",
+        "eventSourceARN": "arn:aws:sqs:us-east-1:123456789012:ChatbotJobQueue",
+        "awsRegion": "us-east-1",
+    }
+
+
+@mock_aws
+class TestWorker:
+    def test_worker_runs_jobs_and_reports_throttled_ones(
+        self, bedrock_model_id, base_lambda_context, create_ddb_table
+    ):
+        os.environ["BEDROCK_MODEL_ID"] = bedrock_model_id
+        os.environ["JOBS_TABLE_NAME"] = "ChatbotJobs"
+        boto3.client("dynamodb").create_table(
+            TableName="ChatbotJobs",
+            KeySchema=[{"AttributeName": "job_id", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "job_id", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        from worker.app import lambda_handler
+        app = reload(sys.modules["worker.app"])
+        from jobs import JobStore, new_job
+
+        store = JobStore("ChatbotJobs")
+        system_prompts = [{"text": "You are a chatbot"}]
+        succeeded = new_job(system_prompts, "session-1", "Create me a nursery rhyme about goats", messages=[])
+        throttled = new_job(system_prompts, "session-2", "throttle me", messages=[])
+        for job in (succeeded, throttled):
+            store.put(job)
+
+        # Too little time left to retry the throttled job in this invocation
+        base_lambda_context.remaining_time_in_millis = 1000
+        event = {"Records": [sqs_record("1", succeeded), sqs_record("2", throttled)]}
+        with patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+            response = app.lambda_handler(event, base_lambda_context)
+
+        # The throttled message is handed back to SQS for redelivery
+        assert response == {"batchItemFailures": [{"itemIdentifier": "2"}]}
+        assert store.get(succeeded["job_id"])["status"] == "succeeded"
+        assert store.get(succeeded["job_id"])["result"]["message"]["content"][0]["text"] == "Baa baa."
+        assert store.get(throttled["job_id"])["status"] == "pending"
+
+        # A redelivered job that already succeeded isn't run again
+        with patch("botocore.client.BaseClient._make_api_call", new=mock_make_api_call):
+            response = app.lambda_handler({"Records": [sqs_record("1", succeeded)]}, base_lambda_context)
+        assert response == {"batchItemFailures": []}
+        history = boto3.client("dynamodb").query(
+            TableName=os.environ["DDB_TABLE_NAME"],
+            KeyConditionExpression="session_id = :session_id",
+            ExpressionAttributeValues={":session_id": {"S": "session-1"}},
+        )
+        assert history["Count"] == 2
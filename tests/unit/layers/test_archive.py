@@ -0,0 +1,150 @@
+import gzip
+import json
+import os
+import sys
+import time
+import pytest
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from archive import LocalArchiveStore
+from chatbot_client import Chatbot, ExecutionMode
+from dynamodb import ARCHIVE_SEQUENCE, DynamoDB
+from resilience import start_deadline
+from models import ContentRecord, MessageRecord, Messages, Role
+
+LONG_ANSWER = "Goats can climb trees and steep cliffs, and they are very curious. " * 30
+TTL_SECONDS = 3600
+
+
+def session():
+    messages = Messages(session_id="archived", messages=[])
+    for prompt, answer in (("Tell me about goats", LONG_ANSWER), ("And kids?", "Baby goats are kids.")):
+        messages.append(MessageRecord(Role.USER, [ContentRecord(prompt)]))
+        messages.append(MessageRecord(Role.ASSISTANT, [ContentRecord(answer)]))
+    return messages
+
+
+@pytest.fixture(autouse=True)
+def no_deadline():
+    start_deadline(None)
+    yield
+    start_deadline(None)
+
+
+def turn(session_id):
+    messages = Messages(session_id=session_id, messages=[])
+    messages.append(MessageRecord(Role.USER, [ContentRecord("Hello")]))
+    messages.append(MessageRecord(Role.ASSISTANT, [ContentRecord("Baa.")]))
+    return messages
+
+
+def chatbot(tmp_path):
+    return Chatbot(
+        "anthropic.claude-3-sonnet-20240229-v1:0",
+        os.environ["DDB_TABLE_NAME"],
+        execution_mode=ExecutionMode.SERIAL,
+        session_ttl_seconds=TTL_SECONDS,
+        archive_store=LocalArchiveStore(str(tmp_path)),
+    )
+
+
+def stored_items(ddb_client):
+    return ddb_client.query(
+        TableName=os.environ["DDB_TABLE_NAME"],
+        KeyConditionExpression="session_id = :session_id",
+        ExpressionAttributeValues={":session_id": {"S": "archived"}},
+    )["Items"]
+
+
+class TestArchive:
+    def test_items_are_written_with_ttl(self, ddb_client, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"], ttl_seconds=TTL_SECONDS)
+
+        ddb.save_last_messages(session(), count=4)
+
+        for item in stored_items(ddb_client):
+            assert abs(int(item["expires_at"]["N"]) - (time.time() + TTL_SECONDS)) < 60
+
+    def test_idle_session_is_archived_and_rehydrated(self, ddb_client, create_ddb_table, tmp_path):
+        client = chatbot(tmp_path)
+        client.ddb.save_last_messages(session(), count=4)
+
+        assert list(client.ddb.idle_sessions(TTL_SECONDS * 2)) == []
+        assert client.archiver.archive_idle(0) == 1
+
+        # Only the marker is left in the table, the session is gzipped JSONL in the archive.
+        items = stored_items(ddb_client)
+        assert [int(item["sequence"]["N"]) for item in items] == [ARCHIVE_SEQUENCE]
+        (key,) = LocalArchiveStore(str(tmp_path)).list("archived/")
+        records = [json.loads(line) for line in gzip.decompress((tmp_path / key).read_bytes()).splitlines()]
+        assert [record["sequence"] for record in records] == [1, 2, 3, 4]
+        assert records[1]["content"][0]["text"] == LONG_ANSWER
+
+        # Resuming the session restores it transparently.
+        messages = client.get_history("archived")
+        assert [message.content[0].text for message in messages.messages] == [
+            "Tell me about goats",
+            LONG_ANSWER,
+            "And kids?",
+            "Baby goats are kids.",
+        ]
+        items = stored_items(ddb_client)
+        assert [int(item["sequence"]["N"]) for item in items] == [1, 2, 3, 4]
+        assert all("expires_at" in item for item in items)
+
+    def test_expired_items_are_archived_and_rehydrated(self, ddb_client, create_ddb_table, tmp_path):
+        client = chatbot(tmp_path)
+        client.ddb.save_last_messages(session(), count=4)
+
+        # TTL removes the oldest turn, the stream hands its old images to the archiver.
+        expired = [item for item in client.ddb.get_items("archived") if item["sequence"] <= 2]
+        client.ddb.delete_items("archived", [1, 2])
+        client.archiver.archive_expired(expired)
+
+        messages = client.ddb.get_messages("archived")
+        assert len(messages.messages) == 4
+        assert messages.messages[1].content[0].text == LONG_ANSWER
+        # The marker is cleared, so the next read doesn't touch the archive.
+        assert "archived_through" not in client.ddb.get_session_state("archived")
+
+    def test_history_pages_of_an_archived_session(self, ddb_client, create_ddb_table, tmp_path):
+        client = chatbot(tmp_path)
+        client.ddb.save_last_messages(session(), count=4)
+        client.archiver.archive_idle(0)
+
+        messages, cursor = client.ddb.query_messages("archived", fields=["sequence"])
+
+        assert [message["sequence"] for message in messages] == [1, 2, 3, 4]
+        assert cursor is None
+
+    def test_idle_scan_resumes_where_it_stopped(self, ddb_client, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"])
+        for session_id in ("a", "b", "c", "d"):
+            ddb.save_last_messages(turn(session_id))
+
+        # An invocation that timed out after the first two pages.
+        scan = ddb.idle_sessions(0, page_size=3)
+        assert [next(scan), next(scan)] == ["a", "b"]
+        scan.close()
+
+        # The next one carries on from the last saved page, then a new pass starts.
+        assert list(ddb.idle_sessions(0, page_size=3)) == ["b", "c", "d"]
+        assert list(ddb.idle_sessions(0, page_size=3)) == ["a", "b", "c", "d"]
+
+    def test_archiving_stops_near_the_deadline(self, ddb_client, create_ddb_table, tmp_path):
+        client = chatbot(tmp_path)
+        client.ddb.save_last_messages(session(), count=4)
+
+        start_deadline(1000)
+        assert client.archiver.archive_idle(0, reserve_ms=5000) == 0
+        assert "archived_through" not in client.ddb.get_session_state("archived")
+
+    def test_new_sessions_do_not_read_the_archive(self, ddb_client, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"])
+
+        def rehydrate(session_id):
+            raise AssertionError("Only sessions with a marker are rehydrated")
+
+        ddb.rehydrate = rehydrate
+        assert ddb.get_messages("new").messages == []
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+import aws_clients
+from bedrock import Bedrock
+from dynamodb import DynamoDB
+from response_cache import DynamoDBResponseCache
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+
+
+@pytest.fixture(autouse=True)
+def fresh_clients():
+    aws_clients.reset()
+    yield
+    aws_clients.reset()
+
+
+class TestAwsClients:
+    def test_components_share_one_client(self):
+        ddb = DynamoDB("ChatbotHistory")
+        cache = DynamoDBResponseCache("ChatbotResponseCache")
+
+        assert ddb.ddb_client is cache.ddb_client
+        assert ddb.ddb_client.meta.config.max_pool_connections == aws_clients.DEFAULT_MAX_POOL_CONNECTIONS
+        assert ddb.ddb_client.meta.config.tcp_keepalive is True
+        assert ddb.ddb_client.meta.config.read_timeout == 5
+
+    def test_bedrock_keeps_its_retry_settings(self, monkeypatch):
+        monkeypatch.setenv("BEDROCK_READ_TIMEOUT_SECONDS", "280")
+
+        config = Bedrock(MODEL_ID).bedrock_client.meta.config
+
+        assert config.retries == {"total_max_attempts": 1, "mode": "standard"}
+        assert config.read_timeout == 280
+        assert config.max_pool_connections == aws_clients.DEFAULT_MAX_POOL_CONNECTIONS
+
+    def test_endpoint_override(self):
+        default = aws_clients.client("dynamodb")
+
+        aws_clients.set_endpoint_url("dynamodb", "http://localhost:8000")
+        local = aws_clients.client("dynamodb")
+        aws_clients.set_endpoint_url("dynamodb", None)
+
+        assert local is not default
+        assert local.meta.endpoint_url == "http://localhost:8000"
+        assert aws_clients.client("dynamodb").meta.endpoint_url != "http://localhost:8000"
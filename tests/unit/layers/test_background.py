@@ -0,0 +1,81 @@
+import os
+import sys
+import threading
+import pytest
+
+from botocore.exceptions import ClientError, EndpointConnectionError, ReadTimeoutError
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from background import BackgroundWriter
+
+
+def throttled():
+    return ClientError(
+        {"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "Slow down"}},
+        "PutItem",
+    )
+
+
+class TestBackgroundWriter:
+    def test_failed_write_is_retried(self):
+        writer = BackgroundWriter(backoff_seconds=0)
+        attempts = []
+
+        def put_item():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise throttled()
+            return "written"
+
+        future = writer.submit(put_item)
+
+        assert future.result() == "written"
+        assert len(attempts) == 3
+
+    def test_only_unapplied_writes_are_retried(self):
+        writer = BackgroundWriter(backoff_seconds=0)
+        attempts = []
+
+        def put_item(error):
+            attempts.append(type(error).__name__)
+            if len(attempts) == 1:
+                raise error
+            return "written"
+
+        assert writer.submit(put_item, EndpointConnectionError(endpoint_url="https://dynamodb")).result() == "written"
+        attempts.clear()
+        # The first write may have landed, sending it again could write the prompt twice.
+        with pytest.raises(ReadTimeoutError):
+            writer.submit(put_item, ReadTimeoutError(endpoint_url="https://dynamodb")).result()
+        assert attempts == ["ReadTimeoutError"]
+
+    def test_failure_is_surfaced_to_waiter(self):
+        writer = BackgroundWriter(max_attempts=2, backoff_seconds=0)
+        attempts = []
+
+        def put_item():
+            attempts.append(1)
+            raise throttled()
+
+        succeeded = writer.submit(lambda: "written")
+        failed = writer.submit(put_item)
+
+        with pytest.raises(ClientError):
+            writer.wait([succeeded, failed])
+        assert len(attempts) == 2
+
+    def test_drain_waits_for_writes_in_flight(self):
+        writer = BackgroundWriter()
+        released = threading.Event()
+        written = []
+
+        writer.submit(lambda: written.append("quick"))
+        stalled = writer.submit(released.wait)
+
+        # Bounded, the stalled write is counted rather than holding the handler.
+        assert writer.drain(0.05) == 1
+        assert written == ["quick"]
+        released.set()
+        stalled.result()
+        assert writer.drain(0.05) == 0
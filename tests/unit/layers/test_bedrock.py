@@ -0,0 +1,98 @@
+import os
+import sys
+import botocore.client
+import pytest
+
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from bedrock import Bedrock, CACHE_POINT
+from models import ContentItem, Message, Messages, Role
+
+orig = botocore.client.BaseClient._make_api_call
+
+LONG_SYSTEM_PROMPTS = [{"text": "Always answer politely and accurately. " * 200}]
+LONG_ANSWER = "Goats are browsers rather than grazers. " * 200
+
+
+@pytest.fixture()
+def converse_requests():
+    requests = []
+
+    def fake_make_api_call(self, operation_name, kwarg):
+        if operation_name == "Converse":
+            requests.append(kwarg)
+            return {
+                "output": {"message": {"role": "assistant", "content": [{"text": "Baa."}]}},
+                "stopReason": "end_turn",
+                "usage": {
+                    "inputTokens": 20,
+                    "outputTokens": 5,
+                    "totalTokens": 2525,
+                    "cacheReadInputTokens": 2500,
+                    "cacheWriteInputTokens": 0,
+                },
+                "metrics": {"latencyMs": 100},
+            }
+        return orig(self, operation_name, kwarg)
+
+    with patch("botocore.client.BaseClient._make_api_call", new=fake_make_api_call):
+        yield requests
+
+
+def conversation() -> Messages:
+    return Messages(
+        session_id="test-session",
+        messages=[
+            Message(role=Role.USER, content=[ContentItem(text="Tell me about goats")]),
+            Message(role=Role.ASSISTANT, content=[ContentItem(text=LONG_ANSWER)]),
+            Message(role=Role.USER, content=[ContentItem(text="And sheep?")]),
+        ],
+    )
+
+
+class TestPromptCaching:
+    def test_cache_points_after_system_prompt_and_stable_prefix(self, ddb_client, converse_requests):
+        bedrock = Bedrock("us.anthropic.claude-3-7-sonnet-20250219-v1:0")
+
+        bedrock.converse(LONG_SYSTEM_PROMPTS, conversation())
+
+        request = converse_requests[0]
+        assert request["system"] == LONG_SYSTEM_PROMPTS + [CACHE_POINT]
+        # The checkpoint closes the last message before the new prompt
+        assert request["messages"][1]["content"] == [{"text": LONG_ANSWER}, CACHE_POINT]
+        assert request["messages"][0]["content"] == [{"text": "Tell me about goats"}]
+        assert request["messages"][2]["content"] == [{"text": "And sheep?"}]
+
+    def test_no_cache_points_below_minimum_tokens(self, ddb_client, converse_requests):
+        bedrock = Bedrock("us.anthropic.claude-3-7-sonnet-20250219-v1:0")
+        messages = Messages(
+            session_id="test-session",
+            messages=[Message(role=Role.USER, content=[ContentItem(text="Hi")])],
+        )
+
+        bedrock.converse([{"text": "Be brief"}], messages)
+
+        request = converse_requests[0]
+        assert CACHE_POINT not in request["system"]
+        assert CACHE_POINT not in request["messages"][0]["content"]
+
+    def test_per_turn_system_prompts_stay_after_the_cache_point(self, ddb_client, converse_requests):
+        bedrock = Bedrock("us.anthropic.claude-3-7-sonnet-20250219-v1:0")
+        passages = [{"text": "Reference passages, use them to answer when they are relevant:\n\nSheep say baa."}]
+
+        bedrock.converse(LONG_SYSTEM_PROMPTS + [CACHE_POINT] + passages, conversation())
+
+        request = converse_requests[0]
+        assert request["system"] == LONG_SYSTEM_PROMPTS + [CACHE_POINT] + passages
+
+    def test_no_cache_points_for_unsupported_model(self, ddb_client, converse_requests):
+        bedrock = Bedrock("anthropic.claude-3-sonnet-20240229-v1:0")
+        passages = [{"text": "Sheep say baa."}]
+
+        bedrock.converse(LONG_SYSTEM_PROMPTS + [CACHE_POINT] + passages, conversation())
+
+        request = converse_requests[0]
+        assert request["system"] == LONG_SYSTEM_PROMPTS + passages
+        assert all(CACHE_POINT not in message["content"] for message in request["messages"])
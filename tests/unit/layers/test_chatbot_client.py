@@ -0,0 +1,157 @@
+import os
+import sys
+import threading
+import botocore.client
+import botocore.exceptions
+import pytest
+
+from types import SimpleNamespace
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from chatbot_client import BATCH_SAVE_RESERVE_MS, Chatbot, PersistenceMode, Turn, TurnOutOfTime
+from models import ContentItem, ContentRecord, Message, MessageRecord, Messages, Role
+from resilience import start_deadline
+
+orig = botocore.client.BaseClient._make_api_call
+
+MODEL_SECONDS = 5
+
+
+def converse_response(text):
+    return {
+        "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+        "stopReason": "end_turn",
+        "usage": {"inputTokens": 54, "outputTokens": 2, "totalTokens": 56},
+        "metrics": {"latencyMs": 100},
+    }
+
+
+def turns(count):
+    return [
+        Turn(f"batch-{number}", Message(role="user", content=[ContentItem(text=f"Prompt {number}")]), history=[])
+        for number in range(count)
+    ]
+
+
+def stored_sessions(chatbot, count):
+    return [len(chatbot.ddb.get_messages(f"batch-{number}").messages) for number in range(count)]
+
+
+@pytest.fixture(autouse=True)
+def no_deadline():
+    start_deadline(None)
+    yield
+    start_deadline(None)
+
+
+class TestBatchDeadline:
+    def test_turns_are_not_started_without_time_to_finish(self, create_ddb_table):
+        chatbot = Chatbot(
+            "anthropic.claude-3-sonnet-20240229-v1:0", os.environ["DDB_TABLE_NAME"], batch_concurrency=1
+        )
+        # Model calls take MODEL_SECONDS on a clock only the deadline checks read.
+        clock = [0.0]
+
+        def fake_make_api_call(self, operation_name, kwarg):
+            if operation_name == "Converse":
+                clock[0] += MODEL_SECONDS
+                return converse_response("Baa.")
+            return orig(self, operation_name, kwarg)
+
+        with patch("resilience.time", SimpleNamespace(monotonic=lambda: clock[0])):
+            # Time for two turns of the default length, then saving them.
+            start_deadline(BATCH_SAVE_RESERVE_MS + chatbot.batch_turn_ms + MODEL_SECONDS * 1000)
+            with patch("botocore.client.BaseClient._make_api_call", new=fake_make_api_call):
+                results = chatbot.converse_batch([{"text": "Be brief"}], turns(3))
+
+        assert [type(result) for result in results] == [Messages, Messages, TurnOutOfTime]
+        assert results[2].status_code == 503
+        assert stored_sessions(chatbot, 3) == [2, 2, 0]
+
+    def test_completed_turns_are_saved_when_one_overruns(self, create_ddb_table):
+        chatbot = Chatbot(
+            "anthropic.claude-3-sonnet-20240229-v1:0", os.environ["DDB_TABLE_NAME"], batch_turn_ms=0
+        )
+        release = threading.Event()
+
+        def fake_make_api_call(self, operation_name, kwarg):
+            if operation_name == "Converse":
+                if kwarg["messages"][-1]["content"][0]["text"] == "Prompt 1":
+                    # Still generating when the invocation has to respond.
+                    release.wait(10)
+                return converse_response("Baa.")
+            return orig(self, operation_name, kwarg)
+
+        start_deadline(BATCH_SAVE_RESERVE_MS + 1000)
+        with patch("botocore.client.BaseClient._make_api_call", new=fake_make_api_call):
+            try:
+                results = chatbot.converse_batch([{"text": "Be brief"}], turns(3))
+            finally:
+                release.set()
+
+        assert [type(result) for result in results] == [Messages, TurnOutOfTime, Messages]
+        assert stored_sessions(chatbot, 3) == [2, 0, 2]
+
+
+class TestWriteAhead:
+    def test_failed_turn_leaves_no_unanswered_prompt(self, create_ddb_table):
+        chatbot = Chatbot(
+            "anthropic.claude-3-sonnet-20240229-v1:0",
+            os.environ["DDB_TABLE_NAME"],
+            persistence_mode=PersistenceMode.WRITE_AHEAD,
+        )
+        sent = []
+
+        def fake_make_api_call(self, operation_name, kwarg):
+            if operation_name == "Converse":
+                sent.append([message["role"] for message in kwarg["messages"]])
+                if len(sent) == 1:
+                    raise botocore.exceptions.ClientError(
+                        {"Error": {"Code": "ValidationException", "Message": "Bad request"}}, "Converse"
+                    )
+                return converse_response("Baa.")
+            return orig(self, operation_name, kwarg)
+
+        with patch("botocore.client.BaseClient._make_api_call", new=fake_make_api_call):
+            for prompt in ["Hello", "Hello again"]:
+                messages = chatbot.get_history("ahead")
+                messages.append(Message(role="user", content=[ContentItem(text=prompt)]))
+                try:
+                    chatbot.converse([{"text": "Be brief"}], messages)
+                except botocore.exceptions.ClientError:
+                    pass
+
+        assert sent == [["user"], ["user"]]
+        stored = chatbot.ddb.get_messages("ahead").messages
+        assert [message.content[0].text for message in stored] == ["Hello again", "Baa."]
+
+    def test_turns_follow_a_gap_in_the_stored_sequences(self, create_ddb_table):
+        chatbot = Chatbot("anthropic.claude-3-sonnet-20240229-v1:0", os.environ["DDB_TABLE_NAME"])
+        # A turn that was removed between two others left sequences 3 and 4 empty.
+        for sequence in (1, 5):
+            turn = Messages("gap", [
+                MessageRecord(Role.USER, [ContentRecord(f"Prompt {sequence}")]),
+                MessageRecord(Role.ASSISTANT, [ContentRecord(f"Answer {sequence}")]),
+            ])
+            chatbot.ddb.save_last_messages(turn, sequence=sequence)
+        operations = []
+
+        def fake_make_api_call(self, operation_name, kwarg):
+            operations.append(operation_name)
+            if operation_name == "Converse":
+                return converse_response("Baa.")
+            return orig(self, operation_name, kwarg)
+
+        with patch("botocore.client.BaseClient._make_api_call", new=fake_make_api_call):
+            for prompt in ["Next", "And next"]:
+                messages = chatbot.get_history("gap")
+                messages.append(Message(role="user", content=[ContentItem(text=prompt)]))
+                chatbot.converse([{"text": "Be brief"}], messages)
+
+        # No conflicts, and the second turn is served from the session cache.
+        assert operations.count("TransactWriteItems") == 2
+        assert operations.count("Query") == 2
+        items = chatbot.ddb.get_items("gap")
+        assert [int(item["sequence"]) for item in items] == [1, 2, 5, 6, 7, 8, 9, 10]
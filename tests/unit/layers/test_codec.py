@@ -0,0 +1,67 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from codec import FORMAT_VERSION, decode_content, encode_content, item_size
+from dynamodb import DynamoDB
+from models import ContentRecord, MessageRecord, Messages, Role
+
+LONG_ANSWER = "Goats are browsers rather than grazers, they prefer leaves and shrubs. " * 40
+
+
+def conversation():
+    return Messages(
+        session_id="codec",
+        messages=[
+            MessageRecord(Role.USER, [ContentRecord("Tell me about goats")]),
+            MessageRecord(Role.ASSISTANT, [ContentRecord(LONG_ANSWER)]),
+        ],
+    )
+
+
+class TestCodec:
+    def test_small_content_stays_plain(self):
+        record = {"role": "user", "content": [{"text": "Baa"}]}
+
+        item = encode_content(record)
+
+        assert item == dict(record, format_version=FORMAT_VERSION)
+        assert decode_content(item) == item
+
+    def test_large_content_is_compressed(self):
+        record = {"role": "assistant", "content": [{"text": LONG_ANSWER}]}
+
+        item = encode_content(record)
+
+        assert "content" not in item
+        assert item["codec"] in ("zlib", "zstd")
+        assert item_size(item) < item_size(record) / 4
+        assert decode_content(item)["content"] == record["content"]
+
+    def test_reads_old_and_new_items(self, ddb_client, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"])
+        # An item written before the codec existed, without format_version.
+        ddb_client.put_item(
+            TableName=os.environ["DDB_TABLE_NAME"],
+            Item={
+                "session_id": {"S": "codec"},
+                "sequence": {"N": "1"},
+                "role": {"S": "user"},
+                "content": {"L": [{"M": {"text": {"S": "Tell me about goats"}}}]},
+            },
+        )
+        ddb.save_last_message(conversation())
+
+        stored = ddb_client.get_item(
+            TableName=os.environ["DDB_TABLE_NAME"],
+            Key={"session_id": {"S": "codec"}, "sequence": {"N": "2"}},
+        )["Item"]
+        assert "B" in stored["content_z"]
+        assert stored["format_version"] == {"N": str(FORMAT_VERSION)}
+
+        messages = ddb.get_messages("codec")
+        assert [message.content[0].text for message in messages.messages] == [
+            "Tell me about goats",
+            LONG_ANSWER,
+        ]
@@ -0,0 +1,177 @@
+import os
+import sys
+import botocore.client
+import pytest
+
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from chatbot_client import Chatbot, ExecutionMode
+from compaction import CompactionMode, SUMMARY_SYSTEM_PROMPTS
+from dynamodb import DynamoDB
+from models import ContentItem, ContentRecord, Message, MessageRecord, Messages, Role
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+SYSTEM_PROMPTS = [{"text": "You are a goat."}]
+
+orig = botocore.client.BaseClient._make_api_call
+
+
+@pytest.fixture()
+def converse_calls():
+    """Answers turns with the prompt echoed back and summaries with a numbered summary."""
+    calls = []
+
+    def fake_make_api_call(self, operation_name, kwarg):
+        if operation_name == "Converse":
+            calls.append(kwarg)
+            if kwarg["system"] == SUMMARY_SYSTEM_PROMPTS:
+                text = f"Summary {sum(call['system'] == SUMMARY_SYSTEM_PROMPTS for call in calls)}"
+            else:
+                text = f"Re: {kwarg['messages'][-1]['content'][0]['text']}"
+            return {
+                "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+                "stopReason": "end_turn",
+                "usage": {"inputTokens": 10, "outputTokens": 2, "totalTokens": 12},
+                "metrics": {"latencyMs": 10},
+            }
+        return orig(self, operation_name, kwarg)
+
+    with patch("botocore.client.BaseClient._make_api_call", new=fake_make_api_call):
+        yield calls
+
+
+def chatbot(table_name, **kwargs):
+    return Chatbot(
+        MODEL_ID,
+        table_name,
+        execution_mode=ExecutionMode.SERIAL,
+        compaction_max_turns=3,
+        compaction_keep_turns=2,
+        **kwargs,
+    )
+
+
+def turn(client, session_id, prompt):
+    messages = client.get_history(session_id)
+    messages.append(Message(role="user", content=[ContentItem(text=prompt)]))
+    messages = client.converse(SYSTEM_PROMPTS, messages, use_cache=False)
+    client.maybe_compact(messages)
+    return messages
+
+
+def stored_sequences(ddb_client, table_name, session_id):
+    items = ddb_client.query(
+        TableName=table_name,
+        KeyConditionExpression="session_id = :session_id",
+        ExpressionAttributeValues={":session_id": {"S": session_id}},
+    )["Items"]
+    return [int(item["sequence"]["N"]) for item in items]
+
+
+class TestCompaction:
+    def test_inline_compaction_folds_old_turns_into_summary(
+        self, ddb_client, create_ddb_table, converse_calls
+    ):
+        table_name = os.environ["DDB_TABLE_NAME"]
+        client = chatbot(table_name, compaction_mode=CompactionMode.INLINE)
+
+        for prompt in ("one", "two", "three"):
+            turn(client, "goat", prompt)
+        # Three turns is not over the threshold yet.
+        assert DynamoDB(table_name).get_summary("goat") is None
+
+        turn(client, "goat", "four")
+        # The two oldest turns, four messages, were folded.
+        assert DynamoDB(table_name).get_summary("goat") == {"summary": "Summary 1", "covers_through": 4}
+
+        # A cold container only reads the summary and the tail.
+        messages = DynamoDB(table_name).get_messages("goat")
+        assert messages.summary == "Summary 1"
+        assert messages.offset == 4
+        assert [message.content[0].text for message in messages.messages] == [
+            "three",
+            "Re: three",
+            "four",
+            "Re: four",
+        ]
+
+        # The next turn is stored after the existing messages and sends the summary.
+        client.sessions.clear()
+        messages = turn(client, "goat", "five")
+        assert stored_sequences(ddb_client, table_name, "goat") == list(range(0, 11))
+        assert converse_calls[-1]["system"][-1]["text"].endswith("Summary 1")
+        assert "one" not in str(converse_calls[-1]["messages"])
+        assert messages.to_record()["summary"] == "Summary 1"
+
+    def test_compaction_extends_the_previous_summary(
+        self, ddb_client, create_ddb_table, converse_calls
+    ):
+        table_name = os.environ["DDB_TABLE_NAME"]
+        client = chatbot(table_name, compaction_mode=CompactionMode.INLINE)
+
+        for prompt in ("one", "two", "three", "four", "five", "six"):
+            turn(client, "goat", prompt)
+
+        summaries = [call for call in converse_calls if call["system"] == SUMMARY_SYSTEM_PROMPTS]
+        assert len(summaries) == 2
+        second = summaries[1]["messages"][0]["content"][0]["text"]
+        # Only the previous summary and the turns since are sent, not the whole history.
+        assert "Existing summary:\nSummary 1" in second
+        assert "User: three" in second and "User: four" in second
+        assert "User: one" not in second
+        assert DynamoDB(table_name).get_summary("goat") == {"summary": "Summary 2", "covers_through": 8}
+
+    def test_deferred_compaction_hands_off_the_session(
+        self, ddb_client, create_ddb_table, converse_calls
+    ):
+        table_name = os.environ["DDB_TABLE_NAME"]
+        deferred = []
+        client = chatbot(
+            table_name, compaction_mode=CompactionMode.DEFERRED, defer_compaction=deferred.append
+        )
+
+        for prompt in ("one", "two", "three", "four"):
+            turn(client, "goat", prompt)
+
+        assert deferred == ["goat"]
+        assert "goat" not in client.sessions
+        assert DynamoDB(table_name).get_summary("goat") is None
+
+        # The separate pass compacts from the stored history.
+        client.compact_session("goat")
+        assert DynamoDB(table_name).get_summary("goat") == {"summary": "Summary 1", "covers_through": 4}
+        assert client.get_history("goat").offset == 4
+
+    def test_summary_covers_the_stored_sequences_after_a_gap(
+        self, ddb_client, create_ddb_table, converse_calls
+    ):
+        table_name = os.environ["DDB_TABLE_NAME"]
+        client = chatbot(table_name, compaction_mode=CompactionMode.INLINE)
+        # A failed turn between the first two left sequences 3 and 4 empty.
+        for sequence, prompt in ((1, "one"), (5, "two")):
+            stored = Messages("goat", [
+                MessageRecord(Role.USER, [ContentRecord(prompt)]),
+                MessageRecord(Role.ASSISTANT, [ContentRecord(f"Re: {prompt}")]),
+            ])
+            client.ddb.save_last_messages(stored, sequence=sequence)
+
+        for prompt in ("three", "four"):
+            turn(client, "goat", prompt)
+
+        assert DynamoDB(table_name).get_summary("goat") == {"summary": "Summary 1", "covers_through": 6}
+        messages = DynamoDB(table_name).get_messages("goat")
+        assert [message.content[0].text for message in messages.messages] == [
+            "three",
+            "Re: three",
+            "four",
+            "Re: four",
+        ]
+
+    def test_older_summary_does_not_overwrite_newer(self, ddb_client, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"])
+
+        assert ddb.save_summary("goat", "newer", 8)
+        assert not ddb.save_summary("goat", "older", 4)
+        assert ddb.get_summary("goat") == {"summary": "newer", "covers_through": 8}
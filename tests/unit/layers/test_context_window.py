@@ -0,0 +1,89 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from context_window import ContextWindow, model_token_budget
+from models import ContentItem, Message, Messages, Role
+
+
+def build_session(turns: int, text: str = "goat " * 100) -> Messages:
+    messages = Messages(session_id="test-session", messages=[])
+    for turn in range(turns):
+        messages.append(Message(role=Role.USER, content=[ContentItem(text=f"{turn} {text}")]))
+        messages.append(Message(role=Role.ASSISTANT, content=[ContentItem(text=f"{turn} {text}")]))
+    messages.append(Message(role=Role.USER, content=[ContentItem(text="And one more?")]))
+    return messages
+
+
+class TestContextWindow:
+    def test_short_conversation_is_sent_unchanged(self):
+        messages = build_session(2)
+        window = ContextWindow("anthropic.claude-3-sonnet-20240229-v1:0")
+
+        assert window.select([{"text": "system"}], messages) is messages
+
+    def test_keeps_most_recent_turns_within_budget(self):
+        messages = build_session(50)
+        window = ContextWindow("anthropic.claude-3-sonnet-20240229-v1:0", token_budget=2000)
+
+        selected = window.select([{"text": "system"}], messages).messages
+
+        # Recent turns are kept, ending with the new prompt and starting with a user message
+        assert selected[-1] is messages.messages[-1]
+        assert selected[-2] is messages.messages[-2]
+        assert selected[0].role == Role.USER
+        assert sum(window.estimate_tokens(message) for message in selected) <= 2000
+        # Roles still alternate
+        for previous, current in zip(selected, selected[1:]):
+            assert previous.role != current.role
+
+    def test_pinned_turn_is_kept(self):
+        messages = build_session(50)
+        messages.messages[0].pinned = True
+        window = ContextWindow("anthropic.claude-3-sonnet-20240229-v1:0", token_budget=2000)
+
+        selected = window.select([{"text": "system"}], messages).messages
+
+        # The pinned user message is kept together with its answer
+        assert selected[0] is messages.messages[0]
+        assert selected[1] is messages.messages[1]
+        assert selected[2].role == Role.USER
+
+    def test_window_alternates_when_the_history_does_not(self):
+        # An assistant message first, and a prompt whose turn failed before the next one.
+        history = [
+            Message(role=Role.ASSISTANT, content=[ContentItem(text="Welcome!")]),
+            Message(role=Role.USER, content=[ContentItem(text="Hello")]),
+            Message(role=Role.ASSISTANT, content=[ContentItem(text="Hi")]),
+            Message(role=Role.USER, content=[ContentItem(text="Unanswered")]),
+            Message(role=Role.USER, content=[ContentItem(text="Are you there?")]),
+        ]
+        messages = Messages(session_id="test-session", messages=history)
+        window = ContextWindow("anthropic.claude-3-sonnet-20240229-v1:0")
+
+        selected = window.select([{"text": "system"}], messages).messages
+
+        assert [message.role for message in selected] == [Role.USER, Role.ASSISTANT, Role.USER]
+        assert [item.text for item in selected[-1].content] == ["Unanswered", "Are you there?"]
+
+    def test_system_prompt_counts_against_budget(self):
+        messages = build_session(10)
+        window = ContextWindow("anthropic.claude-3-sonnet-20240229-v1:0", token_budget=2000)
+
+        without_system = window.select([], messages).messages
+        with_system = window.select([{"text": "rule " * 1000}], messages).messages
+
+        assert len(with_system) < len(without_system)
+
+    def test_token_estimate_is_cached_on_message(self):
+        message = Message(role=Role.USER, content=[ContentItem(text="goat " * 100)])
+        window = ContextWindow("anthropic.claude-3-sonnet-20240229-v1:0")
+
+        tokens = window.estimate_tokens(message)
+
+        assert message._token_count == tokens
+
+    def test_model_token_budget(self):
+        assert model_token_budget("us.anthropic.claude-3-5-sonnet-20240620-v1:0") == 180000
+        assert model_token_budget("unknown.model") == 100000
@@ -0,0 +1,163 @@
+import json
+import os
+import sys
+import threading
+import time
+import botocore.client
+import botocore.exceptions
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from dynamodb import DynamoDB, SessionWriteConflict
+from models import ContentRecord, MessageRecord, Messages, Role
+
+orig = botocore.client.BaseClient._make_api_call
+
+WRITERS = 8
+TURNS_PER_WRITER = 5
+
+
+def turn(session_id, history, prompt):
+    messages = Messages(session_id, list(history))
+    messages.append(MessageRecord(Role.USER, [ContentRecord(prompt)]))
+    messages.append(MessageRecord(Role.ASSISTANT, [ContentRecord(f"Answer to {prompt}")]))
+    return messages
+
+
+def stored_texts(ddb, session_id):
+    return [message.content[0].text for message in ddb.get_messages(session_id).messages]
+
+
+class TestSessionWrites:
+    def test_concurrent_turns_are_both_kept(self, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"])
+
+        # Two tabs sent a turn from the same empty history.
+        assert ddb.save_last_messages(turn("tabs", [], "first tab")) == 1
+        assert ddb.save_last_messages(turn("tabs", [], "second tab")) == 3
+
+        assert stored_texts(ddb, "tabs") == [
+            "first tab",
+            "Answer to first tab",
+            "second tab",
+            "Answer to second tab",
+        ]
+
+    def test_conflict_once_the_attempts_run_out(self, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"])
+        ddb.save_last_messages(turn("tabs", [], "first tab"))
+
+        with pytest.raises(SessionWriteConflict) as conflict:
+            ddb.save_last_messages(turn("tabs", [], "second tab"), max_attempts=1)
+        assert conflict.value.status_code == 409
+        assert stored_texts(ddb, "tabs") == ["first tab", "Answer to first tab"]
+
+    def test_batch_writes_a_conflicting_turn_after_the_other(self, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"])
+        ddb.save_last_messages(turn("shared", [], "from chat"))
+
+        results = ddb.save_turns([turn("batch", [], "alone"), turn("shared", [], "from batch")])
+
+        assert results == [1, 3]
+        assert stored_texts(ddb, "batch") == ["alone", "Answer to alone"]
+        assert stored_texts(ddb, "shared")[2:] == ["from batch", "Answer to from batch"]
+
+    def test_batch_keeps_the_turns_beside_one_that_fails(self, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"])
+
+        # One bad item fails the whole transaction.
+        def reject_broken(self, operation_name, kwarg):
+            if operation_name == "TransactWriteItems" and '"broken"' in json.dumps(kwarg):
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "ValidationException", "Message": "Item size has exceeded the maximum allowed size"}},
+                    operation_name,
+                )
+            return orig(self, operation_name, kwarg)
+
+        with patch("botocore.client.BaseClient._make_api_call", new=reject_broken):
+            results = ddb.save_turns([turn("before", [], "first"), turn("broken", [], "bad"), turn("after", [], "last")])
+
+        assert results[0] == 1 and results[2] == 1
+        assert isinstance(results[1], botocore.exceptions.ClientError)
+        assert stored_texts(ddb, "before") == ["first", "Answer to first"]
+        assert stored_texts(ddb, "after") == ["last", "Answer to last"]
+
+    def test_write_ahead_response_stays_after_its_prompt(self, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"])
+        messages = Messages("tabs", [MessageRecord(Role.USER, [ContentRecord("first tab")])])
+        prompt_sequence = ddb.save_last_message(messages, reserve_next=True)
+
+        # Another tab's turn lands while the model is still answering the first.
+        ddb.save_last_messages(turn("tabs", [], "second tab"))
+        assert stored_texts(ddb, "tabs") == ["first tab", "second tab", "Answer to second tab"]
+        messages.append(MessageRecord(Role.ASSISTANT, [ContentRecord("Answer to first tab")]))
+        ddb.save_reserved_message(messages, prompt_sequence + 1)
+
+        assert stored_texts(ddb, "tabs") == [
+            "first tab",
+            "Answer to first tab",
+            "second tab",
+            "Answer to second tab",
+        ]
+
+    def test_conflict_when_the_response_sequence_is_not_reserved(self, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"])
+        messages = Messages("tabs", [MessageRecord(Role.USER, [ContentRecord("first tab")])])
+        prompt_sequence = ddb.save_last_message(messages)
+        ddb.save_last_messages(turn("tabs", [], "second tab"))
+
+        messages.append(MessageRecord(Role.ASSISTANT, [ContentRecord("Answer to first tab")]))
+        with pytest.raises(SessionWriteConflict):
+            ddb.save_reserved_message(messages, prompt_sequence + 1)
+        assert stored_texts(ddb, "tabs") == ["first tab", "second tab", "Answer to second tab"]
+
+    def test_many_writers_to_one_session(self, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"])
+        # DynamoDB applies each conditional write atomically, moto needs a lock to.
+        lock = threading.Lock()
+
+        def atomic_make_api_call(self, operation_name, kwarg):
+            time.sleep(0.001)
+            with lock:
+                return orig(self, operation_name, kwarg)
+
+        saved, conflicts = [], []
+
+        def writer(index):
+            for number in range(TURNS_PER_WRITER):
+                # Every writer sends its own view of the history, stale once the others write.
+                history = [MessageRecord(Role.USER, [ContentRecord("seen")])] * (2 * number)
+                prompt = f"writer {index} turn {number}"
+                try:
+                    ddb.save_last_messages(turn("team", history, prompt))
+                    saved.append(prompt)
+                except SessionWriteConflict:
+                    # A clear 409 for the client to resend, rather than a lost turn.
+                    conflicts.append(prompt)
+
+        with patch("botocore.client.BaseClient._make_api_call", new=atomic_make_api_call):
+            with ThreadPoolExecutor(WRITERS) as executor:
+                list(executor.map(writer, range(WRITERS)))
+
+        texts = stored_texts(ddb, "team")
+        # Nothing was overwritten, and each prompt is followed by its own response.
+        assert len(saved) + len(conflicts) == WRITERS * TURNS_PER_WRITER
+        assert sorted(texts[0::2]) == sorted(saved)
+        assert texts[1::2] == [f"Answer to {prompt}" for prompt in texts[0::2]]
+
+
+class TestHistoryPages:
+    def test_pages_hold_only_message_fields(self, create_ddb_table):
+        ddb = DynamoDB(os.environ["DDB_TABLE_NAME"], ttl_seconds=3600)
+        ddb.save_last_messages(turn("pages", [], "hello"))
+
+        messages, cursor = ddb.query_messages("pages")
+
+        # Expiry times are numbers in the table, the page must still serialise.
+        json.dumps(messages)
+        assert cursor is None
+        assert messages[1] == {"sequence": 2, "role": "assistant", "content": [{"text": "Answer to hello"}]}
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from idempotency import IdempotencyKeyReused, IdempotencyStore, RequestInProgress
+
+TABLE_NAME = "ChatbotIdempotency"
+
+
+@pytest.fixture()
+def store(ddb_client):
+    ddb_client.create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{"AttributeName": "idempotency_key", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "idempotency_key", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    return IdempotencyStore(TABLE_NAME)
+
+
+class TestIdempotency:
+    def test_duplicates_get_the_first_response(self, store):
+        calls = []
+
+        def converse():
+            calls.append(1)
+            return '{"messages": ["Baa"]}'
+
+        first = store.run("goats#1", "fingerprint", converse)
+        second = store.run("goats#1", "fingerprint", converse)
+
+        assert first == second == '{"messages": ["Baa"]}'
+        assert len(calls) == 1
+
+    def test_concurrent_duplicate_is_rejected(self, store):
+        def converse():
+            # The retry arrives while the first request is still generating.
+            with pytest.raises(RequestInProgress) as conflict:
+                store.run("goats#1", "fingerprint", lambda: "second")
+            assert conflict.value.status_code == 409
+            return "first"
+
+        assert store.run("goats#1", "fingerprint", converse) == "first"
+
+    def test_failed_request_can_be_retried(self, store):
+        def fail():
+            raise RuntimeError("Bedrock went away")
+
+        with pytest.raises(RuntimeError):
+            store.run("goats#1", "fingerprint", fail)
+
+        assert store.run("goats#1", "fingerprint", lambda: "retried") == "retried"
+
+    def test_key_reused_for_another_request(self, store):
+        store.run("key#abc", "fingerprint", lambda: "first")
+
+        with pytest.raises(IdempotencyKeyReused):
+            store.run("key#abc", "another fingerprint", lambda: "second")
+
+    def test_abandoned_request_is_taken_over(self, store, ddb_client):
+        store.start("goats#1", "fingerprint")
+        # The container running the request died, its marker has run out.
+        ddb_client.update_item(
+            TableName=TABLE_NAME,
+            Key={"idempotency_key": {"S": "goats#1"}},
+            UpdateExpression="SET in_progress_until = :past",
+            ExpressionAttributeValues={":past": {"N": str(int(time.time()) - 1)}},
+        )
+
+        assert store.run("goats#1", "fingerprint", lambda: "taken over") == "taken over"
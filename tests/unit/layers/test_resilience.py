@@ -0,0 +1,162 @@
+import os
+import sys
+import pytest
+
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from bedrock import Bedrock
+from resilience import (
+    CircuitBreaker,
+    CircuitOpen,
+    RetryPolicy,
+    ServiceUnavailable,
+    Throttled,
+    start_deadline,
+)
+
+
+def error(code):
+    if code == "ReadTimeout":
+        return ReadTimeoutError(endpoint_url="https://bedrock-runtime.us-east-1.amazonaws.com")
+    return ClientError({"Error": {"Code": code, "Message": code}}, "Converse")
+
+
+class StubBedrock:
+    """Fails with the queued error codes, then succeeds."""
+
+    def __init__(self, *codes):
+        self.codes = list(codes)
+        self.calls = 0
+
+    def converse(self, **kwargs):
+        self.calls += 1
+        if self.codes:
+            raise error(self.codes.pop(0))
+        return {"output": "Baa."}
+
+
+@pytest.fixture(autouse=True)
+def no_deadline():
+    start_deadline(None)
+    yield
+    start_deadline(None)
+
+
+class TestRetryPolicy:
+    def test_throttling_is_retried(self):
+        sleeps = []
+        policy = RetryPolicy(max_attempts=4, sleep=sleeps.append)
+        stub = StubBedrock("ThrottlingException", "ServiceUnavailableException")
+
+        response, retries = policy.call(stub.converse)
+
+        assert response == {"output": "Baa."}
+        assert retries == 2
+        assert stub.calls == 3
+        assert len(sleeps) == 2
+
+    def test_exhausted_retries_raise_throttled(self):
+        policy = RetryPolicy(max_attempts=3, sleep=lambda delay: None)
+        stub = StubBedrock(*["ThrottlingException"] * 5)
+
+        with pytest.raises(Throttled) as raised:
+            policy.call(stub.converse)
+
+        assert stub.calls == 3
+        assert raised.value.status_code == 429
+        assert int(raised.value.retry_after) >= 1
+        assert isinstance(raised.value.__cause__, ClientError)
+
+    def test_stops_retrying_near_the_deadline(self):
+        sleeps = []
+        policy = RetryPolicy(max_attempts=10, reserve_ms=2000, sleep=sleeps.append)
+        stub = StubBedrock(*["ModelNotReadyException"] * 10)
+        # Less time left than the reserve for returning a response
+        start_deadline(1500)
+
+        with pytest.raises(ServiceUnavailable) as raised:
+            policy.call(stub.converse)
+
+        assert stub.calls == 1
+        assert sleeps == []
+        assert raised.value.status_code == 503
+
+    def test_timeouts_are_retried(self):
+        policy = RetryPolicy(max_attempts=2, sleep=lambda delay: None)
+
+        response, retries = policy.call(StubBedrock("ReadTimeout").converse)
+        assert response == {"output": "Baa."}
+        assert retries == 1
+
+        with pytest.raises(ServiceUnavailable) as raised:
+            policy.call(StubBedrock("ReadTimeout", "ReadTimeout").converse)
+        assert raised.value.status_code == 503
+        assert isinstance(raised.value.__cause__, ReadTimeoutError)
+
+    def test_client_errors_are_not_retried(self):
+        policy = RetryPolicy(sleep=lambda delay: None)
+        stub = StubBedrock("ValidationException")
+
+        with pytest.raises(ClientError):
+            policy.call(stub.converse)
+        assert stub.calls == 1
+
+
+class TestCircuitBreaker:
+    def test_opens_once_failure_rate_crosses_threshold(self):
+        breaker = CircuitBreaker("model", failure_rate_threshold=0.5, window_size=4, minimum_calls=4)
+        for failed in [False, True, False, True]:
+            breaker.before_call()
+            breaker.record_failure() if failed else breaker.record_success()
+
+        assert breaker.is_open
+        with pytest.raises(CircuitOpen) as raised:
+            breaker.before_call()
+        assert raised.value.status_code == 503
+
+    def test_probe_closes_circuit(self):
+        breaker = CircuitBreaker("model", window_size=2, minimum_calls=2, open_seconds=0)
+        breaker.record_failure()
+        breaker.record_failure()
+        assert breaker.is_open
+
+        # Half open lets one probe through, others are still shed
+        breaker.before_call()
+        with pytest.raises(CircuitOpen):
+            breaker.before_call()
+
+        breaker.record_success()
+        assert not breaker.is_open
+        breaker.before_call()
+
+    def test_failed_probe_reopens_circuit(self):
+        breaker = CircuitBreaker("model", window_size=2, minimum_calls=2, open_seconds=0)
+        breaker.record_failure()
+        breaker.record_failure()
+
+        breaker.before_call()
+        breaker.record_failure()
+
+        assert breaker.is_open
+
+    def test_probe_timeout_reopens_circuit(self):
+        breaker = CircuitBreaker("model", window_size=2, minimum_calls=2, open_seconds=0)
+        breaker.record_failure()
+        breaker.record_failure()
+        bedrock = Bedrock(
+            "anthropic.claude-3-sonnet-20240229-v1:0",
+            retry_policy=RetryPolicy(max_attempts=1),
+            circuit_breaker=breaker,
+        )
+
+        # The half open probe times out rather than getting an error back
+        with pytest.raises(ServiceUnavailable):
+            bedrock._invoke(StubBedrock("ReadTimeout").converse, {"system": [], "messages": []})
+        assert breaker.is_open
+
+        # The probe finished, so the next one is let through and closes the circuit
+        response = bedrock._invoke(StubBedrock().converse, {"system": [], "messages": []})
+        assert response == {"output": "Baa."}
+        assert not breaker.is_open
@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import boto3
+import botocore.client
+import pytest
+
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from bedrock import Bedrock
+from models import ContentItem, Message, Messages
+from response_cache import ResponseCache, cache_key
+from router import ModelRouter
+from semantic_cache import SemanticCache
+from telemetry import metrics
+
+orig = botocore.client.BaseClient._make_api_call
+
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+SYSTEM_PROMPTS = [{"text": "You are a chatbot"}]
+
+
+@pytest.fixture(autouse=True)
+def clear_metrics():
+    metrics.clear_metrics()
+    yield
+    metrics.clear_metrics()
+
+
+def count(name):
+    return sum(metrics.metric_set.get(name, {}).get("Value", []))
+
+
+@pytest.fixture()
+def converse_calls():
+    calls = []
+
+    def fake_make_api_call(self, operation_name, kwarg):
+        if operation_name == "Converse":
+            calls.append(kwarg)
+            return {
+                "output": {"message": {"role": "assistant", "content": [{"text": "We open at 9am."}]}},
+                "stopReason": "end_turn",
+                "usage": {"inputTokens": 10, "outputTokens": 5, "totalTokens": 15},
+                "metrics": {"latencyMs": 100},
+            }
+        return orig(self, operation_name, kwarg)
+
+    with patch("botocore.client.BaseClient._make_api_call", new=fake_make_api_call):
+        yield calls
+
+
+@pytest.fixture()
+def cache_table(ddb_client):
+    table_name = "ChatbotResponseCache"
+    ddb_client.create_table(
+        TableName=table_name,
+        KeySchema=[{"AttributeName": "cache_key", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "cache_key", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    yield table_name
+
+
+def prompt(text: str) -> Messages:
+    return Messages(
+        session_id="test-session",
+        messages=[Message(role="user", content=[ContentItem(text=text)])],
+    )
+
+
+class TestResponseCache:
+    def test_cache_key_normalizes_whitespace(self):
+        args = {
+            "modelId": MODEL_ID,
+            "system": SYSTEM_PROMPTS,
+            "inferenceConfig": {"temperature": 0.5},
+            "messages": [{"role": "user", "content": [{"text": "What are your  hours?"}]}],
+        }
+        spaced = dict(args, messages=[{"role": "user", "content": [{"text": " What are your hours? "}]}])
+        other_model = dict(args, modelId="amazon.nova-pro-v1:0")
+
+        assert cache_key(args) == cache_key(spaced)
+        assert cache_key(args) != cache_key(other_model)
+
+    def test_local_hit_skips_model(self, ddb_client, converse_calls):
+        bedrock = Bedrock(MODEL_ID, response_cache=ResponseCache())
+
+        first = bedrock.converse(SYSTEM_PROMPTS, prompt("What are your hours?"))
+        second = bedrock.converse(SYSTEM_PROMPTS, prompt("What are your hours?"))
+
+        assert len(converse_calls) == 1
+        assert second.content[0].text == first.content[0].text
+        assert count("ResponseCacheLocalHit") == 1
+        assert count("ResponseCacheSharedHit") == 0
+        assert count("ResponseCacheMiss") == 1
+
+    def test_opt_out_calls_model(self, ddb_client, converse_calls):
+        bedrock = Bedrock(MODEL_ID, response_cache=ResponseCache())
+
+        bedrock.converse(SYSTEM_PROMPTS, prompt("What are your hours?"))
+        bedrock.converse(SYSTEM_PROMPTS, prompt("What are your hours?"), use_cache=False)
+
+        assert len(converse_calls) == 2
+
+    def test_shared_tier_is_used_across_containers(self, cache_table, converse_calls):
+        # Two clients with their own local tier stand in for two Lambda containers
+        first_container = Bedrock(MODEL_ID, response_cache=ResponseCache(table_name=cache_table))
+        second_container = Bedrock(MODEL_ID, response_cache=ResponseCache(table_name=cache_table))
+
+        first_container.converse(SYSTEM_PROMPTS, prompt("What are your hours?"))
+        message = second_container.converse(SYSTEM_PROMPTS, prompt("What are your hours?"))
+
+        assert len(converse_calls) == 1
+        assert message.content[0].text == "We open at 9am."
+        assert count("ResponseCacheSharedHit") == 1
+        item = boto3.resource("dynamodb").Table(cache_table).scan()["Items"][0]
+        assert item["expires_at"] > time.time()
+
+    def test_expired_entries_are_not_returned(self, ddb_client, converse_calls):
+        bedrock = Bedrock(MODEL_ID, response_cache=ResponseCache(ttl_seconds=0))
+
+        bedrock.converse(SYSTEM_PROMPTS, prompt("What are your hours?"))
+        bedrock.converse(SYSTEM_PROMPTS, prompt("What are your hours?"))
+
+        assert len(converse_calls) == 2
+
+    def test_semantic_cache_answers_rephrased_first_turn(self, ddb_client, converse_calls):
+        bedrock = Bedrock(
+            MODEL_ID, response_cache=ResponseCache(), semantic_cache=SemanticCache(threshold=0.8)
+        )
+
+        bedrock.converse(SYSTEM_PROMPTS, prompt("What are your opening hours?"))
+        message = bedrock.converse(SYSTEM_PROMPTS, prompt("what are your opening hours"))
+
+        assert len(converse_calls) == 1
+        assert message.content[0].text == "We open at 9am."
+
+    def test_trimmed_conversation_is_not_answered_from_the_semantic_cache(self, ddb_client, converse_calls):
+        router = ModelRouter(MODEL_ID, context_token_budget=60, semantic_cache=SemanticCache(threshold=0.8))
+        router.converse(SYSTEM_PROMPTS, prompt("What are your opening hours?"))
+
+        # A long conversation the context window trims down to its last prompt.
+        history = [
+            Message(role=role, content=[ContentItem(text=f"Earlier message {number} about our booking " * 5)])
+            for number, role in enumerate(["user", "assistant"] * 3)
+        ]
+        conversation = Messages(
+            session_id="other-session",
+            messages=history + [Message(role="user", content=[ContentItem(text="what are your opening hours")])],
+        )
+        router.converse(SYSTEM_PROMPTS, conversation)
+
+        assert len(converse_calls) == 2
+        assert converse_calls[1]["messages"] == [
+            {"role": "user", "content": [{"text": "what are your opening hours"}]}
+        ]
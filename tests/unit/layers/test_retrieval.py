@@ -0,0 +1,89 @@
+import os
+import sys
+import botocore.client
+
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from bedrock import CACHE_POINT
+from chatbot_client import Chatbot, ExecutionMode
+from models import ContentItem, Message, Messages
+from retrieval import Retriever, build_index, chunk_text
+from vector_index import HashingEmbedder
+
+orig = botocore.client.BaseClient._make_api_call
+
+DOCUMENTS = {
+    "goats.md": "Goats can climb trees and steep cliffs.\n\nA baby goat is called a kid.",
+    "sheep.md": "Sheep are grown for their wool, which is sheared once a year.",
+}
+
+
+class CountingEmbedder(HashingEmbedder):
+    def __init__(self):
+        super().__init__()
+        self.embedded = []
+
+    def embed(self, texts):
+        self.embedded.extend(texts)
+        return super().embed(texts)
+
+
+class TestRetrieval:
+    def test_chunks_keep_paragraphs_whole(self):
+        text = "First paragraph.\n\nSecond paragraph.\n\n" + "word " * 50
+
+        chunks = chunk_text(text, max_chars=40)
+
+        assert chunks[0] == "First paragraph.\n\nSecond paragraph."
+        assert all(len(chunk) <= 40 for chunk in chunks)
+        assert " ".join(chunks[1:]).split() == ["word"] * 50
+
+    def test_rebuild_only_embeds_changed_documents(self, tmp_path):
+        path = str(tmp_path / "documents")
+        assert build_index(path, DOCUMENTS) == {"kept": 0, "embedded": 2, "passages": 2}
+
+        embedder = CountingEmbedder()
+        documents = dict(DOCUMENTS, **{"cows.md": "Cows have four stomach compartments."})
+        del documents["sheep.md"]
+        counts = build_index(path, documents, embedder=embedder)
+
+        assert embedder.embedded == ["Cows have four stomach compartments."]
+        assert counts == {"kept": 1, "embedded": 1, "passages": 2}
+        sources = [passage["source"] for passage in Retriever(path).index.metadata]
+        assert sorted(sources) == ["cows.md", "goats.md"]
+
+    def test_relevant_passages_are_added_after_the_cache_point(self, tmp_path, create_ddb_table):
+        path = str(tmp_path / "documents")
+        build_index(path, DOCUMENTS)
+        client = Chatbot(
+            "us.anthropic.claude-3-7-sonnet-20250219-v1:0",
+            os.environ["DDB_TABLE_NAME"],
+            execution_mode=ExecutionMode.SERIAL,
+            retriever=Retriever(path, k=1),
+        )
+        system = []
+
+        def fake_make_api_call(self, operation_name, kwarg):
+            if operation_name == "Converse":
+                system.append(kwarg["system"])
+                return {
+                    "output": {"message": {"role": "assistant", "content": [{"text": "Yes."}]}},
+                    "stopReason": "end_turn",
+                    "usage": {"inputTokens": 54, "outputTokens": 2, "totalTokens": 56},
+                    "metrics": {"latencyMs": 100},
+                }
+            return orig(self, operation_name, kwarg)
+
+        messages = Messages("retrieval", [Message(role="user", content=[ContentItem(text="Can goats climb trees?")])])
+        static_prompts = [{"text": "Answer questions about farm animals. " * 200}]
+        with patch("botocore.client.BaseClient._make_api_call", new=fake_make_api_call):
+            client.converse(static_prompts, messages, use_cache=False)
+
+        # The passages change every turn, so they come after the cached prefix.
+        (prompts,) = system
+        assert prompts[:2] == static_prompts + [CACHE_POINT]
+        assert "[goats.md]\nGoats can climb trees" in prompts[2]["text"]
+        assert "Sheep" not in prompts[2]["text"]
+        assert len(prompts) == 3
@@ -0,0 +1,130 @@
+import os
+import sys
+import botocore.client
+import pytest
+
+from botocore.exceptions import ClientError
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from models import ContentItem, Message, Messages
+from resilience import RetryPolicy, Throttled
+from router import ModelRouter, parse_routes
+
+DEFAULT_MODEL = "anthropic.claude-3-sonnet-20240229-v1:0"
+SMALL_MODEL = "anthropic.claude-3-haiku-20240307-v1:0"
+LARGE_MODEL = "anthropic.claude-3-opus-20240229-v1:0"
+
+NO_RETRIES = RetryPolicy(max_attempts=1)
+
+ROUTES = f"""[
+    {{"model_id": "{LARGE_MODEL}", "keywords": ["prove", "step by step"]}},
+    {{"model_id": "{SMALL_MODEL}", "max_prompt_tokens": 50, "max_history_messages": 2}}
+]"""
+
+orig = botocore.client.BaseClient._make_api_call
+
+
+def conversation(prompt, history=0):
+    messages = [
+        Message(role="user" if index % 2 == 0 else "assistant", content=[ContentItem(text="Baa")])
+        for index in range(history)
+    ]
+    messages.append(Message(role="user", content=[ContentItem(text=prompt)]))
+    return Messages(session_id="router", messages=messages)
+
+
+@pytest.fixture()
+def bedrock_calls():
+    """Records the model of each Bedrock call, throttling the models in the throttled set."""
+    calls = {"models": [], "throttled": set()}
+
+    def fake_make_api_call(self, operation_name, kwarg):
+        if operation_name in ("Converse", "ConverseStream"):
+            calls["models"].append(kwarg["modelId"])
+            if kwarg["modelId"] in calls["throttled"]:
+                raise ClientError(
+                    {"Error": {"Code": "ThrottlingException", "Message": "Too many requests"}},
+                    operation_name,
+                )
+            usage = {"inputTokens": 10, "outputTokens": 2, "totalTokens": 12}
+            if operation_name == "ConverseStream":
+                return {
+                    "stream": iter(
+                        [
+                            {"messageStart": {"role": "assistant"}},
+                            {"contentBlockDelta": {"delta": {"text": "Baa."}, "contentBlockIndex": 0}},
+                            {"messageStop": {"stopReason": "end_turn"}},
+                            {"metadata": {"usage": usage, "metrics": {"latencyMs": 10}}},
+                        ]
+                    )
+                }
+            return {
+                "output": {"message": {"role": "assistant", "content": [{"text": "Baa."}]}},
+                "stopReason": "end_turn",
+                "usage": usage,
+                "metrics": {"latencyMs": 10},
+            }
+        return orig(self, operation_name, kwarg)
+
+    with patch("botocore.client.BaseClient._make_api_call", new=fake_make_api_call):
+        yield calls
+
+
+class TestModelRouter:
+    def test_routes_are_checked_in_order(self):
+        router = ModelRouter(DEFAULT_MODEL, parse_routes(ROUTES))
+
+        # Short first turns go to the small model
+        assert router.route(conversation("Tell me a goat fact"))[0] == SMALL_MODEL
+        # Long prompts or long histories stay on the default model
+        assert router.route(conversation("Tell me about goats. " * 20))[0] == DEFAULT_MODEL
+        assert router.route(conversation("Tell me a goat fact", history=4))[0] == DEFAULT_MODEL
+        # Keyword rules win because they are listed first
+        assert router.route(conversation("Prove goats can climb"))[0] == LARGE_MODEL
+
+    def test_without_routes_uses_default_model(self, bedrock_calls):
+        router = ModelRouter(DEFAULT_MODEL)
+
+        message = router.converse([{"text": "Be brief"}], conversation("Tell me a goat fact"))
+
+        assert bedrock_calls["models"] == [DEFAULT_MODEL]
+        assert message.model_id == DEFAULT_MODEL
+        assert message.to_record()["model_id"] == DEFAULT_MODEL
+        # The model id is stored but never sent back to the model
+        assert "model_id" not in message.to_dict()
+
+    def test_throttled_model_falls_back(self, bedrock_calls):
+        router = ModelRouter(DEFAULT_MODEL, parse_routes(ROUTES), retry_policy=NO_RETRIES)
+        bedrock_calls["throttled"].add(SMALL_MODEL)
+
+        message = router.converse([{"text": "Be brief"}], conversation("Tell me a goat fact"))
+
+        assert bedrock_calls["models"] == [SMALL_MODEL, DEFAULT_MODEL]
+        assert message.model_id == DEFAULT_MODEL
+
+    def test_throttled_stream_falls_back(self, bedrock_calls):
+        router = ModelRouter(DEFAULT_MODEL, parse_routes(ROUTES), retry_policy=NO_RETRIES)
+        bedrock_calls["throttled"].add(SMALL_MODEL)
+
+        stream = router.converse_stream([{"text": "Be brief"}], conversation("Tell me a goat fact"))
+        deltas = []
+        while True:
+            try:
+                deltas.append(next(stream))
+            except StopIteration as stop:
+                message = stop.value
+                break
+
+        assert deltas == ["Baa."]
+        assert bedrock_calls["models"] == [SMALL_MODEL, DEFAULT_MODEL]
+        assert message.model_id == DEFAULT_MODEL
+
+    def test_throttled_fallback_raises(self, bedrock_calls):
+        router = ModelRouter(DEFAULT_MODEL, parse_routes(ROUTES), retry_policy=NO_RETRIES)
+        bedrock_calls["throttled"].update({SMALL_MODEL, DEFAULT_MODEL})
+
+        with pytest.raises(Throttled):
+            router.converse([{"text": "Be brief"}], conversation("Tell me a goat fact"))
+        assert bedrock_calls["models"] == [SMALL_MODEL, DEFAULT_MODEL]
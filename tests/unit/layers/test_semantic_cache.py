@@ -0,0 +1,91 @@
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from bedrock import Bedrock
+from models import ContentItem, Message, Messages
+from response_cache import namespace_key
+from semantic_cache import SemanticCache, build_index
+from vector_index import HashingEmbedder, VectorIndex
+
+ANSWER = {"role": "assistant", "content": [{"text": "We are open 9am to 5pm."}]}
+
+
+class TestSemanticCache:
+    def test_hashing_embedder_is_deterministic_and_normalized(self):
+        embedder = HashingEmbedder()
+
+        first = embedder.embed(["What are your opening hours?"])
+        second = HashingEmbedder().embed(["What are your opening hours?"])
+
+        assert np.array_equal(first, second)
+        assert np.isclose(np.linalg.norm(first[0]), 1.0)
+
+    def test_near_duplicate_prompt_hits(self):
+        cache = SemanticCache(threshold=0.8)
+        cache.put("namespace", "What are your opening hours?", ANSWER)
+
+        assert cache.get("namespace", "what are your opening hours") == ANSWER
+        assert cache.get("namespace", "Write me a poem about goats") is None
+        assert cache.stats == {"hits": 1, "misses": 1}
+
+    def test_matches_are_scoped_to_namespace(self):
+        cache = SemanticCache(threshold=0.8)
+        cache.put("claude", "What are your opening hours?", ANSWER)
+
+        assert cache.get("nova", "What are your opening hours?") is None
+
+    def test_size_is_bounded(self):
+        cache = SemanticCache(threshold=0.99, max_size=3)
+        for number in range(5):
+            cache.put("namespace", f"prompt number {number} about goats", ANSWER)
+
+        assert len(cache.index) == 3
+        # The oldest entries were evicted
+        assert cache.get("namespace", "prompt number 0 about goats") is None
+        assert cache.get("namespace", "prompt number 4 about goats") == ANSWER
+
+    def test_index_is_memory_mapped_on_load(self, tmp_path):
+        index_path = str(tmp_path / "semantic_cache")
+        cache = SemanticCache(threshold=0.8)
+        cache.put("namespace", "What are your opening hours?", ANSWER)
+        cache.save(index_path)
+
+        loaded = SemanticCache(threshold=0.8, index_path=index_path)
+
+        assert isinstance(loaded.index._vectors, np.memmap)
+        assert loaded.get("namespace", "what are your opening hours") == ANSWER
+        # Inserting copies the mapped vectors rather than writing to the file
+        loaded.put("namespace", "Where are you based?", ANSWER)
+        assert len(loaded.index) == 2
+        assert len(VectorIndex.load(index_path)) == 1
+
+    def test_loaded_entries_keep_their_recency(self, tmp_path):
+        index_path = str(tmp_path / "semantic_cache")
+        cache = SemanticCache(threshold=0.8, max_size=2)
+        cache.put("namespace", "What are your opening hours?", ANSWER)
+        cache.put("namespace", "Where are you based?", ANSWER)
+        cache.save(index_path)
+
+        loaded = SemanticCache(threshold=0.8, max_size=2, index_path=index_path)
+        assert loaded.get("namespace", "what are your opening hours") == ANSWER
+        loaded.put("namespace", "Do you deliver?", ANSWER)
+
+        # The entry matched since loading is kept, the other one is replaced.
+        assert loaded.get("namespace", "what are your opening hours") == ANSWER
+        assert loaded.get("namespace", "where are you based") is None
+
+    def test_built_index_answers_first_turns(self, tmp_path):
+        index_path = str(tmp_path / "answers")
+        model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
+        system_prompts = [{"text": "You are a chatbot"}]
+        answers = [{"prompt": "What are your opening hours?", "answer": "We are open 9am to 5pm."}]
+
+        assert build_index(index_path, model_id, system_prompts, answers) == 1
+
+        cache = SemanticCache(threshold=0.8, index_path=index_path)
+        prompt = Messages("session", [Message(role="user", content=[ContentItem(text="what are your opening hours")])])
+        namespace = namespace_key(Bedrock(model_id)._converse_args(system_prompts, prompt))
+        assert cache.get(namespace, "what are your opening hours") == ANSWER
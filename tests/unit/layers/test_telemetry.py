@@ -0,0 +1,32 @@
+import os
+import sys
+import pytest
+
+sys.path.append(os.path.join(os.getcwd(), "layers", "chatbot"))
+
+from telemetry import add_consumed_capacity, metrics, timed
+
+
+@pytest.fixture(autouse=True)
+def clear_metrics():
+    metrics.clear_metrics()
+    yield
+    metrics.clear_metrics()
+
+
+class TestTelemetry:
+    def test_failed_block_is_still_timed(self):
+        with pytest.raises(ValueError):
+            with timed("DynamoDBPutItem"):
+                raise ValueError("throttled")
+
+        assert len(metrics.metric_set["DynamoDBPutItemLatency"]["Value"]) == 1
+
+    def test_transaction_capacity_is_summed_across_tables(self):
+        add_consumed_capacity(
+            "ConsumedWriteCapacity",
+            [{"TableName": "a", "CapacityUnits": 2.0}, {"TableName": "b", "CapacityUnits": 4.0}],
+        )
+        add_consumed_capacity("ConsumedWriteCapacity", None)
+
+        assert metrics.metric_set["ConsumedWriteCapacity"]["Value"] == [6.0]